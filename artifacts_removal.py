@@ -1,4 +1,3 @@
-import openslide
 import h5py
 import numpy as np
 import glob
@@ -6,22 +5,27 @@ import os
 import cv2
 import time
 import argparse
-import multiprocessing as mp
 import re
+from slide_handles import get_slide, read_downsampled, slide_pool, slide_chunksize
 
 
-def artifacts_removal(coord, slide_name, patch_size):
+def artifacts_removal(coord, slide_name, patch_size, low_res=True):
     """
     Remove the patch if the white area is larger than 90 percent
     Input:
         coord (np.array): The coordinate of patche in the slide
         slide_name (str): The slide to process
         patch_size (int): The patch size used to patch the slide
+        low_res (bool): Whether to read the patch from the pyramid level closest to 256 px
+        instead of level 0
     Output:
         (bool): 1: The patch is white, otherwise, 0
     """
-    wsi = openslide.open_slide(slide_name)
-    region = wsi.read_region(coord, 0, (patch_size, patch_size)).convert("L").resize((256, 256))
+    wsi = get_slide(slide_name)
+    if low_res:
+        region = read_downsampled(wsi, coord, patch_size).convert("L")
+    else:
+        region = wsi.read_region(coord, 0, (patch_size, patch_size)).convert("L").resize((256, 256))
     _, white_region = cv2.threshold(np.array(region), 235, 255, cv2.THRESH_BINARY)
     if np.sum(white_region == 255) / (256 * 256) > 0.9:
         return 1
@@ -29,8 +33,37 @@ def artifacts_removal(coord, slide_name, patch_size):
         return 0
 
 
+def save_clean_mosaic(mosaic_dir, slide_id, coords, artifacts_indicator):
+    """
+    Write the mosaics of a slide without artifacts into coord_clean and, if there are any,
+    the removed ones into coord_artifacts
+    Input:
+        mosaic_dir (str): The mosaic directory of the slide's diagnosis and resolution
+        slide_id (str): The name of the slide
+        coords (np.array): The coordinates of the mosaics
+        artifacts_indicator (list): 1 for each mosaic that is an artifact, otherwise 0
+    Output:
+        coord_clean (np.array): The coordinates of the clean mosaics
+    """
+    artifacts_indicator = np.array(artifacts_indicator)
+    coord_clean = coords[artifacts_indicator == 0]
+    coord_artifacts = coords[artifacts_indicator == 1]
+
+    save_path_clean = os.path.join(mosaic_dir, "coord_clean")
+    save_path_artifacts = os.path.join(mosaic_dir, "coord_artifacts")
+    os.makedirs(save_path_clean, exist_ok=True)
+    os.makedirs(save_path_artifacts, exist_ok=True)
+    with h5py.File(os.path.join(save_path_clean, slide_id + ".h5"), 'w') as hf:
+        hf.create_dataset("coords", data=coord_clean)
+    if len(coord_artifacts) > 0:
+        with h5py.File(os.path.join(save_path_artifacts, slide_id + ".h5"), 'w') as hf:
+            hf.create_dataset("coords", data=coord_artifacts)
+    return coord_clean
+
+
 def process_mosaics(site_slide_path, site_mosaic_path):
-    pool = mp.Pool(4)
+    num_workers = 4
+    pool = slide_pool(num_workers)
     total = len(glob.glob(os.path.join(site_mosaic_path, "*", "*", "coord", "*")))
     progress = 0
 
@@ -53,33 +86,14 @@ def process_mosaics(site_slide_path, site_mosaic_path):
         slide_path = os.path.join(site_slide_path, diagnosis, resolution, slide_id + ".svs")
         t_start = time.time()
         iterable = [(coord, slide_path, patch_size) for coord in coords]
-        artifacts_indicator = pool.starmap(artifacts_removal, iterable)
-        coord_clean = coords[np.array(artifacts_indicator) == 0]
-        coord_artifacts = coords[np.array(artifacts_indicator) == 1]
+        artifacts_indicator = pool.starmap(artifacts_removal, iterable,
+                                           chunksize=slide_chunksize(len(iterable), num_workers))
+        coord_clean = save_clean_mosaic(os.path.join(site_mosaic_path, diagnosis, resolution),
+                                        slide_id, coords, artifacts_indicator)
         print("Clean mosaic size:", len(coord_clean), flush=True)
         print("Removal takes: ", time.time() - t_start, flush=True)
-
-        save_path_clean = os.path.join(site_mosaic_path, diagnosis,
-                                       resolution, "coord_clean")
-        save_path_artifacts = os.path.join(site_mosaic_path, diagnosis,
-                                           resolution, "coord_artifacts")
-        # Save the results
-        if not os.path.exists(save_path_clean):
-            os.makedirs(save_path_clean)
-        if not os.path.exists(save_path_artifacts):
-            os.makedirs(save_path_artifacts)
-
-        with h5py.File(os.path.join(save_path_clean, slide_id + ".h5"), 'w') as hf:
-            hf.create_dataset("coords", data=coord_clean)
-        if len(coord_clean) == len(coords):
-            print("")
-            progress += 1
-            continue
-        else:
-            with h5py.File(os.path.join(save_path_artifacts, slide_id + ".h5"), 'w') as hf:
-                hf.create_dataset("coords", data=coord_artifacts)
-            progress += 1
-            print("")
+        print("")
+        progress += 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+"""
+Benchmark the batched min_max_binarize against the per-mosaic min_max_binarized loop of
+build_index.py on random DenseNet features, and check that both produce the same codes.
+Run from the repository root:
+    python -m benchmarks.bench_binarize --num_features 100000
+"""
+import argparse
+import time
+import numpy as np
+from texture_codes import pack_codes, min_max_binarize
+
+
+def min_max_binarized_loop(feat):
+    """
+    The original element by element min_max_binarized of build_index.py
+    """
+    prev = float('inf')
+    output_binarized = []
+    for ele in feat:
+        if ele < prev:
+            code = 0
+            output_binarized.append(code)
+        elif ele >= prev:
+            code = 1
+            output_binarized.append(code)
+        prev = ele
+    output_binarized = "".join([str(e) for e in output_binarized])
+    return output_binarized
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the min-max binarization")
+    parser.add_argument("--num_features", type=int, default=100000,
+                        help="Number of features")
+    parser.add_argument("--dim", type=int, default=1024,
+                        help="Dimension of the features")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    # DenseNet features are non negative after the ReLU and the pooling, with ties at 0
+    features = np.maximum(rng.randn(args.num_features, args.dim), 0).astype(np.float32)
+
+    t_start = time.time()
+    codes_loop = pack_codes([min_max_binarized_loop(feat) for feat in features])
+    t_loop = time.time() - t_start
+
+    t_start = time.time()
+    codes = min_max_binarize(features)
+    t_batch = time.time() - t_start
+
+    t_start = time.time()
+    codes_str = min_max_binarize(features, as_str=True)
+    t_str = time.time() - t_start
+
+    assert np.array_equal(codes, codes_loop), "The batched codes differ from the loop"
+    assert np.array_equal(pack_codes(codes_str), codes_loop), "The string codes differ from the loop"
+    print("{} features of dimension {}".format(args.num_features, args.dim))
+    print("loop:            {:.2f}s".format(t_loop))
+    print("batched:         {:.3f}s ({:.0f}x)".format(t_batch, t_loop / t_batch))
+    print("batched strings: {:.3f}s ({:.0f}x)".format(t_str, t_loop / t_str))
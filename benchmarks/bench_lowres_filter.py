@@ -0,0 +1,80 @@
+"""
+Benchmark the white patch filters read from the pyramid level closest to 256 px against
+reading every patch at level 0, on a synthetic pyramidal TIFF, and report how many keep/drop
+decisions, RGB/LBP features and artifact classifier decisions differ. The slide is textured with
+noise by default, on smooth slides the classifier rarely changes its mind. Writing the TIFF needs
+tifffile.
+Run from the repository root:
+    python -m benchmarks.bench_lowres_filter --size 32768 --patch_size 1024 --noise 20
+"""
+import argparse
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+from artifacts_removal import artifacts_removal
+from extract_mosaic import pre_filtering
+from slide_handles import close_slides
+from benchmarks.bench_slide_handles import write_slide
+
+
+def run_filters(coords, slide_path, patch_size, low_res):
+    """
+    Run both filters on every patch
+    Output:
+        white (np.array): The decision of artifacts_removal of each patch
+        features (list): The (RGB histogram, LBP histogram) of pre_filtering of each patch
+        t_elapse (float): The time taken
+    """
+    t_start = time.time()
+    white = np.array([artifacts_removal(coord, slide_path, patch_size, low_res) for coord in coords])
+    features = [pre_filtering(coord, slide_path, patch_size, low_res) for coord in coords]
+    return white, features, time.time() - t_start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the low resolution white patch filters")
+    parser.add_argument("--size", type=int, default=32768,
+                        help="Height and width of the synthetic slide")
+    parser.add_argument("--patch_size", type=int, default=1024,
+                        help="Size of the patches at level 0 (51.2 x magnification)")
+    parser.add_argument("--clf_path", type=str, default="./checkpoints/trash_lgrlbp.pkl",
+                        help="The artifact classifier applied to the LBP histograms")
+    parser.add_argument("--noise", type=int, default=20,
+                        help="Amplitude of the texture noise of the synthetic slide, 0 for smooth tissue")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    with tempfile.TemporaryDirectory() as save_dir:
+        slide_path = os.path.join(save_dir, "synthetic.tiff")
+        write_slide(slide_path, args.size, rng, noise=args.noise)
+        steps = np.arange(0, args.size - args.patch_size + 1, args.patch_size)
+        coords = [(int(x), int(y)) for y in steps for x in steps]
+
+        white_full, features_full, t_full = run_filters(coords, slide_path, args.patch_size, False)
+        close_slides()
+        white_low, features_low, t_low = run_filters(coords, slide_path, args.patch_size, True)
+        close_slides()
+
+    kept_full = np.array([hist is not None for hist, _ in features_full])
+    kept_low = np.array([hist is not None for hist, _ in features_low])
+    both = np.where(kept_full & kept_low)[0]
+    # Histograms are compared by the fraction of the 256 x 256 pixels that change bins
+    rgb_diff = [np.abs(features_full[i][0] - features_low[i][0]).sum() / (2 * 3 * 256 * 256) for i in both]
+    lbp_diff = [np.abs(features_full[i][1] - features_low[i][1]).sum() / 2 for i in both]
+
+    print("{} patches of {} px".format(len(coords), args.patch_size))
+    print("level 0:   {:.2f}s, {:.0f} patches/s".format(t_full, len(coords) / t_full))
+    print("low res:   {:.2f}s, {:.0f} patches/s ({:.1f}x)".format(t_low, len(coords) / t_low, t_full / t_low))
+    print("artifacts_removal decisions that differ: {}/{}".format(int(np.sum(white_full != white_low)), len(coords)))
+    print("pre_filtering decisions that differ: {}/{}".format(int(np.sum(kept_full != kept_low)), len(coords)))
+    if len(both) > 0:
+        print("mean changed fraction of the RGB histograms {:.4f}, of the LBP histograms {:.4f}"
+              .format(np.mean(rgb_diff), np.mean(lbp_diff)))
+        with open(args.clf_path, 'rb') as handle:
+            clf = pickle.load(handle)
+        trash_full = clf.predict(np.stack([features_full[i][1] for i in both]))
+        trash_low = clf.predict(np.stack([features_low[i][1] for i in both]))
+        print("artifact classifier decisions that differ: {}/{}".format(int(np.sum(trash_full != trash_low)), len(both)))
@@ -0,0 +1,70 @@
+"""
+Benchmark the block-wise patch_features of extract_mosaic.py against computing the white
+region filter and the RGB/LBP histograms patch by patch with pre_filtering, on a synthetic
+pyramidal TIFF, and check that both give the same features. The reference takes the white
+patches from the low resolution pre_filtering and the histograms from the level pre_filtering
+reads with --low_res_features. Writing the TIFF needs tifffile.
+Run from the repository root:
+    python -m benchmarks.bench_patch_features --size 16384 --workers 4
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from extract_mosaic import pre_filtering, patch_features, feature_block_size
+from slide_handles import slide_pool, slide_chunksize
+from benchmarks.bench_slide_handles import write_slide
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the block-wise patch features")
+    parser.add_argument("--size", type=int, default=16384,
+                        help="Height and width of the synthetic slide")
+    parser.add_argument("--patch_size", type=int, default=512,
+                        help="Size of the patches at level 0")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of worker processes")
+    parser.add_argument("--low_res_features", action='store_true',
+                        help="Compute the histograms from the low resolution read instead of level 0")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    with tempfile.TemporaryDirectory() as save_dir:
+        slide_path = os.path.join(save_dir, "synthetic.tiff")
+        write_slide(slide_path, args.size, rng, noise=20)
+        steps = np.arange(0, args.size - args.patch_size + 1, args.patch_size)
+        coords = np.array([(x, y) for y in steps for x in steps])
+
+        pool = slide_pool(args.workers)
+        t_start = time.time()
+        results = pool.starmap(pre_filtering, [(coord, slide_path, args.patch_size, True) for coord in coords],
+                               chunksize=slide_chunksize(len(coords), args.workers))
+        white_patch = np.array([r[0] is None for r in results])
+        if not args.low_res_features:
+            results = pool.starmap(pre_filtering, [(coord, slide_path, args.patch_size, False)
+                                                   for coord in coords[~white_patch]],
+                                   chunksize=slide_chunksize(int(np.sum(~white_patch)), args.workers))
+        hist_patch = np.concatenate([r[0] for r in results if r[0] is not None], 0)
+        lbp_patch = np.stack([r[1] for r in results if r[1] is not None])
+        t_patch = time.time() - t_start
+
+        t_start = time.time()
+        block_size = min(feature_block_size, slide_chunksize(len(coords), args.workers))
+        blocks = [coords[start:start + block_size] for start in range(0, len(coords), block_size)]
+        results = pool.starmap(patch_features, [(block, slide_path, args.patch_size, args.low_res_features)
+                                                for block in blocks])
+        white_block = np.concatenate([r[0] for r in results])
+        hist_block = np.concatenate([r[1] for r in results], 0)
+        lbp_block = np.concatenate([r[2] for r in results], 0)
+        t_block = time.time() - t_start
+        pool.close()
+        pool.join()
+
+    assert np.array_equal(white_patch, white_block), "The white patches differ"
+    assert np.array_equal(hist_patch, hist_block), "The RGB histograms differ"
+    assert np.allclose(lbp_patch, lbp_block), "The LBP histograms differ"
+    print("{} patches of {} px, {} white".format(len(coords), args.patch_size, int(np.sum(white_block))))
+    print("per patch: {:.2f}s, {:.0f} patches/s".format(t_patch, len(coords) / t_patch))
+    print("blocks:    {:.2f}s, {:.0f} patches/s".format(t_block, len(coords) / t_block))
@@ -0,0 +1,97 @@
+"""
+Benchmark the slide-level HistoDatabase.query_batch against querying the mosaics of a slide
+one by one on a synthetic database, and check that both return the same results.
+Run from the repository root:
+    python -m benchmarks.bench_query_batch --num_slides 2000 --mosaics 30
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+from database import HistoDatabase
+from meta_store import ColumnarMeta
+from mosaic_index import latents_to_indices
+
+
+def build_database(save_dir, num_slides, mosaics, num_patients, rng):
+    """
+    Write a synthetic slide database (codebook and columnar meta) into save_dir
+    Input:
+        save_dir (str): The directory to write into
+        num_slides (int): The number of slides in the database
+        mosaics (int): The number of mosaics per slide
+        num_patients (int): The number of distinct patients
+        rng (np.random.RandomState): The random generator
+    Output:
+        slides (dict): Slide name -> (latents, packed codes) usable as queries
+    """
+    codebook = torch.from_numpy(rng.permutation(128))
+    torch.save(codebook, os.path.join(save_dir, 'codebook_semantic.pt'))
+    lookup = codebook.numpy()
+
+    # Mosaics are drawn around a few tissue prototypes so that neighbouring keys exist
+    prototypes = rng.randint(0, 128, size=(16, 64, 64))
+    database = {}
+    slides = {}
+    for s in range(num_slides):
+        slide_name = 'TCGA-XX-{:04d}-01Z-{}'.format(rng.randint(num_patients), s)
+        latents = prototypes[rng.randint(len(prototypes), size=mosaics)]
+        latents = np.clip(latents + rng.randint(-3, 4, size=latents.shape), 0, 127).astype(np.int64)
+        codes = np.packbits(rng.randint(0, 2, size=(mosaics, 1024)).astype(bool), axis=1)
+        slides[slide_name] = (latents, codes)
+        for key, code in zip(latents_to_indices(latents, lookup).tolist(), codes):
+            database.setdefault(key, []).append({'slide_name': slide_name, 'dense_binarized': code,
+                                                 'x': 0, 'y': 0, 'slide_ext': '.svs',
+                                                 'diagnosis': 'd{}'.format(s % 4), 'site': 'synthetic'})
+    ColumnarMeta.from_dict(database).save(os.path.join(save_dir, 'columnar'))
+    return slides
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark HistoDatabase.query_batch against per-mosaic queries")
+    parser.add_argument("--num_slides", type=int, default=2000,
+                        help="Number of slides in the synthetic database")
+    parser.add_argument("--mosaics", type=int, default=30,
+                        help="Number of mosaics per slide")
+    parser.add_argument("--num_patients", type=int, default=500,
+                        help="Number of distinct patients")
+    parser.add_argument("--num_queries", type=int, default=20,
+                        help="Number of slides queried")
+    parser.add_argument("--thrsh", type=int, default=520,
+                        help="Hamming threshold, random codes need a looser one than 128")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    with tempfile.TemporaryDirectory() as save_dir:
+        slides = build_database(save_dir, args.num_slides, args.mosaics, args.num_patients, rng)
+        db = HistoDatabase(None, os.path.join(save_dir, 'columnar'),
+                           os.path.join(save_dir, 'codebook_semantic.pt'))
+        print("Synthetic database with {} keys and {} mosaics"
+              .format(len(db.meta.keys), len(db.meta.codes)), flush=True)
+
+        t_single = 0
+        t_batch = 0
+        query_names = list(slides.keys())[:args.num_queries]
+        for slide_name in query_names:
+            latents, codes = slides[slide_name]
+            db.leave_one_patient(slide_name.split("-")[2])
+
+            t_start = time.time()
+            indices = db.slides_to_indices(latents)
+            single = [db.query_by_index(index, code, thrsh=args.thrsh)
+                      for index, code in zip(indices, codes)]
+            t_single += time.time() - t_start
+
+            t_start = time.time()
+            batch = db.query_batch(latents, codes, thrsh=args.thrsh)
+            t_batch += time.time() - t_start
+
+            if single != batch:
+                raise RuntimeError("query_batch differs from per-mosaic queries on {}".format(slide_name))
+
+        print("per-mosaic: {:.3f} s/slide".format(t_single / len(query_names)))
+        print("query_batch: {:.3f} s/slide ({:.2f}x)".format(t_batch / len(query_names),
+                                                            t_single / max(t_batch, 1e-9)))
@@ -0,0 +1,63 @@
+"""
+Benchmark the mosaic selection of extract_mosaic.py against K-means on all clean patches
+for synthetic slides of growing size. Reports the selection time and the mean distance of
+the patches to their closest mosaic (in patches) as the coverage of the slide.
+Run from the repository root:
+    python -m benchmarks.bench_select_mosaic --sizes 1000 10000 100000 300000 --max_exact 30000
+"""
+import argparse
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.cluster import KMeans
+from extract_mosaic import select_mosaic
+
+
+def slide_coords(num_patches, patch_size, rng):
+    """
+    The coordinates of about num_patches clean patches of a slide with elliptic tissue pieces
+    """
+    side = int(np.sqrt(num_patches * 2.5))
+    yy, xx = np.mgrid[:side, :side]
+    tissue = np.zeros((side, side), dtype=bool)
+    for _ in range(6):
+        cy, cx = rng.uniform(0, side, 2)
+        ry, rx = rng.uniform(side / 8, side / 3, 2)
+        tissue |= ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 < 1
+    coords = np.stack([xx[tissue], yy[tissue]], 1) * patch_size
+    return coords[:num_patches]
+
+
+def coverage(coords, mosaic, patch_size):
+    return np.mean(cKDTree(mosaic).query(coords)[0]) / patch_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the mosaic selection")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 100000, 300000],
+                        help="Number of clean patches of each slide")
+    parser.add_argument("--sample_rate", type=float, default=0.1)
+    parser.add_argument("--max_exact", type=int, default=30000,
+                        help="Largest slide also clustered with K-means on all patches")
+    parser.add_argument("--patch_size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    for size in args.sizes:
+        coords = slide_coords(size, args.patch_size, rng)
+        t_start = time.time()
+        mosaic = select_mosaic(coords, args.sample_rate, seed=args.seed)
+        t_select = time.time() - t_start
+        again = select_mosaic(coords, args.sample_rate, seed=args.seed)
+        assert np.array_equal(mosaic, again), "The selection is not deterministic"
+        line = "{:>7} patches, {:>6} mosaics: select_mosaic {:.2f}s (coverage {:.2f})".format(
+            len(coords), len(mosaic), t_select, coverage(coords, mosaic, args.patch_size))
+        if len(coords) <= args.max_exact:
+            t_start = time.time()
+            model = KMeans(n_clusters=int(args.sample_rate * len(coords)), random_state=args.seed)
+            model.fit(coords)
+            exact = model.cluster_centers_.astype(int)
+            line += ", K-means {:.2f}s (coverage {:.2f})".format(
+                time.time() - t_start, coverage(coords, exact, args.patch_size))
+        print(line, flush=True)
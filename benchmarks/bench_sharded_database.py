@@ -0,0 +1,80 @@
+"""
+Benchmark the ShardedHistoDatabase over the key range shards of a synthetic database against
+the single HistoDatabase, and check that both return the same results.
+Run from the repository root:
+    python -m benchmarks.bench_sharded_database --num_slides 2000 --num_shards 4
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from database import HistoDatabase
+from sharded_database import ShardedHistoDatabase, split_by_key_range
+from benchmarks.bench_query_batch import build_database
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sharded database against a single database")
+    parser.add_argument("--num_slides", type=int, default=2000,
+                        help="Number of slides in the synthetic database")
+    parser.add_argument("--mosaics", type=int, default=30,
+                        help="Number of mosaics per slide")
+    parser.add_argument("--num_patients", type=int, default=500,
+                        help="Number of distinct patients")
+    parser.add_argument("--num_shards", type=int, default=4,
+                        help="Number of key range shards")
+    parser.add_argument("--num_queries", type=int, default=20,
+                        help="Number of slides queried")
+    parser.add_argument("--thrsh", type=int, default=520,
+                        help="Hamming threshold, random codes need a looser one than 128")
+    parser.add_argument("--sequential", action='store_true',
+                        help="Search the shards one after the other in this process")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    with tempfile.TemporaryDirectory() as save_dir:
+        slides = build_database(save_dir, args.num_slides, args.mosaics, args.num_patients, rng)
+        codebook = os.path.join(save_dir, 'codebook_semantic.pt')
+        shard_paths = split_by_key_range(os.path.join(save_dir, 'columnar'), args.num_shards,
+                                         os.path.join(save_dir, 'shards'))
+        db = HistoDatabase(None, os.path.join(save_dir, 'columnar'), codebook)
+        sharded = ShardedHistoDatabase(shard_paths, codebook, parallel=not args.sequential)
+        print("Synthetic database with {} keys and {} mosaics in {} shards"
+              .format(len(db.meta.keys), len(db.meta.codes), len(shard_paths)), flush=True)
+
+        t_single = 0
+        t_sharded = 0
+        num_results = 0
+        query_names = list(slides.keys())[:args.num_queries]
+        try:
+            for slide_name in query_names:
+                latents, codes = slides[slide_name]
+                patient_id = slide_name.split("-")[2]
+                db.leave_one_patient(patient_id)
+                sharded.leave_one_patient(patient_id)
+
+                t_start = time.time()
+                single = db.query_batch(latents, codes, thrsh=args.thrsh)
+                t_single += time.time() - t_start
+
+                t_start = time.time()
+                merged = sharded.query_batch(latents, codes, thrsh=args.thrsh)
+                t_sharded += time.time() - t_start
+
+                if single != merged:
+                    raise RuntimeError("The sharded database differs from the single database on {}"
+                                       .format(slide_name))
+                if sharded.query_by_index(db.slides_to_indices(latents[:1])[0], codes[0],
+                                          thrsh=args.thrsh) != single[0]:
+                    raise RuntimeError("query_by_index of the sharded database differs on {}"
+                                       .format(slide_name))
+                num_results += sum(len(res) for res in single)
+        finally:
+            sharded.close()
+
+        print("{} results of {} slides are identical".format(num_results, len(query_names)))
+        print("single:  {:.3f} s/slide".format(t_single / len(query_names)))
+        print("sharded: {:.3f} s/slide ({:.2f}x)".format(t_sharded / len(query_names),
+                                                          t_single / max(t_sharded, 1e-9)))
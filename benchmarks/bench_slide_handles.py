@@ -0,0 +1,104 @@
+"""
+Benchmark the white patch filter of artifacts_removal.py with the cached slide handles of
+slide_handles.py against opening the slide for every patch, on a synthetic pyramidal TIFF,
+and check that both give the same decisions. Writing the TIFF needs tifffile.
+Run from the repository root:
+    python -m benchmarks.bench_slide_handles --size 16384 --workers 4
+"""
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+import openslide
+import tifffile
+from artifacts_removal import artifacts_removal
+from slide_handles import slide_pool, slide_chunksize
+
+
+def write_slide(path, size, rng, levels=4, noise=0):
+    """
+    Write a tiled pyramidal RGB TIFF of white background with round tissue blobs
+    Input:
+        path (str): The path of the TIFF
+        size (int): The height and width of level 0
+        rng (np.random.RandomState): The random generator
+        levels (int): The number of pyramid levels, each 4 times smaller than the previous one
+        noise (int): The amplitude of the uniform noise added to the pixels as texture
+    """
+    cell = 64
+    small = np.full((size // cell, size // cell, 3), 245, dtype=np.uint8)
+    yy, xx = np.ogrid[:size // cell, :size // cell]
+    for _ in range(size // 512):
+        y, x = rng.randint(0, size // cell, 2)
+        radius = rng.randint(2, size // cell // 8)
+        small[(yy - y) ** 2 + (xx - x) ** 2 < radius ** 2] = rng.randint(120, 200, 3)
+    level = cv2.resize(small, (size, size), interpolation=cv2.INTER_NEAREST)
+    if noise > 0:
+        for row in range(0, size, 1024):
+            block = level[row:row + 1024].astype(np.int16) + rng.randint(-noise, noise + 1, level[row:row + 1024].shape)
+            level[row:row + 1024] = np.clip(block, 0, 255)
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for i in range(levels):
+            tif.write(level, tile=(256, 256), photometric='rgb', compression='zlib',
+                      subfiletype=0 if i == 0 else 1)
+            level = cv2.resize(level, (level.shape[1] // 4, level.shape[0] // 4),
+                               interpolation=cv2.INTER_AREA)
+
+
+def artifacts_removal_reopen(coord, slide_name, patch_size):
+    """
+    The filter of artifacts_removal.py opening the slide for every patch
+    """
+    wsi = openslide.open_slide(slide_name)
+    region = wsi.read_region(coord, 0, (patch_size, patch_size)).convert("L").resize((256, 256))
+    _, white_region = cv2.threshold(np.array(region), 235, 255, cv2.THRESH_BINARY)
+    if np.sum(white_region == 255) / (256 * 256) > 0.9:
+        return 1
+    else:
+        return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cached slide handles")
+    parser.add_argument("--size", type=int, default=16384,
+                        help="Height and width of the synthetic slide")
+    parser.add_argument("--patch_size", type=int, default=512,
+                        help="Size of the patches read at level 0")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of worker processes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    with tempfile.TemporaryDirectory() as save_dir:
+        slide_path = os.path.join(save_dir, "synthetic.tiff")
+        t_start = time.time()
+        write_slide(slide_path, args.size, rng)
+        print("Wrote a {0}x{0} slide in {1:.1f}s".format(args.size, time.time() - t_start), flush=True)
+
+        steps = np.arange(0, args.size - args.patch_size + 1, args.patch_size)
+        coords = [(int(x), int(y)) for y in steps for x in steps]
+        iterable = [(coord, slide_path, args.patch_size) for coord in coords]
+
+        pool = mp.Pool(args.workers)
+        t_start = time.time()
+        reopen = pool.starmap(artifacts_removal_reopen, iterable)
+        t_reopen = time.time() - t_start
+        pool.close()
+        pool.join()
+
+        pool = slide_pool(args.workers)
+        t_start = time.time()
+        cached = pool.starmap(artifacts_removal, iterable,
+                              chunksize=slide_chunksize(len(iterable), args.workers))
+        t_cached = time.time() - t_start
+        pool.close()
+        pool.join()
+
+    assert reopen == cached, "The cached handles change the decisions"
+    print("{} patches of {} px, {} removed as white".format(len(coords), args.patch_size, sum(cached)))
+    print("open per patch: {:.2f}s, {:.0f} patches/s".format(t_reopen, len(coords) / t_reopen))
+    print("cached handles: {:.2f}s, {:.0f} patches/s".format(t_cached, len(coords) / t_cached))
@@ -0,0 +1,78 @@
+"""
+Benchmark the per-query latency of SortedIndex against the VEB tree on a synthetic index.
+Run from the repository root:
+    python -m benchmarks.bench_sorted_index --num_keys 10000000
+"""
+import argparse
+import time
+import numpy as np
+from veb import VEB
+from sorted_index import SortedIndex
+
+
+def time_queries(index, queries, steps):
+    """
+    Time the predecessor/successor/member calls and a cursor walk of the given number of steps
+    Input:
+        index (VEB or SortedIndex): The index to benchmark
+        queries (np.array): The query keys
+        steps (int): The number of keys visited per walk (pre_step/succ_step in the search)
+    Output:
+        timings (dict): Average latency per operation in microseconds
+    """
+    queries = queries.tolist()
+    timings = {}
+    for name in ['predecessor', 'successor', 'member']:
+        fn = getattr(index, name)
+        t_start = time.time()
+        for q in queries:
+            fn(q)
+        timings[name] = (time.time() - t_start) / len(queries) * 1e6
+
+    t_start = time.time()
+    for q in queries:
+        for count, _ in enumerate(index.iter_predecessors(q)):
+            if count + 1 >= steps:
+                break
+    timings['walk_{}'.format(steps)] = (time.time() - t_start) / len(queries) * 1e6
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SortedIndex against VEB")
+    parser.add_argument("--num_keys", type=int, default=10000000,
+                        help="Number of keys in the synthetic index")
+    parser.add_argument("--num_queries", type=int, default=10000,
+                        help="Number of random queries")
+    parser.add_argument("--steps", type=int, default=375,
+                        help="Number of keys visited in the walk benchmark")
+    parser.add_argument("--universe", type=int, default=2 ** 32,
+                        help="Upper bound of the synthetic keys")
+    parser.add_argument("--skip_veb", action='store_true',
+                        help="Only benchmark the sorted index")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    keys = np.unique(rng.randint(0, args.universe, size=args.num_keys, dtype=np.int64))
+    queries = rng.randint(0, args.universe, size=args.num_queries, dtype=np.int64)
+    print("Synthetic index with {} unique keys".format(len(keys)), flush=True)
+
+    engines = {}
+    t_start = time.time()
+    engines['sorted'] = SortedIndex(keys)
+    print("SortedIndex build takes {:.2f}s".format(time.time() - t_start), flush=True)
+
+    if not args.skip_veb:
+        t_start = time.time()
+        veb = VEB(int(keys[-1]))
+        for k in keys.tolist():
+            veb.insert(k)
+        engines['veb'] = veb
+        print("VEB build takes {:.2f}s".format(time.time() - t_start), flush=True)
+
+    results = {name: time_queries(index, queries, args.steps) for name, index in engines.items()}
+    print("")
+    print("{:<16}".format("us/query") + "".join("{:>12}".format(name) for name in results))
+    for op in results['sorted']:
+        print("{:<16}".format(op) + "".join("{:>12.2f}".format(results[name][op]) for name in results))
@@ -0,0 +1,79 @@
+"""
+Load test of a running query_server.py. Sends concurrent mosaic queries with random latent codes
+and texture features, or slide queries with the latent files matched by --latent_glob, and
+reports the throughput, the latency percentiles and the server metrics.
+Run from the repository root against a local server:
+    python -m benchmarks.load_test_server --site brain --concurrency 16 --num_requests 1000
+"""
+import argparse
+import glob
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def random_mosaic(rng):
+    latent = rng.randint(0, 128, size=(64, 64)).tolist()
+    dense_feat = "".join(rng.choice(['0', '1'], size=1024))
+    return {'latent': latent, 'dense_feat': dense_feat}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a running query_server.py")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    parser.add_argument("--site", type=str, required=True,
+                        help="The site queried")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Number of concurrent clients")
+    parser.add_argument("--num_requests", type=int, default=1000,
+                        help="Total number of requests")
+    parser.add_argument("--latent_glob", type=str, default=None,
+                        help="Send slide queries for these latent h5 files instead of random mosaics, "
+                             "they have to lie under the --data_root of the server")
+    parser.add_argument("--thrsh", type=int, default=128,
+                        help="Hamming threshold of the queries")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("Server: {}".format(get(args.url + "/health")), flush=True)
+    rng = np.random.RandomState(args.seed)
+    if args.latent_glob is not None:
+        latents = sorted(glob.glob(args.latent_glob))
+        endpoint = args.url + "/query/slide"
+        bodies = [{'site': args.site, 'latent_path': latents[i % len(latents)],
+                   'params': {'thrsh': args.thrsh}} for i in range(args.num_requests)]
+    else:
+        endpoint = args.url + "/query/mosaic"
+        bodies = [dict(random_mosaic(rng), site=args.site, params={'thrsh': args.thrsh})
+                  for _ in range(args.num_requests)]
+
+    def timed_post(body):
+        t_start = time.time()
+        post(endpoint, body)
+        return time.time() - t_start
+
+    t_start = time.time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = np.array(list(pool.map(timed_post, bodies)))
+    t_elapse = time.time() - t_start
+
+    print("{} requests with {} clients in {:.2f}s: {:.1f} requests/s".format(
+        len(bodies), args.concurrency, t_elapse, len(bodies) / t_elapse))
+    print("latency mean {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+        latencies.mean() * 1e3, np.percentile(latencies, 50) * 1e3,
+        np.percentile(latencies, 95) * 1e3, np.percentile(latencies, 99) * 1e3))
+    print("Server metrics: {}".format(get(args.url + "/metrics")))
@@ -1,11 +1,12 @@
 import argparse
+import json
 import os
+import shutil
 import time
 import numpy as np
 import h5py
 import glob
 import torch
-import multiprocessing as mp
 
 # HANDLE OS SPECIFIC OPENSLIDE IMPORT
 if hasattr(os, 'add_dll_directory'):
@@ -16,10 +17,13 @@ if hasattr(os, 'add_dll_directory'):
 else:
 	import openslide
 
-import copy
 import pickle
 from collections import OrderedDict
 from veb import VEB
+from texture_codes import pack_codes, min_max_binarize
+from mosaic_index import semantic_lookup, latents_to_indices
+from meta_store import ColumnarMeta
+from build_journal import BuildJournal
 from models.vqvae import LargeVectorQuantizedVAE_Encode
 from dataset import Mosaic_Bag_FP
 from torchvision.models import densenet121
@@ -66,58 +70,17 @@ def save_hdf5(output_path, asset_dict, mode='a'):
     return output_path
 
 
-def to_latent_semantic(latent, codebook_semantic):
-    """
-    Convert the original VQ-VAE latent code by using re-ordered codebook
-    Input:
-        latent (64 x 64 np.array): The original latent code from VQ-VAE encoder
-        codebook_semantic (dict): The dictionary that map old codewords to
-        the new ones
-    Output:
-        latent_semantic: The latent code with new codewords
-    """
-    latent_semantic = np.zeros_like(latent)
-    for i in range(latent_semantic.shape[0]):
-        for j in range(latent_semantic.shape[1]):
-            latent_semantic[i][j] = codebook_semantic[latent[i][j]]
-    return latent_semantic
-
-
-def slide_to_index(latent, codebook_semantic, pool_layers, pool=None):
+def slide_to_index(latent, codebook_semantic):
     """
     Convert VQ-VAE latent code into an integer
     Input:
         latent (N x 64 x 64 np array): The latent code from VQ-VAE enecoder
-        codebook_semantic (128 x 256): The codebook from VQ-VAE encoder
-        pool_layers (torch.nn.Sequential): A series of pool layers that convert the latent code into an integer
+        codebook_semantic (dict or torch.Tensor): The semantic codebook that maps the old codewords
+        to the new ones
     Output:
-        index (int): An integer index that represents the latent code
+        index (np.array): An integer index that represents each latent code
     """
-    if pool is None:
-        result = to_latent_semantic(latent, codebook_semantic)
-        feat = torch.from_numpy(np.expand_dims(result, 0))
-    else:
-        iterable = [(lt, codebook_semantic) for lt in latent]
-        result = pool.starmap(to_latent_semantic, iterable)
-        feat = torch.from_numpy(np.array(result))
-
-    num_level = list(range(len(pool_layers) + 1))
-    level_sum_dict = {level: None for level in num_level}
-    for level in num_level:
-        if level == 0:
-            level_sum_dict[level] = torch.sum(feat, (1, 2)).numpy().astype(float)
-        else:
-            feat = pool_layers[level - 1](feat)
-            level_sum_dict[level] = torch.sum(feat, (1, 2)).numpy().astype(float)
-
-    level_power = [0, 0, 1e6, 1e11]
-    index = 0
-    for level, power in enumerate(level_power):
-        if level == 1:
-            index = copy.deepcopy(level_sum_dict[level])
-        elif level > 1:
-            index += level_sum_dict[level] * power
-    return index
+    return latents_to_indices(latent, semantic_lookup(codebook_semantic))
 
 
 def min_max_binarized(feat):
@@ -129,110 +92,176 @@ def min_max_binarized(feat):
     Output:
         output_binarized (str): A binary code of length  1024
     """
-    prev = float('inf')
-    output_binarized = []
-    for ele in feat:
-        if ele < prev:
-            code = 0
-            output_binarized.append(code)
-        elif ele >= prev:
-            code = 1
-            output_binarized.append(code)
-        prev = ele
-    output_binarized = "".join([str(e) for e in output_binarized])
-    return output_binarized
-
-
-def compute_latent_features(wsi, mosaic_path, save_path, resolution, transform,
-                            vqvae, batch_size=8, num_workers=4):
+    return min_max_binarize(np.ravel(feat), as_str=True)
+
+
+def open_slide_loader(mosaic_path, slide_path, resolution, transforms_list,
+                      batch_size=8, num_workers=4):
     """
-    Copmute the latent code of input by VQ-VAE encoder
+    Open a slide and start reading its mosaics. The DataLoader workers read ahead as soon as
+    the iterator is created, so opening the next slide before encoding the current one
+    overlaps the slide reading with the encoding.
     Input:
-        wsi (openslide objet): The slide to compute
         mosaic_path (str): The path that store wsi mosaic
-        save_path (str): Path to store latent code
+        slide_path (str): The path to the wsi
         resolution (str): The resolution of wsi (e.g., 20x or 40x)
-        transoform (torch.transforms): The transform applied to image before
-        feeding into VQ-VAE
-        vqvae (torch.models): VQ-VAE encoder along with codebook with weight
-        from the checkpoints
-        batch_size (int): The number of data processed by VQ-VAE per loop
+        transforms_list (tuple): The transforms applied to each region read, one per network
+        batch_size (int): The number of mosaics per batch
         num_workers (int): Number of cpu used by Dataloader to load the data
     Output:
-        feature list (list): list of vq-vqae latent code of length = #mosaics
-        in the wsi
+        batches (iterator): The batches of (tensor per transform, coords)
+        total (int): The number of mosaics of the slide
     """
+    wsi = openslide.open_slide(slide_path)
     dataset = Mosaic_Bag_FP(mosaic_path, wsi, int(resolution[:-1]),
-                            custom_transforms=transform)
+                            custom_transforms=tuple(transforms_list))
     dataloader = DataLoader(dataset=dataset, batch_size=batch_size,
                             num_workers=num_workers, shuffle=False,
                             pin_memory=True)
-    count = 0
-    total = len(dataset)
-    if total == 0:
-        return None
-    features_list = []
-    mode = 'w'
-    save_vqvae_path = os.path.join(save_path, 'vqvae', os.path.basename(mosaic_path))
-    with torch.no_grad():
-        for mosaic, coord in dataloader:
-            mosaic = torch.squeeze(mosaic, 1)
-            mosaic = mosaic.to(device, non_blocking=True)
-            features = vqvae(mosaic)
-            features = features.cpu().numpy()
-            features_list.append(features)
-            count += features.shape[0]
-            print("Numebr of latent code processed {}/{}".format(count, total))
-            asset_dict = {'features': features, 'coords': coord.numpy()}
-            save_hdf5(save_vqvae_path, asset_dict, mode=mode)
-            mode = 'a'
-    return np.concatenate(features_list, 0)
+    return iter(dataloader), len(dataset)
 
 
-def compute_densenet_features(wsi, mosaic_path, save_path, resolution,
-                              transform, densenet,
-                              batch_size=8, num_workers=4):
+def compute_features(batches, total, mosaic_path, save_path, vqvae, densenet, stats):
     """
-    Copmute the texture feature (h_{i}) of input by DenseNet121.
+    Compute the latent code by VQ-VAE encoder and the texture feature (h_{i}) by DenseNet121
+    of each mosaic. Both networks are fed from the same batch, so every region is read once.
     Input:
-        wsi (openslide objet): The slide to compute
+        batches (iterator): The batches of ((vq-vae input, densenet input), coords)
+        from open_slide_loader
+        total (int): The number of mosaics of the slide
         mosaic_path (str): The path that store wsi mosaic
-        save_path (str): Path to store latent code
-        resolution (str): The resolution of wsi (e.g., 20x or 40x)
-        transoform (torch.transforms): The transform applied to image before
-        feeding into DenseNet.
+        save_path (str): Path to store latent code and texture features
+        vqvae (torch.models): VQ-VAE encoder along with codebook with weight
+        from the checkpoints
         densenet (torch.models): A pretrained Densenet121 model loaded from pytorch
-        batch_size (int): The number of data processed by VQ-VAE per loop
-        num_workers (int): Number of cpu used by Dataloader to load the data
+        stats (dict): The time spent in and the number of mosaics of each stage, updated in place
     Output:
-        feature list (list): list of binarized texture feature of length = #mosaics
-        in the wsi
+        latent (np.array): vq-vae latent code of each mosaic in the wsi
+        dense_feat (np.array): packed binarized texture features (#mosaics x 128 uint8)
+        of the mosaics in the wsi
     """
-    dataset = Mosaic_Bag_FP(mosaic_path, wsi, int(resolution[:-1]),
-                            custom_transforms=transform)
-    dataloader = DataLoader(dataset=dataset, batch_size=batch_size,
-                            num_workers=num_workers, shuffle=False,
-                            pin_memory=True)
-    features_list = []
+    if total == 0:
+        return None, None
+    latent_list = []
+    dense_list = []
     count = 0
-    total = len(dataset)
+    mode = 'w'
+    save_vqvae_path = os.path.join(save_path, 'vqvae', os.path.basename(mosaic_path))
     save_dense_path = os.path.join(save_path, 'densenet',
-                                   os.path.basename(mosaic_path).replace(".h5",".pkl"))
+                                   os.path.basename(mosaic_path).replace(".h5", ".pkl"))
     with torch.no_grad():
-        for mosaic, coord in dataloader:
-            mosaic = torch.squeeze(mosaic, 1)
-            mosaic = mosaic.to(device, non_blocking=True)
-            features = densenet(mosaic)
+        while True:
+            t_read = time.time()
+            try:
+                (mosaic_vqvae, mosaic_dense), coord = next(batches)
+            except StopIteration:
+                break
+            t_vqvae = time.time()
+            latent = vqvae(torch.squeeze(mosaic_vqvae, 1).to(device, non_blocking=True))
+            latent = latent.cpu().numpy()
+            t_dense = time.time()
+            features = densenet(torch.squeeze(mosaic_dense, 1).to(device, non_blocking=True))
             features = features.cpu().numpy()
-            features_list.append(features)
-            count += features.shape[0]
-            print("Number of dense feature rocessed {}/{}".format(count, total))
+            t_end = time.time()
+
+            stats['read'] += t_vqvae - t_read
+            stats['vqvae'] += t_dense - t_vqvae
+            stats['densenet'] += t_end - t_dense
+            stats['mosaics'] += latent.shape[0]
+            latent_list.append(latent)
+            dense_list.append(features)
+            count += latent.shape[0]
+            print("Number of mosaics encoded {}/{}".format(count, total))
+            asset_dict = {'features': latent, 'coords': coord.numpy()}
+            save_hdf5(save_vqvae_path, asset_dict, mode=mode)
+            mode = 'a'
 
-    features_list = np.squeeze(np.concatenate(features_list, 0))
-    features_binarized = [min_max_binarized(feat) for feat in features_list]
+    dense_list = np.concatenate(dense_list, 0)
+    dense_list = dense_list.reshape(dense_list.shape[0], -1)
+    features_binarized = min_max_binarize(dense_list)
     with open(save_dense_path, 'wb') as handle:
         pickle.dump(features_binarized, handle)
-    return features_binarized
+    return np.concatenate(latent_list, 0), features_binarized
+
+
+def throughput_report(stats):
+    """
+    The throughput of each encoding stage in mosaics per second. The read time is the time
+    the encoding waited for the DataLoader, i.e., the reading that prefetching did not hide.
+    """
+    def rate(stage):
+        return stats['mosaics'] / stats[stage] if stats[stage] > 0 else float('inf')
+    return "{} mosaics: {:.1f} regions/s read, {:.1f} latents/s, {:.1f} dense/s".format(
+        stats['mosaics'], rate('read'), rate('vqvae'), rate('densenet'))
+
+
+def load_encoded_slide(save_path_latent, slide_id, num_mosaics):
+    """
+    Load the latent code and the texture features of a slide encoded by an earlier build
+    Input:
+        save_path_latent (str): The LATENT directory of the slide (.../SITE/DIAGNOSIS/RESOLUTION)
+        slide_id (str): The name of the slide
+        num_mosaics (int): The number of mosaics the outputs must hold
+    Output:
+        latent (np.array): The latent code of each mosaic, None if the outputs are missing
+        or incomplete
+        dense_feat (np.array): The packed texture feature of each mosaic
+    """
+    latent_path = os.path.join(save_path_latent, 'vqvae', slide_id + ".h5")
+    dense_path = os.path.join(save_path_latent, 'densenet', slide_id + ".pkl")
+    if not os.path.exists(latent_path) or not os.path.exists(dense_path):
+        return None, None
+    with h5py.File(latent_path, 'r') as hf:
+        latent = hf['features'][:]
+    with open(dense_path, 'rb') as handle:
+        dense_feat = pack_codes(pickle.load(handle))
+    if len(latent) != num_mosaics or len(dense_feat) != num_mosaics:
+        return None, None
+    return latent, dense_feat
+
+
+def load_manifest(manifest_path):
+    """
+    The manifest records the slides of a database, see build_manifest_entry
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as handle:
+        return json.load(handle)
+
+
+def build_manifest_entry(mosaic_path, diagnosis, resolution, num_mosaics):
+    """
+    The manifest entry of a slide. A slide whose mosaic file changed since it was
+    indexed is encoded again by an incremental build.
+    """
+    return {'mosaic_path': mosaic_path, 'diagnosis': diagnosis, 'resolution': resolution,
+            'num_mosaics': int(num_mosaics), 'mosaic_mtime': os.path.getmtime(mosaic_path)}
+
+
+def replace_store(new_path, store_path):
+    """
+    Move a complete columnar meta store in place of the existing one
+    """
+    old_path = store_path + ".old"
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(store_path):
+        os.rename(store_path, old_path)
+    os.rename(new_path, store_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def save_store(meta, store_path):
+    """
+    Write a columnar meta store, replacing an existing one only once the new one is complete
+    """
+    tmp_path = store_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    meta.save(tmp_path)
+    replace_store(tmp_path, store_path)
 
 
 if __name__ == "__main__":
@@ -249,6 +278,15 @@ if __name__ == "__main__":
                         help="Path to VQ-VAE checkpoint")
     parser.add_argument("--codebook_semantic", type=str, default="./checkpoints/codebook_semantic.pt", 
                         help="Path to semantic codebook")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Only add the slides that are not in the existing database yet, "
+                             "reusing their DATA/LATENT outputs when they exist")
+    parser.add_argument("--delete_slides", type=str, nargs='*', default=[],
+                        help="Slides to remove from the existing database (with --incremental)")
+    parser.add_argument("--prune_missing", action='store_true',
+                        help="Remove the slides whose mosaics no longer exist (with --incremental)")
+    parser.add_argument("--restart", action='store_true',
+                        help="Discard the journal of an interrupted build instead of resuming it")
     args = parser.parse_args()
 
     # Create the save path of database
@@ -265,15 +303,9 @@ if __name__ == "__main__":
 
     # Set up cpu and device
     device = torch.device("cuda:0,1") if torch.cuda.is_available() else torch.device('cpu')
-    num_workers = mp.cpu_count()
-    pool = mp.Pool(num_workers)
 
     t_total_start = time.time()
 
-    # initialize the database related object
-    database = {}
-    key_list = []
-
     # initialize transforms for densenet and vq-vae
     transform_densenet = transforms.Compose([transforms.ToTensor(),
                                              transforms.Normalize([0.485, 0.456, 0.406],
@@ -299,22 +331,60 @@ if __name__ == "__main__":
     vqvae = vqvae.to(device)
     vqvae.eval()
 
-    # Initialize pooling layer
-    pool_layers = [torch.nn.AvgPool2d(kernel_size=(2, 2)),
-                   torch.nn.AvgPool2d(kernel_size=(2, 2)),
-                   torch.nn.AvgPool2d(kernel_size=(2, 2))]
-    t_enc_start = time.time()
+    store_path = os.path.join(save_path_indexmeta, "columnar")
+    manifest_path = os.path.join(save_path_indexmeta, "manifest.json")
     mosaic_all = os.path.join(args.mosaic_path, args.site,
                               "*", "*", "coord_clean", "*")
-    total = len(glob.glob(mosaic_all))
+    mosaic_paths = glob.glob(mosaic_all)
+
+    # Each encoded slide is journaled, an interrupted build resumes after the last journaled slide
+    journal = BuildJournal(os.path.join(save_path_indexmeta, "journal"))
+    if args.restart:
+        journal.clear()
+        journal = BuildJournal(os.path.join(save_path_indexmeta, "journal"))
+    elif len(journal.completed) > 0:
+        print("Resuming the build after {} journaled slides".format(len(journal.completed)))
+
+    # Slides already in the database and those to remove from it
+    existing = None
+    manifest = {}
+    indexed = set()
+    removed = set()
+    if args.incremental and os.path.isdir(store_path):
+        existing = ColumnarMeta.open(store_path, mmap_mode=None)
+        manifest = load_manifest(manifest_path)
+        indexed = {existing.vocab['slide_name'][i] for i in np.unique(existing.columns['slide_name'])}
+        # Journaled slides of an interrupted run may already be in the store, they are re-added from the journal
+        removed = (set(args.delete_slides) | set(journal.completed)) & indexed
+        if args.prune_missing:
+            present = {os.path.basename(path).replace(".h5", "") for path in mosaic_paths}
+            removed |= indexed - present
+        print("Incremental build on {} indexed slides, {} to delete".format(len(indexed), len(removed)))
+    elif args.incremental:
+        print("No database in {}, building it from scratch".format(store_path))
+
+    t_enc_start = time.time()
+    total = len(mosaic_paths)
     count = 0
     number_of_mosaic = 0
-    for mosaic_path in tqdm(glob.glob(mosaic_all)):
-        print(mosaic_path)
-        t_start = time.time()
+    reused = 0
+    # Decide first which slides are encoded, so the next one can be read while encoding
+    jobs = []
+    for mosaic_path in mosaic_paths:
         resolution = mosaic_path.split("/")[-3]
         diagnosis = mosaic_path.split("/")[-4]
         slide_id = os.path.basename(mosaic_path).replace(".h5", "")
+        if slide_id in args.delete_slides or slide_id in journal.completed:
+            continue
+        if slide_id in indexed and slide_id not in removed:
+            # Indexed slides are only encoded again when their mosaics changed
+            if slide_id not in manifest:
+                manifest[slide_id] = build_manifest_entry(mosaic_path, diagnosis, resolution,
+                                                          int(np.sum(existing.slide_rows([slide_id]))))
+            if manifest[slide_id]['mosaic_mtime'] == os.path.getmtime(mosaic_path):
+                continue
+            removed.add(slide_id)
+
         slide_path = os.path.join(args.slide_path, args.site, diagnosis,
                                   resolution, slide_id + ".svs")
         save_path_latent = os.path.join("./DATA/LATENT/",
@@ -322,37 +392,95 @@ if __name__ == "__main__":
         if not os.path.exists(save_path_latent):
             os.makedirs(os.path.join(save_path_latent, 'vqvae'))
             os.makedirs(os.path.join(save_path_latent, 'densenet'))
-
-        with h5py.File(mosaic_path, 'r') as hf:
+        jobs.append({'mosaic_path': mosaic_path, 'slide_path': slide_path,
+                     'save_path_latent': save_path_latent, 'slide_id': slide_id,
+                     'diagnosis': diagnosis, 'resolution': resolution,
+                     'reuse': args.incremental and slide_id not in removed})
+
+    stats = {'read': 0., 'vqvae': 0., 'densenet': 0., 'mosaics': 0}
+    transforms_list = (transform_vqvqe, transform_densenet)
+    prefetched = {}
+    for job_id, job in enumerate(tqdm(jobs)):
+        print(job['mosaic_path'])
+        t_start = time.time()
+        with h5py.File(job['mosaic_path'], 'r') as hf:
             mosaic_coord = hf['coords'][:]
-        wsi = openslide.open_slide(slide_path)
-        latent = compute_latent_features(wsi, mosaic_path, save_path_latent,
-                                         resolution, transform_vqvqe, vqvae)
-        dense_feat = compute_densenet_features(wsi, mosaic_path,
-                                               save_path_latent, resolution,
-                                               transform_densenet, densenet)
-        slide_index = slide_to_index(latent, codebook_semantic,
-                                     pool_layers=pool_layers, pool=pool)
-
-        for idx, key in enumerate(slide_index):
-            tmp = {'slide_name': slide_id, 'dense_binarized': dense_feat[idx],
-                   'x': mosaic_coord[idx][0], 'y': mosaic_coord[idx][1],
-                   'slide_ext': args.slide_ext, 'diagnosis': diagnosis,
-                   'site': args.site}
-            if key not in database:
-                database[key] = [tmp]
+        latent, dense_feat = None, None
+        if job['reuse']:
+            latent, dense_feat = load_encoded_slide(job['save_path_latent'], job['slide_id'],
+                                                    len(mosaic_coord))
+        if latent is not None:
+            reused += 1
+        else:
+            if job_id in prefetched:
+                batches, num_mosaics = prefetched.pop(job_id)
             else:
-                database[key].append(tmp)
-            key_list.append(int(key))
+                batches, num_mosaics = open_slide_loader(job['mosaic_path'], job['slide_path'],
+                                                         job['resolution'], transforms_list)
+            # Start reading the next slide that is not reused
+            next_id = next((i for i in range(job_id + 1, len(jobs)) if not jobs[i]['reuse']), None)
+            if next_id is not None and next_id not in prefetched:
+                prefetched[next_id] = open_slide_loader(jobs[next_id]['mosaic_path'],
+                                                        jobs[next_id]['slide_path'],
+                                                        jobs[next_id]['resolution'],
+                                                        transforms_list)
+            latent, dense_feat = compute_features(batches, num_mosaics, job['mosaic_path'],
+                                                  job['save_path_latent'], vqvae, densenet, stats)
+            del batches
+        slide_index = slide_to_index(latent, codebook_semantic)
+
+        journal.append({'slide_name': job['slide_id'], 'diagnosis': job['diagnosis'],
+                        'site': args.site, 'slide_ext': args.slide_ext,
+                        'keys': np.asarray(slide_index, dtype=np.int64),
+                        'codes': pack_codes(dense_feat),
+                        'x': mosaic_coord[:, 0], 'y': mosaic_coord[:, 1],
+                        'manifest': build_manifest_entry(job['mosaic_path'], job['diagnosis'],
+                                                         job['resolution'], len(mosaic_coord))})
         count += 1
         print("{}/{} Processing slide {} with diagnosis {} takes {}".
-              format(count, total, slide_id, diagnosis, time.time() - t_start))
+              format(count, total, job['slide_id'], job['diagnosis'], time.time() - t_start))
         number_of_mosaic += len(mosaic_coord)
 
     print("")
     print("Encoding takes {}".format(time.time() - t_enc_start))
-    database_keys = key_list
-    universe = max(database_keys)
+    print("Encoding throughput: {}".format(throughput_report(stats)))
+    if args.incremental:
+        print("Added {} slides ({} from existing LATENT outputs), removed or replaced {} slides"
+              .format(count, reused, len(removed)))
+
+    # Assemble the journaled slides and merge them into the existing database
+    new_store_path = store_path + ".new"
+    if os.path.exists(new_store_path):
+        shutil.rmtree(new_store_path)
+    manifest.update(journal.completed)
+    if existing is not None:
+        kept = existing.select(~existing.slide_rows(removed))
+        if len(journal.completed) > 0:
+            kept = ColumnarMeta.concat([kept, journal.assemble(new_store_path)])
+        save_store(kept, store_path)
+        if os.path.exists(new_store_path):
+            shutil.rmtree(new_store_path)
+    else:
+        journal.assemble(new_store_path)
+        replace_store(new_store_path, store_path)
+    meta = ColumnarMeta.open(store_path)
+
+    # The journal is only dropped once its slides are in the store
+    for slide_id in args.delete_slides:
+        manifest.pop(slide_id, None)
+    if args.prune_missing:
+        present = {os.path.basename(path).replace(".h5", "") for path in mosaic_paths}
+        manifest = {slide_id: entry for slide_id, entry in manifest.items() if slide_id in present}
+    with open(manifest_path, 'w') as handle:
+        json.dump(manifest, handle)
+    journal.clear()
+
+    # The VEB tree has no deletion, so it is rebuilt from the keys of the merged database
+    database_keys = meta.keys.tolist()
+    if len(database_keys) == 0:
+        # e.g., --delete_slides or --prune_missing removed every slide
+        print("The database of site {} has no mosaics left, writing an empty index".format(args.site))
+    universe = max(database_keys, default=0)
     number_of_index = len(database_keys)
     print("Universe size of veb tree:", universe)
     veb = VEB(universe)
@@ -360,5 +488,3 @@ if __name__ == "__main__":
         veb.insert(int(k))
     with open(os.path.join(save_path_indextree, "veb.pkl"), 'wb') as handle:
         pickle.dump(veb, handle)
-    with open(os.path.join(save_path_indexmeta, "meta.pkl"), 'wb') as handle:
-        pickle.dump(database, handle)
@@ -5,11 +5,13 @@ import numpy as np
 import h5py
 import torch
 import openslide
-import copy
 import pickle
 import pandas as pd
 from collections import OrderedDict
 from veb import VEB
+from texture_codes import min_max_binarize
+from mosaic_index import semantic_lookup, latents_to_indices
+from meta_store import ColumnarMeta
 from models.vqvae import LargeVectorQuantizedVAE_Encode
 from torchvision.models import densenet121
 from torchvision import transforms
@@ -30,60 +32,17 @@ def set_everything(seed):
     torch.backends.cudnn.deterministic = True
 
 
-def to_latent_semantic(latent, codebook_semantic):
+def slide_to_index(latent, codebook_semantic):
     """
-    Convert the original VQ-VAE latent code by using re-ordered codebook
-    Input:
-        latent (64 x 64 np.array): The original latent code from VQ-VAE encoder
-        codebook_semantic (dict): The dictionary that map old codewords to
-        the new ones
-    Output:
-        latent_semantic: The latent code with new codewords
-    """
-    latent_semantic = np.zeros_like(latent)
-    for i in range(latent_semantic.shape[0]):
-        for j in range(latent_semantic.shape[1]):
-            latent_semantic[i][j] = codebook_semantic[latent[i][j]]
-    return latent_semantic
-
-
-def slide_to_index(latent, codebook_semantic, pool_layers, pool=None):
-    """
-    Convert VQ-VAE latent code into an integer.
+    Convert VQ-VAE latent code into an integer
     Input:
         latent (N x 64 x 64 np array): The latent code from VQ-VAE enecoder
-        codebook_semantic (128 x 256): The codebook from VQ-VAE encoder
-        pool_layers (torch.nn.Sequential): A series of pool layers that convert the latent code into an integer
+        codebook_semantic (dict or torch.Tensor): The semantic codebook that maps the old codewords
+        to the new ones
     Output:
-        index (int): An integer index that represents the latent code
+        index (np.array): An integer index that represents each latent code
     """
-    if pool is None:
-        result = to_latent_semantic(latent[0], codebook_semantic)
-        feat = torch.from_numpy(np.expand_dims(result, 0))
-    else:
-        iterable = [(lt, codebook_semantic) for lt in latent]
-        result = pool.starmap(to_latent_semantic, iterable)
-        feat = torch.from_numpy(np.array(result))
-
-    num_level = list(range(len(pool_layers) + 1))
-    level_sum_dict = {level: None for level in num_level}
-
-    for level in num_level:
-        if level == 0:
-            level_sum_dict[level] = torch.sum(feat, (1, 2)).numpy().astype(float)
-        else:
-            feat = pool_layers[level - 1](feat)
-            level_sum_dict[level] = torch.sum(feat, (1, 2)).numpy().astype(float)
-
-    level_power = [0, 0, 1e6, 1e11]
-    index = 0
-    for level, power in enumerate(level_power):
-        if level == 1:
-            index = copy.deepcopy(level_sum_dict[level])
-        elif level > 1:
-            index += level_sum_dict[level] * power
-
-    return index
+    return latents_to_indices(latent, semantic_lookup(codebook_semantic))
 
 
 def min_max_binarized(feat):
@@ -95,18 +54,7 @@ def min_max_binarized(feat):
     Output:
         output_binarized (str): A binary code of length  1024
     """
-    prev = float('inf')
-    output_binarized = []
-    for ele in feat:
-        if ele < prev:
-            code = 0
-            output_binarized.append(code)
-        elif ele >= prev:
-            code = 1
-            output_binarized.append(code)
-        prev = ele
-    output_binarized = "".join([str(e) for e in output_binarized])
-    return output_binarized
+    return min_max_binarize(np.ravel(feat), as_str=True)
 
 
 def compute_latent_features(patch_rescaled, patch_id, save_path, transform, vqvae):
@@ -146,7 +94,7 @@ def compute_densenet_features(patch_rescaled, patch_id, save_path, transform, de
         feeding into VQ-VAE
         densenet (torch.models): A pretrained Densenet121 model loaded from pytorch
     Output:
-        feature_binarzied (str): A string of binarzied feature of length 1024
+        feature_binarzied (np.array): The binarized feature of length 1024 packed into 128 uint8
     """
     save_dense_path = os.path.join(save_path, 'densenet', patch_id + ".pkl")
     with torch.no_grad():
@@ -156,7 +104,7 @@ def compute_densenet_features(patch_rescaled, patch_id, save_path, transform, de
         feature = densenet(inp)
         feature = feature.cpu().numpy()
     feature = np.squeeze(feature)
-    feature_binarized = min_max_binarized(feature)
+    feature_binarized = min_max_binarize(feature)
     with open(save_dense_path, 'wb') as handle:
         pickle.dump(feature_binarized, handle)
     return feature_binarized
@@ -222,9 +170,6 @@ if __name__ == "__main__":
     t_enc_start = time.time()
     database = {}
     key_list = []
-    pool_layers = [torch.nn.AvgPool2d(kernel_size=(2, 2)),
-                   torch.nn.AvgPool2d(kernel_size=(2, 2)),
-                   torch.nn.AvgPool2d(kernel_size=(2, 2))]
     for idx in tqdm(range(len(patch_label_file))):
         t_start = time.time()
         patch_name = patch_label_file.loc[idx, 'Patch Names']
@@ -242,8 +187,7 @@ if __name__ == "__main__":
         dense_feat = compute_densenet_features(patch_rescaled, patch_name.split(".")[0],
                                                save_path_latent,
                                                transform_densenet, densenet)
-        slide_index = slide_to_index(latent, codebook_semantic,
-                                     pool_layers=pool_layers)
+        slide_index = slide_to_index(latent, codebook_semantic)
         key = int(slide_index[0])
         tmp = {'patch_name': patch_name.split(".")[0],
                'dense_binarized': dense_feat,
@@ -265,5 +209,4 @@ if __name__ == "__main__":
         veb.insert(int(k))
     with open(os.path.join(save_path_indextree, "veb.pkl"), 'wb') as handle:
         pickle.dump(veb, handle)
-    with open(os.path.join(save_path_indexmeta, "meta.pkl"), 'wb') as handle:
-        pickle.dump(database, handle)
+    ColumnarMeta.from_dict(database).save(os.path.join(save_path_indexmeta, "columnar"))
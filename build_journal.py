@@ -0,0 +1,162 @@
+"""
+Append-only journal of the slides encoded by build_index.py. Every slide is written as one
+pickled record to the current shard file as soon as it is encoded, so an interrupted build
+resumes after the last completed slide. The columnar meta store is then assembled by
+streaming over the shards: only the int64 key, the coordinates and the column ids of each
+mosaic are held in memory while the texture codes are written straight into the store.
+Layout:
+    shard_00000.pkl, shard_00001.pkl, ...   pickled records, one per slide
+A record is a dictionary with
+    slide_name, diagnosis, site, slide_ext  (str)
+    keys    (N,)        int64 index key of each mosaic
+    codes   (N x 128)   uint8 packed texture code of each mosaic
+    x, y    (N,)        int32 coordinates of each mosaic
+    manifest            the manifest entry of the slide (see build_index.build_manifest_entry)
+"""
+import glob
+import os
+import pickle
+import shutil
+import numpy as np
+from meta_store import ColumnarMeta, SLIDE_COLUMNS, COORD_COLUMNS, PATIENT_COLUMN, encode_patients
+
+
+class BuildJournal(object):
+    """
+    Per-slide journal of a database build
+    Attributes:
+        journal_path (str): The directory of the shard files
+        shard_size (int): The number of slides written to a shard before starting a new one
+    """
+
+    def __init__(self, journal_path, shard_size=256):
+        self.journal_path = journal_path
+        self.shard_size = shard_size
+        os.makedirs(self.journal_path, exist_ok=True)
+        self.completed = {}
+        self.num_shards = 0
+        self.shard_records = 0
+        self._recover()
+
+    def _shards(self):
+        return sorted(glob.glob(os.path.join(self.journal_path, "shard_*.pkl")))
+
+    def _recover(self):
+        """
+        Read the completed slides. A record cut off by a crash is truncated away.
+        """
+        shards = self._shards()
+        for shard in shards:
+            records = 0
+            with open(shard, 'rb') as handle:
+                while True:
+                    offset = handle.tell()
+                    try:
+                        record = pickle.load(handle)
+                    except (EOFError, pickle.UnpicklingError, ValueError):
+                        break
+                    self.completed[record['slide_name']] = record['manifest']
+                    records += 1
+            if offset < os.path.getsize(shard):
+                print("Truncating the incomplete record at the end of {}".format(shard), flush=True)
+                with open(shard, 'r+b') as handle:
+                    handle.truncate(offset)
+            self.shard_records = records
+        self.num_shards = len(shards)
+
+    def append(self, record):
+        """
+        Write the record of an encoded slide and flush it to disk
+        """
+        if self.num_shards == 0 or self.shard_records >= self.shard_size:
+            self.num_shards += 1
+            self.shard_records = 0
+        shard = os.path.join(self.journal_path, "shard_{:05d}.pkl".format(self.num_shards - 1))
+        with open(shard, 'ab') as handle:
+            pickle.dump(record, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.shard_records += 1
+        self.completed[record['slide_name']] = record['manifest']
+
+    def records(self):
+        """
+        Iterate over the records of all shards in the order they were written
+        """
+        for shard in self._shards():
+            with open(shard, 'rb') as handle:
+                while True:
+                    try:
+                        yield pickle.load(handle)
+                    except EOFError:
+                        break
+
+    def assemble(self, store_path):
+        """
+        Write the columnar meta store of all journaled slides
+        Input:
+            store_path (str): The directory of the store
+        Output:
+            meta (ColumnarMeta): The store, memory mapped from store_path
+        """
+        # First pass: everything but the texture codes
+        row_keys = []
+        coords = {name: [] for name in COORD_COLUMNS}
+        columns = {name: [] for name in SLIDE_COLUMNS}
+        lookups = {name: {} for name in SLIDE_COLUMNS}
+        code_bytes = 0
+        for record in self.records():
+            num_mosaics = len(record['keys'])
+            row_keys.append(np.asarray(record['keys'], dtype=np.int64))
+            for name in COORD_COLUMNS:
+                coords[name].append(np.asarray(record[name], dtype=np.int32))
+            for name in SLIDE_COLUMNS:
+                value_id = lookups[name].setdefault(record[name], len(lookups[name]))
+                columns[name].append(np.full(num_mosaics, value_id, dtype=np.int32))
+            code_bytes = record['codes'].shape[1]
+        if len(row_keys) == 0:
+            raise ValueError("The journal in {} holds no slides".format(self.journal_path))
+
+        row_keys = np.concatenate(row_keys)
+        order = np.argsort(row_keys, kind='stable')
+        keys, counts = np.unique(row_keys[order], return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        coords = {name: np.concatenate(values)[order] for name, values in coords.items()}
+        columns = {name: np.concatenate(values)[order] for name, values in columns.items()}
+        vocab = {name: list(lookup.keys()) for name, lookup in lookups.items()}
+        columns[PATIENT_COLUMN], vocab[PATIENT_COLUMN] = encode_patients(columns['slide_name'],
+                                                                         vocab['slide_name'])
+
+        os.makedirs(store_path, exist_ok=True)
+        arrays = {'keys': keys.astype(np.int64), 'offsets': offsets}
+        arrays.update(coords)
+        arrays.update(columns)
+        for name, array in arrays.items():
+            np.save(os.path.join(store_path, name + '.npy'), array)
+
+        # Second pass: scatter the codes of each slide to the sorted rows
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order), dtype=np.int64)
+        codes = np.lib.format.open_memmap(os.path.join(store_path, 'codes.npy'), mode='w+',
+                                          dtype=np.uint8, shape=(len(order), code_bytes))
+        start = 0
+        for record in self.records():
+            stop = start + len(record['keys'])
+            codes[rank[start:stop]] = record['codes']
+            start = stop
+        codes.flush()
+        del codes
+
+        codes = np.load(os.path.join(store_path, 'codes.npy'), mmap_mode='r')
+        meta = ColumnarMeta(arrays['keys'], offsets, codes, coords, columns, vocab)
+        meta.save_header(store_path)
+        return ColumnarMeta.open(store_path)
+
+    def clear(self):
+        """
+        Remove the journal once its slides are in the database
+        """
+        shutil.rmtree(self.journal_path)
+        self.completed = {}
+        self.num_shards = 0
+        self.shard_records = 0
@@ -2,6 +2,7 @@
 from SISH_Fork.wsi_core.WholeSlideImage import WholeSlideImage
 from SISH_Fork.wsi_core.wsi_utils import StitchCoords
 # other imports
+import multiprocessing as mp
 import os
 import numpy as np
 import time
@@ -70,6 +71,128 @@ def initialize_df(slides, seg_params, filter_params, vis_params, patch_params):
     return df
 
 
+def process_slide(task):
+    """
+    Segment, patch and stitch one slide, called in the worker processes of seg_and_patch
+    Input:
+        task (tuple): The index of the slide in the process list, the slide file name, its row
+        of the process list and the settings of seg_and_patch
+    Output:
+        idx (int): The index of the slide in the process list
+        updates (dict): The values of the process list row that changed
+        times (tuple): The segmentation, patching and stitching time in seconds (-1 if not run)
+    """
+    idx, slide, row, settings = task
+    print('processing {}'.format(slide), flush=True)
+    slide_id, _ = os.path.splitext(slide)
+    legacy_support = settings['legacy_support']
+    updates = {}
+
+    # Inialize WSI
+    full_path = os.path.join(settings['source'], slide)
+    WSI_object = WholeSlideImage(full_path, hdf5_file=None)
+
+    if settings['use_default_params']:
+        current_vis_params = settings['vis_params'].copy()
+        current_filter_params = settings['filter_params'].copy()
+        current_seg_params = settings['seg_params'].copy()
+        current_patch_params = settings['patch_params'].copy()
+
+    else:
+        current_vis_params = {}
+        current_filter_params = {}
+        current_seg_params = {}
+        current_patch_params = {}
+
+        for key in settings['vis_params'].keys():
+            if legacy_support and key == 'vis_level':
+                updates[key] = row[key] = -1
+            current_vis_params.update({key: row[key]})
+
+        for key in settings['filter_params'].keys():
+            if legacy_support and key == 'a_t':
+                old_area = row['a']
+                seg_level = row['seg_level']
+                scale = WSI_object.level_downsamples[seg_level]
+                adjusted_area = int(old_area * (scale[0] * scale[1]) / (512 * 512))
+                current_filter_params.update({key: adjusted_area})
+                updates[key] = row[key] = adjusted_area
+            current_filter_params.update({key: row[key]})
+
+        for key in settings['seg_params'].keys():
+            if legacy_support and key == 'seg_level':
+                updates[key] = row[key] = -1
+            current_seg_params.update({key: row[key]})
+
+        for key in settings['patch_params'].keys():
+            current_patch_params.update({key: row[key]})
+
+    if current_vis_params['vis_level'] < 0:
+        if len(WSI_object.level_dim) == 1:
+            current_vis_params['vis_level'] = 0
+
+        else:
+            wsi = WSI_object.getOpenSlide()
+            best_level = wsi.get_best_level_for_downsample(64)
+            current_vis_params['vis_level'] = best_level
+
+    if current_seg_params['seg_level'] < 0:
+        if len(WSI_object.level_dim) == 1:
+            current_seg_params['seg_level'] = 0
+
+        else:
+            wsi = WSI_object.getOpenSlide()
+            best_level = wsi.get_best_level_for_downsample(64)
+            current_seg_params['seg_level'] = best_level
+
+    w, h = WSI_object.level_dim[current_seg_params['seg_level']] 
+    if w * h > 5e8:  # 1e8:
+        print('level_dim {} x {} is likely too large for successful segmentation, aborting'.format(w, h))
+        updates['status'] = 'failed_seg'
+        return idx, updates, (-1, -1, -1)
+
+    updates['vis_level'] = current_vis_params['vis_level']
+    updates['seg_level'] = current_seg_params['seg_level']
+
+    seg_time_elapsed = -1
+    if settings['seg']:
+        WSI_object, seg_time_elapsed = segment(WSI_object, current_seg_params, current_filter_params) 
+
+    if settings['save_mask']:
+        mask = WSI_object.visWSI(**current_vis_params)
+        mask_path = os.path.join(settings['mask_save_dir'], slide_id+'.jpg')
+        mask.save(mask_path)
+
+    patch_save_dir = settings['patch_save_dir']
+    patch_time_elapsed = -1  # Default time
+    if settings['patch']:
+        current_patch_params.update({'patch_level': settings['patch_level'], 'patch_size': settings['patch_size'],
+                                     'step_size': settings['step_size'], 'save_path': patch_save_dir})
+        file_path, patch_time_elapsed = patching(WSI_object = WSI_object,  **current_patch_params,)
+
+    stitch_time_elapsed = -1
+    if settings['stitch']:
+        if os.path.exists(os.path.join(patch_save_dir, slide_id + ".h5")):
+            file_path = os.path.join(patch_save_dir, slide_id+'.h5')
+            heatmap, stitch_time_elapsed = stitching(file_path, WSI_object, downscale=64)
+            stitch_path = os.path.join(settings['stitch_save_dir'], slide_id+'.jpg')
+            heatmap.save(stitch_path)
+        else:
+            print("No contour detect")
+            print("Ignore ", slide_id)
+            with open(os.path.join(settings['save_dir'], "ignore.txt"), 'a') as fw:
+                fw.write(slide_id + "\n")
+
+    if settings['seg']:
+        print("segmentation of {} took {} seconds".format(slide_id, seg_time_elapsed), flush=True)
+    if settings['patch']:
+        print("patching of {} took {} seconds".format(slide_id, patch_time_elapsed), flush=True)
+    if settings['stitch']:
+        print("stitching of {} took {} seconds".format(slide_id, stitch_time_elapsed), flush=True)
+    updates['status'] = 'processed'
+    return idx, updates, (seg_time_elapsed, patch_time_elapsed, stitch_time_elapsed)
+
+
 def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_dir,
                   patch_size=256, step_size=256,
                   seg_params={'seg_level': -1, 'sthresh': 8, 'mthresh': 7, 'close': 4, 'use_otsu': False},
@@ -80,7 +203,7 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                   use_default_params=False,
                   seg=False, save_mask=True,
                   stitch=False,
-                  patch=False, auto_skip=True, process_list=None):
+                  patch=False, auto_skip=True, process_list=None, num_workers=1):
 
     slides = sorted(os.listdir(source))
     slides = [slide for slide in slides if os.path.isfile(os.path.join(source, slide))]
@@ -105,17 +228,17 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
         'line_thickness': np.full((len(df)), int(vis_params['line_thickness']), dtype=np.uint32),
         'contour_fn': np.full((len(df)), patch_params['contour_fn'])})
 
-    seg_times = 0.
-    patch_times = 0.
-    stitch_times = 0.
+    settings = {'source': source, 'save_dir': save_dir, 'patch_save_dir': patch_save_dir,
+                'mask_save_dir': mask_save_dir, 'stitch_save_dir': stitch_save_dir,
+                'patch_size': patch_size, 'step_size': step_size, 'seg_params': seg_params,
+                'filter_params': filter_params, 'vis_params': vis_params, 'patch_params': patch_params,
+                'patch_level': patch_level, 'use_default_params': use_default_params, 'seg': seg,
+                'save_mask': save_mask, 'stitch': stitch, 'patch': patch, 'legacy_support': legacy_support}
 
+    tasks = []
     for i in range(total):
-        df.to_csv(os.path.join(save_dir, 'process_list_autogen.csv'), index=False)
         idx = process_stack.index[i]
         slide = process_stack.loc[idx, 'slide_id']
-        print("\n\nprogress: {:.2f}, {}/{}".format(i/total, i, total))
-        print('processing {}'.format(slide))
-
         df.loc[idx, 'process'] = 0
         slide_id, _ = os.path.splitext(slide)
 
@@ -123,112 +246,40 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
             print('{} already exist in destination location, skipped'.format(slide_id))
             df.loc[idx, 'status'] = 'already_exist'
             continue
+        tasks.append((idx, slide, df.loc[idx].to_dict(), settings))
+    df.to_csv(os.path.join(save_dir, 'process_list_autogen.csv'), index=False)
 
-        # Inialize WSI
-        full_path = os.path.join(source, slide)
-        WSI_object = WholeSlideImage(full_path, hdf5_file=None)
-
-        if use_default_params:
-            current_vis_params = vis_params.copy()
-            current_filter_params = filter_params.copy()
-            current_seg_params = seg_params.copy()
-            current_patch_params = patch_params.copy()
-
-        else:
-            current_vis_params = {}
-            current_filter_params = {}
-            current_seg_params = {}
-            current_patch_params = {}
-
-            for key in vis_params.keys():
-                if legacy_support and key == 'vis_level':
-                    df.loc[idx, key] = -1
-                current_vis_params.update({key: df.loc[idx, key]})
-
-            for key in filter_params.keys():
-                if legacy_support and key == 'a_t':
-                    old_area = df.loc[idx, 'a']
-                    seg_level = df.loc[idx, 'seg_level']
-                    scale = WSI_object.level_downsamples[seg_level]
-                    adjusted_area = int(old_area * (scale[0] * scale[1]) / (512 * 512))
-                    current_filter_params.update({key: adjusted_area})
-                    df.loc[idx, key] = adjusted_area
-                current_filter_params.update({key: df.loc[idx, key]})
-
-            for key in seg_params.keys():
-                if legacy_support and key == 'seg_level':
-                    df.loc[idx, key] = -1
-                current_seg_params.update({key: df.loc[idx, key]})
-
-            for key in patch_params.keys():
-                current_patch_params.update({key: df.loc[idx, key]})
-
-        if current_vis_params['vis_level'] < 0:
-            if len(WSI_object.level_dim) == 1:
-                current_vis_params['vis_level'] = 0
-
-            else:
-                wsi = WSI_object.getOpenSlide()
-                best_level = wsi.get_best_level_for_downsample(64)
-                current_vis_params['vis_level'] = best_level
-
-        if current_seg_params['seg_level'] < 0:
-            if len(WSI_object.level_dim) == 1:
-                current_seg_params['seg_level'] = 0
-
-            else:
-                wsi = WSI_object.getOpenSlide()
-                best_level = wsi.get_best_level_for_downsample(64)
-                current_seg_params['seg_level'] = best_level
-
-        w, h = WSI_object.level_dim[current_seg_params['seg_level']] 
-        if w * h > 5e8:  # 1e8:
-            print('level_dim {} x {} is likely too large for successful segmentation, aborting'.format(w, h))
-            df.loc[idx, 'status'] = 'failed_seg'
-            continue
+    seg_times = 0.
+    patch_times = 0.
+    stitch_times = 0.
 
-        df.loc[idx, 'vis_level'] = current_vis_params['vis_level']
-        df.loc[idx, 'seg_level'] = current_seg_params['seg_level']
-
-        seg_time_elapsed = -1
-        if seg:
-            WSI_object, seg_time_elapsed = segment(WSI_object, current_seg_params, current_filter_params) 
-
-        if save_mask:
-            mask = WSI_object.visWSI(**current_vis_params)
-            mask_path = os.path.join(mask_save_dir, slide_id+'.jpg')
-            mask.save(mask_path)
-
-        patch_time_elapsed = -1  # Default time
-        if patch:
-            current_patch_params.update({'patch_level': patch_level, 'patch_size': patch_size, 'step_size': step_size, 
-                                            'save_path': patch_save_dir})
-            file_path, patch_time_elapsed = patching(WSI_object = WSI_object,  **current_patch_params,)
-
-        stitch_time_elapsed = -1
-        if stitch:
-            if os.path.exists(os.path.join(patch_save_dir, slide_id + ".h5")):
-                file_path = os.path.join(patch_save_dir, slide_id+'.h5')
-                heatmap, stitch_time_elapsed = stitching(file_path, WSI_object, downscale=64)
-                stitch_path = os.path.join(stitch_save_dir, slide_id+'.jpg')
-                heatmap.save(stitch_path)
-            else:
-                print("No contour detect")
-                print("Ignore ", slide_id)
-                with open(os.path.join(save_dir, "ignore.txt"), 'a') as fw:
-                    fw.write(slide_id + "\n")
-
-        if seg:
-            print("segmentation took {} seconds".format(seg_time_elapsed))
-        if patch:
-            print("patching took {} seconds".format(patch_time_elapsed))
-        if stitch:
-            print("stitching took {} seconds".format(stitch_time_elapsed))
-        df.loc[idx, 'status'] = 'processed'
-
-        seg_times += seg_time_elapsed
-        patch_times += patch_time_elapsed
-        stitch_times += stitch_time_elapsed
+    # One long-lived pool processes whole slides, the process list is updated as the slides finish
+    pool = None
+    if num_workers > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(num_workers, len(tasks)))
+        results = pool.imap_unordered(process_slide, tasks)
+    else:
+        results = map(process_slide, tasks)
+
+    try:
+        for i, (idx, updates, (seg_time_elapsed, patch_time_elapsed, stitch_time_elapsed)) in enumerate(results):
+            print("progress: {:.2f}, {}/{}".format((i + 1) / len(tasks), i + 1, len(tasks)), flush=True)
+            for key, value in updates.items():
+                df.loc[idx, key] = value
+            df.to_csv(os.path.join(save_dir, 'process_list_autogen.csv'), index=False)
+            if updates['status'] != 'processed':
+                continue
+
+            seg_times += seg_time_elapsed
+            patch_times += patch_time_elapsed
+            stitch_times += stitch_time_elapsed
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     if total > 0:
         seg_times /= total
@@ -246,7 +297,8 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
 
 
 def process_images(source, save_dir, step_size=256, patch_size=256, patch=True, seg=True,
-                   stitch=True, no_auto_skip=True, preset=None, patch_level=0, process_list=None):
+                   stitch=True, no_auto_skip=True, preset=None, patch_level=0, process_list=None,
+                   num_workers=4):
     patch_save_dir = os.path.join(save_dir, 'patches')
     mask_save_dir = os.path.join(save_dir, 'masks')
     stitch_save_dir = os.path.join(save_dir, 'stitches')
@@ -297,7 +349,8 @@ def process_images(source, save_dir, step_size=256, patch_size=256, patch=True,
                                            patch_size=patch_size, step_size=step_size,
                                            seg=seg, use_default_params=False, save_mask=True,
                                            stitch=stitch, patch_level=patch_level, patch=patch,
-                                           process_list=process_list, auto_skip=no_auto_skip)
+                                           process_list=process_list, auto_skip=no_auto_skip,
+                                           num_workers=num_workers)
 
 
 if __name__ == '__main__':
@@ -313,9 +366,10 @@ if __name__ == '__main__':
     parser.add_argument('--preset', type=str, help='preset parameters file (.csv)')
     parser.add_argument('--patch_level', type=int, default=0, help='downsample level for patching')
     parser.add_argument('--process_list', type=str, help='CSV list of images to process with parameters')
+    parser.add_argument('--num_workers', type=int, default=4, help='number of slides processed in parallel')
 
     args = parser.parse_args()
 
     process_images(args.source, args.save_dir, args.step_size, args.patch_size, args.patch,
                    args.seg, args.stitch, args.no_auto_skip, args.preset, args.patch_level,
-                   args.process_list)
+                   args.process_list, args.num_workers)
@@ -1,7 +1,20 @@
 import pickle
+import time
 import torch
-import copy
 import numpy as np
+from sorted_index import SortedIndex
+from texture_codes import pack_codes, hamming_distance
+from meta_store import load_columnar_meta, PATIENT_COLUMN
+from query_cache import QueryCache
+from snapshot import is_snapshot, load_snapshot
+from mosaic_index import semantic_lookup, latents_to_indices
+
+# Distance given to excluded mosaics, larger than any hamming distance
+EXCLUDED_DIST = np.iinfo(np.int64).max
+
+# Keys cached past the end of each window, so the walks of a cached search can pass over
+# up to this many keys of the held-out patient before falling back to a full search
+CACHE_MARGIN = 32
 
 
 class HistoDatabase(object):
@@ -9,57 +22,118 @@ class HistoDatabase(object):
     The FISH database that perform O(1) search
     Attributes:
         database_index_path (str): The path to the database index stored in veb tree
-        index_meta_path (str): The path to the dictionary that stores the meta data for each index
+        index_meta_path (str): The path to the meta data for each index, either meta.pkl
+        or a columnar meta store directory
         coodebook_semantic (str): The path to the semantic codebook from vq-vae encoder
         is_path (bool): Whether to use patch only mode (for patch only database)
+        index_engine (str): The engine that answers predecessor/successor queries
+        load_times (dict): Seconds spent loading each component of the database
     """
 
     def __init__(self, database_index_path, index_meta_path,
-                 codebook_semantic, is_patch=False):
+                 codebook_semantic, is_patch=False, index_engine='sorted',
+                 query_cache=None):
         """
         The intializer for HistoDatabase
         Input:
             database_index_path (str): The path to the database index stored in veb tree
-            index_meta_path (str): The path to the dictionary that stores the meta data for each index
-            coodebook_semantic (str): The path to the semantic codebook from vq-vae encoder
+            index_meta_path (str): The path to the meta data for each index, either meta.pkl,
+            a columnar meta store directory (see meta_store.py) or a database snapshot
+            (see snapshot.py) that also holds the index and the semantic codebook
+            coodebook_semantic (str): The path to the semantic codebook from vq-vae encoder,
+            not used when loading a snapshot
             is_path (bool): Whether to use patch only mode (for patch only database)
+            index_engine (str): 'sorted' searches the sorted keys of the index meta,
+            'veb' loads the pickled VEB tree from database_index_path
+            query_cache (QueryCache): Optional cache of the keys accepted around each mosaic,
+            only used with the 'sorted' index engine
         Output: None
         """
         self.database_index_path = database_index_path
         self.index_meta_path = index_meta_path
+        self.codebook_semantic_path = codebook_semantic
         self.is_patch = is_patch
+        self.index_engine = index_engine
+        self.query_cache = query_cache
 
-        print("Loading database index...", flush=True)
-        with open(self.database_index_path, 'rb') as handle:
-            self.vebtree = pickle.load(handle)
+        self.load_times = {}
+        lookup = None
+        if is_snapshot(self.index_meta_path):
+            print("Loading database snapshot...", flush=True)
+            self.meta, lookup, load_times = load_snapshot(self.index_meta_path)
+            self.load_times.update(load_times)
+        else:
+            print("Loading index meta...", flush=True)
+            t_start = time.time()
+            self.meta = load_columnar_meta(self.index_meta_path)
+            self.load_times['index_meta'] = time.time() - t_start
 
-        print("Loading index meta...", flush=True)
-        with open(self.index_meta_path, 'rb') as handle:
-            self.meta = pickle.load(handle)
+        t_start = time.time()
+        if self.index_engine == 'sorted':
+            # The keys of the index meta are exactly the keys inserted into the VEB tree
+            self.index_tree = SortedIndex.from_sorted(self.meta.keys)
+        elif self.index_engine == 'veb':
+            print("Loading database index...", flush=True)
+            with open(self.database_index_path, 'rb') as handle:
+                self.index_tree = pickle.load(handle)
+        else:
+            raise NotImplementedError("Unknown index engine: {}".format(index_engine))
+        self.load_times['index'] = time.time() - t_start
+        self.excluded_patient = None
+        self.excluded_patient_id = None
+        self.empty_positions = np.zeros(0, dtype=np.int64)
+        if not self.is_patch:
+            self.patient_codes = {patient: code for code, patient in
+                                  enumerate(self.meta.vocab[PATIENT_COLUMN])}
 
-        print("Loading semantic codebook", flush=True)
-        self.codebook_semantic = torch.load(codebook_semantic)
-        self.pool_layers = [torch.nn.AvgPool2d(kernel_size=(2, 2)),
-                            torch.nn.AvgPool2d(kernel_size=(2, 2)),
-                            torch.nn.AvgPool2d(kernel_size=(2, 2))]
+        if lookup is not None:
+            self.codebook_semantic = lookup
+        else:
+            print("Loading semantic codebook", flush=True)
+            t_start = time.time()
+            self.codebook_semantic = torch.load(codebook_semantic)
+            self.load_times['codebook'] = time.time() - t_start
+        self.semantic_lookup = semantic_lookup(self.codebook_semantic)
+        print("Database loaded in {:.2f}s ({})".format(
+            sum(self.load_times.values()),
+            ", ".join("{} {:.2f}s".format(name, t) for name, t in self.load_times.items())), flush=True)
+
+    def init_args(self):
+        """
+        The arguments that re-open this database, e.g., in a worker process that
+        cannot inherit it through fork
+        """
+        return {'database_index_path': self.database_index_path,
+                'index_meta_path': self.index_meta_path,
+                'codebook_semantic': self.codebook_semantic_path,
+                'is_patch': self.is_patch,
+                'index_engine': self.index_engine,
+                'query_cache': self.query_cache}
+
+    def cache_stats(self):
+        """
+        The statistics of the query cache (see QueryCache.stats), None without a cache
+        """
+        if self.query_cache is None:
+            return None
+        return self.query_cache.stats()
 
     def leave_one_patient(self, patient_id):
         """
         The function used to remove the patient id used in leave-one-patient-out evaluation.
+        The mosaics of the patient are skipped lazily during the search, so switching the
+        held-out patient costs O(1) and the index meta is never copied.
         Input:
-            patient_id (str): Unique patient id.
+            patient_id (str): Unique patient id, None to search the whole database again
         """
-        if self.is_patch:
-            self.meta_clean = self.meta
+        self.excluded_patient_id = patient_id
+        if self.is_patch or patient_id is None:
+            self.excluded_patient = None
         else:
-            meta_tmp = {}
-            for key, val in self.meta.items():
-                val_tmp = []
-                for idx in range(len(val)):
-                    if val[idx]['slide_name'].split("-")[2] != patient_id:
-                        val_tmp.append(val[idx])
-                meta_tmp[key] = val_tmp
-            self.meta_clean = meta_tmp
+            # A patient that is not in the database excludes nothing
+            self.excluded_patient = self.patient_codes.get(patient_id, -1)
+        # Keys whose mosaics all belong to the excluded patient, found while searching
+        self.empty_positions = np.zeros(0, dtype=np.int64)
 
     def query(self, patch, dense_feat,
               pre_step=375, succ_step=375,
@@ -76,21 +150,94 @@ class HistoDatabase(object):
         """
 
         index = self.preprocessing(patch)
+        return self.query_by_index(index, dense_feat, pre_step=pre_step, succ_step=succ_step,
+                                   C=C, T=T, thrsh=thrsh)
 
-        indices_nn = self.search(index, dense_feat,
+    def query_by_index(self, index, dense_feat,
+                       pre_step=375, succ_step=375,
+                       C=50, T=10, thrsh=128):
+        """
+        Query the database with a mosaic index that is already computed
+        (e.g., by slides_to_indices for all mosaics of a slide), see query.
+        index (int): Integer index of the mosaic (m_{i})
+        """
+        indices_nn = self.search(int(index), dense_feat,
                                  pre_step=pre_step, succ_step=succ_step,
                                  C=C, T=T, thrsh=thrsh)
 
         results = self.postprocessing(indices_nn)
         return results
 
+    def query_batch(self, latents, dense_feats,
+                    pre_step=375, succ_step=375,
+                    C=50, T=10, thrsh=128):
+        """
+        Query the database with all mosaics of a slide at once. The mosaic indices,
+        the seeds and the candidate keys of all mosaics are resolved together.
+        Input:
+            latents (np.array): N x 64 x 64 latent codes of the mosaics
+            dense_feats (list or np.array): Texture feature of each mosaic, '0'/'1' strings
+            or packed codes of shape N x 128
+            (see query for the search parameters)
+        Output:
+            results (list): The sorted results of each mosaic, as query returns them
+        """
+        indices = self.slides_to_indices(latents)
+        return self.query_indices(indices, dense_feats, pre_step=pre_step, succ_step=succ_step,
+                                  C=C, T=T, thrsh=thrsh)
+
+    def query_indices(self, indices, dense_feats,
+                      pre_step=375, succ_step=375,
+                      C=50, T=10, thrsh=128):
+        """
+        Query the database with many mosaic indices that are already computed, see query_batch
+        """
+        indices_nn = self.search_batch(indices, dense_feats,
+                                       pre_step=pre_step, succ_step=succ_step,
+                                       C=C, T=T, thrsh=thrsh)
+        return [self.postprocessing(res) for res in indices_nn]
+
+    def window_candidates(self, query_indices, dense_feats,
+                          pre_step=375, succ_step=375,
+                          C=50, T=10, thrsh=128):
+        """
+        The keys in the windows of many mosaics, so that the windows of several databases
+        (i.e., the shards of ShardedHistoDatabase) can be merged before the walks.
+        Only supported by the 'sorted' index engine.
+        Input:
+            query_indices (np.array): The integer index of each mosaic
+            dense_feats (list or np.array): Texture feature of each mosaic
+            (see query for the search parameters)
+        Output:
+            candidates (list): (keys, min_dist, results) of each mosaic: the sorted distinct
+            keys in its windows, the minimum hamming distance of each key and the result
+            tuple (see search) of each key within thrsh, in key order
+        """
+        if not hasattr(self.index_tree, 'range_scan'):
+            raise NotImplementedError("Window candidates need the sorted index engine")
+        query_indices = np.asarray(query_indices, dtype=np.int64)
+        dense_feats = pack_codes(dense_feats)
+        if len(query_indices) == 0:
+            return []
+        windows = self._scan_windows(self._seed_index(query_indices, C, T), pre_step, succ_step)
+        candidates = []
+        for query_index, mosaic_windows, dense_feat in zip(query_indices, windows, dense_feats):
+            positions = np.unique(mosaic_windows[mosaic_windows >= 0])
+            min_dist, min_row = self._nearest_rows(positions, dense_feat)
+            keys = np.asarray(self.meta.keys[positions])
+            accepted = min_dist <= thrsh
+            candidates.append((keys, min_dist, self._results(int(query_index), keys[accepted],
+                                                             min_dist[accepted], min_row[accepted])))
+        return candidates
+
     def search(self, query_index, dense_feat, pre_step, succ_step,
                C, T, thrsh):
         """
         Implementation of backward and forward search in the paper
         Input:
             query_index (int): The integer index of the mosaic (m_{i})
-            dense_feat (str): Texture feature of the mosaic (h_{i})
+            dense_feat (str or np.array): Texture feature of the mosaic (h_{i}), either
+            a '0'/'1' string or packed by texture_codes.pack_codes
             pre_step (int): The number of step in the backward algorithm
             succ_step (int): The number of step in the forward algorithm
             C (int): The width of interval to expand the given search index
@@ -103,100 +250,351 @@ class HistoDatabase(object):
              the diagnosis of the slide associated with the result mosaic
              the (x, y) coordinate in the slide where the result mosaic is located)
         """
+        return self.search_batch([query_index], [dense_feat], pre_step, succ_step,
+                                 C, T, thrsh)[0]
+
+    def search_batch(self, query_indices, dense_feats, pre_step, succ_step,
+                     C, T, thrsh):
+        """
+        The search of many mosaics at once
+        Input:
+            query_indices (np.array): The integer index of each mosaic
+            dense_feats (list or np.array): Texture feature of each mosaic
+            (see search for the other parameters)
+        Output:
+            res (list): The list of result tuples of each mosaic, as search returns them
+        """
+        query_indices = np.asarray(query_indices, dtype=np.int64)
+        dense_feats = pack_codes(dense_feats)
+        if self.query_cache is not None and hasattr(self.index_tree, 'range_scan'):
+            return self._search_cached(query_indices, dense_feats, pre_step, succ_step,
+                                       C, T, thrsh)
+        return self._search_uncached(query_indices, dense_feats, pre_step, succ_step,
+                                     C, T, thrsh)
+
+    def _search_cached(self, query_indices, dense_feats, pre_step, succ_step,
+                       C, T, thrsh):
+        """
+        The search through the query cache. The cache holds the keys accepted in the windows
+        of each mosaic searched without leave-one-patient-out, widened by CACHE_MARGIN keys,
+        so the same entries serve every held-out patient. The walks are replayed with the
+        exclusion applied: the keys of the held-out patient are passed over without counting
+        as a step and the accepted keys that hold its mosaics are compared again. A mosaic
+        whose walks pass over more than CACHE_MARGIN keys is searched without the cache.
+        The results are the same as those of an uncached search.
+        """
+        if len(query_indices) == 0:
+            return []
+        version = self.meta.checksum()
+        keys = [QueryCache.make_key('accepted', CACHE_MARGIN, int(query_index), dense_feat.tobytes(),
+                                    pre_step, succ_step, C, T, thrsh, version)
+                for query_index, dense_feat in zip(query_indices, dense_feats)]
+        accepted = [self.query_cache.get(key) for key in keys]
+        seed_index = self._seed_index(query_indices, C, T)
+        missing = [i for i, entry in enumerate(accepted) if entry is None]
+        if len(missing) > 0:
+            entries = self._accepted_keys(seed_index[missing], dense_feats[missing],
+                                          pre_step, succ_step, thrsh)
+            for i, entry in zip(missing, entries):
+                self.query_cache.put(keys[i], entry)
+                accepted[i] = entry
+
+        windows = self._scan_windows(seed_index, pre_step, succ_step)
+        covered = self._cached_windows(seed_index, windows, pre_step, succ_step)
+        return [self._search_windows(int(query_index), mosaic_windows, dense_feat, pre_step, thrsh,
+                                     cache_entry=entry if is_covered else None)
+                for query_index, mosaic_windows, dense_feat, entry, is_covered
+                in zip(query_indices, windows, dense_feats, accepted, covered)]
+
+    def _accepted_keys(self, seed_index, dense_feats, pre_step, succ_step, thrsh):
+        """
+        The keys accepted in the windows of each mosaic without leave-one-patient-out,
+        with CACHE_MARGIN more keys in each window
+        Output:
+            entries (list): (positions, min_dist, min_row) of the accepted keys of each mosaic,
+            sorted by position
+        """
+        num_seeds = seed_index.shape[1]
+        windows = self.index_tree.range_scan(seed_index.ravel(), pre_step + CACHE_MARGIN,
+                                             succ_step + CACHE_MARGIN)
+        windows = windows.reshape(len(seed_index), num_seeds, windows.shape[1])
+        excluded_patient = self.excluded_patient
+        self.excluded_patient = None
+        entries = []
+        try:
+            for mosaic_windows, dense_feat in zip(windows, dense_feats):
+                candidates = np.unique(mosaic_windows[mosaic_windows >= 0])
+                min_dist, min_row = self._nearest_rows(candidates, dense_feat)
+                keep = min_dist <= thrsh
+                entries.append((candidates[keep], min_dist[keep], min_row[keep]))
+        finally:
+            self.excluded_patient = excluded_patient
+        return entries
+
+    def _cached_windows(self, seed_index, windows, pre_step, succ_step):
+        """
+        Whether the windows of each mosaic lie within the windows of its cache entry
+        """
+        seeds = seed_index.ravel()
+        pre_end = np.searchsorted(self.index_tree.keys, seeds, side='left')
+        succ_start = np.searchsorted(self.index_tree.keys, seeds, side='right')
+        windows = windows.reshape(len(seeds), -1)
+        pre, succ = windows[:, :pre_step], windows[:, pre_step:]
+        covered = np.all((pre < 0) | (pre >= (pre_end - pre_step - CACHE_MARGIN)[:, None]), axis=1)
+        covered &= np.all(succ < (succ_start + succ_step + CACHE_MARGIN)[:, None], axis=1)
+        return covered.reshape(seed_index.shape).all(axis=1)
+
+    def _cached_rows(self, candidates, cache_entry, dense_feat):
+        """
+        The minimum hamming distance and closest row of each candidate key from a cache entry.
+        Keys that were not accepted without the exclusion are not accepted with it either.
+        """
+        positions, dists, rows = cache_entry
+        min_dist = np.full(len(candidates), EXCLUDED_DIST, dtype=np.int64)
+        min_row = np.full(len(candidates), -1, dtype=np.int64)
+        if len(positions) == 0:
+            return min_dist, min_row
+        slot = np.minimum(np.searchsorted(positions, candidates), len(positions) - 1)
+        hit = positions[slot] == candidates
+        if self.excluded_patient is None:
+            min_dist[hit] = dists[slot[hit]]
+            min_row[hit] = rows[slot[hit]]
+        else:
+            # The closest mosaic of an accepted key may belong to the held-out patient
+            min_dist[hit], min_row[hit] = self._nearest_rows(candidates[hit], dense_feat)
+        return min_dist, min_row
+
+    def _seed_index(self, query_indices, C, T):
+        """
+        T seeds spaced C * 1e11 apart on each side of each query index
+        """
+        steps = np.arange(T) * C * 1e11
+        base = query_indices.astype(float)[:, None]
+        return np.concatenate([base - steps, base + steps], axis=1).astype(np.int64)
+
+    def _search_uncached(self, query_indices, dense_feats, pre_step, succ_step,
+                         C, T, thrsh):
+        """
+        The search of many mosaics without the query cache, see search_batch
+        """
+        seed_index = self._seed_index(query_indices, C, T)
+        if hasattr(self.index_tree, 'range_scan'):
+            return self._search_range_scan(query_indices, seed_index, dense_feats,
+                                           pre_step, succ_step, thrsh)
+        return [self._search_walk(int(query_index), seeds.tolist(), dense_feat,
+                                  pre_step, succ_step, thrsh)
+                for query_index, seeds, dense_feat in zip(query_indices, seed_index, dense_feats)]
+
+    def _search_range_scan(self, query_indices, seed_index, dense_feats,
+                           pre_step, succ_step, thrsh):
+        """
+        Resolve the windows of the seeds of all mosaics with one range scan of the index,
+        then search each mosaic within its windows.
+        """
+        if len(query_indices) == 0:
+            return []
+        windows = self._scan_windows(seed_index, pre_step, succ_step)
+        return [self._search_windows(int(query_index), mosaic_windows, dense_feat, pre_step, thrsh)
+                for query_index, mosaic_windows, dense_feat in zip(query_indices, windows, dense_feats)]
+
+    def _scan_windows(self, seed_index, pre_step, succ_step):
+        """
+        The windows of the seeds of all mosaics, passing over the keys whose mosaics all
+        belong to the held-out patient
+        Output:
+            windows (np.array): N x 2T x (pre_step + succ_step) positions, see SortedIndex.range_scan
+        """
+        num_seeds = seed_index.shape[1]
+        while True:
+            windows = self.index_tree.range_scan(seed_index.ravel(), pre_step, succ_step,
+                                                 skip=self.empty_positions)
+            # Keys left without mosaics are not counted as a step, widen the windows past them
+            candidates = np.unique(windows[windows >= 0])
+            empty = candidates[self._empty_mask(candidates)]
+            if len(empty) == 0:
+                break
+            self.empty_positions = np.union1d(self.empty_positions, empty)
+        return windows.reshape(len(seed_index), num_seeds, windows.shape[1])
+
+    def _search_windows(self, query_index, windows, dense_feat, pre_step, thrsh, cache_entry=None):
+        """
+        Evaluate each distinct key in the windows of a mosaic once. The walks are then
+        replayed over the windows so a walk still stops at the first key accepted by an
+        earlier walk, as in _search_walk.
+        Input:
+            query_index (int): The integer index of the mosaic
+            windows (np.array): The range scan of each seed of the mosaic
+            dense_feat (np.array): Packed texture feature of the mosaic
+            pre_step (int): The number of backward positions in each window
+            thrsh (int): The maximum hamming distance of a valid result
+            cache_entry (tuple): The accepted keys of the mosaic (see _accepted_keys), None
+            to compare the query with every key in the windows
+        Output:
+            res (list): The result tuples of the mosaic
+        """
+        valid = windows >= 0
+        candidates, inverse = np.unique(windows[valid], return_inverse=True)
+        if cache_entry is None:
+            min_dist, min_row = self._nearest_rows(candidates, dense_feat)
+        else:
+            min_dist, min_row = self._cached_rows(candidates, cache_entry, dense_feat)
+        accepted = min_dist <= thrsh
+        slots = np.full(windows.shape, -1, dtype=np.int64)
+        slots[valid] = inverse
+
+        found = []
+        visited = np.zeros(len(candidates), dtype=bool)
+        for row in slots:
+            for walk in (row[:pre_step], row[pre_step:]):
+                walk = walk[walk >= 0]
+                hits = np.flatnonzero(visited[walk])
+                if len(hits) > 0:
+                    walk = walk[:hits[0]]
+                walk = walk[accepted[walk]]
+                visited[walk] = True
+                found.append(walk)
+        found = np.concatenate(found) if len(found) > 0 else np.zeros(0, dtype=np.int64)
+        return self._results(query_index, np.asarray(self.meta.keys[candidates[found]]),
+                             min_dist[found], min_row[found])
+
+    def _search_walk(self, query_index, seed_index, dense_feat,
+                     pre_step, succ_step, thrsh):
+        """
+        Walk the predecessors and successors of each seed one key at a time.
+        Used for index engines without range scans (i.e., the VEB tree).
+        """
         res = []
-        pre = None
-        succ = None
-        seed_index = []
-        seed_index_pre = [int(query_index - m * C * 1e11) for m in range(T)]
-        seed_index_succ = [int(query_index + m * C * 1e11) for m in range(T)]
-        seed_index.extend(seed_index_pre)
-        seed_index.extend(seed_index_succ)
         visited = {}
-
         for index in seed_index:
             # Backward search
-            pre_prev = index
             p_count = 0
-            while p_count < pre_step:
-                pre = self.vebtree.predecessor(pre_prev)
-                if pre is None or pre in visited:
+            for pre in self.index_tree.iter_predecessors(index):
+                if p_count >= pre_step or pre in visited:
                     break
-                if len(self.meta_clean[pre]) == 0:
-                    pre_prev = pre
+                position = self._position(pre)
+                if self._is_empty(position):
                     continue
-                # If there are multiple mosaic shared with the same index
-                # find the one that has minimum hamming distance
-                if len(self.meta_clean[pre]) > 1:
-                    tmp = []
-                    for idx, _ in enumerate(self.meta_clean[pre]):
-                        pre_dense = self.meta_clean[pre][idx]['dense_binarized']
-                        hamming_dist_tmp = bin(int(pre_dense, 2) ^ int(dense_feat, 2)).count('1')
-                        tmp.append(hamming_dist_tmp)
-                    min_index = np.argmin(tmp)
-                    hamming_dist = tmp[min_index]
-                else:
-                    min_index = 0
-                    pre_dense = self.meta_clean[pre][min_index]['dense_binarized']
-                    hamming_dist = bin(int(pre_dense, 2) ^ int(dense_feat, 2)).count('1')
-
-                # Only select high quality mosaic with threshold less than thrsh (128)
-                if hamming_dist <= thrsh:
-                    index_meta = self.meta_clean[pre][min_index]
+                result = self._match(query_index, pre, position, dense_feat, thrsh)
+                if result is not None:
                     visited[pre] = 1
-                    if not self.is_patch:
-                        res.append((query_index, pre, np.abs(pre - query_index),
-                                    hamming_dist, index_meta['slide_name'],
-                                    index_meta['diagnosis'], index_meta['site'],
-                                    index_meta['x'], index_meta['y']))
-                    else:
-                        res.append((query_index, pre, np.abs(pre - query_index),
-                                    hamming_dist, index_meta['patch_name'],
-                                    index_meta['diagnosis']))
+                    res.append(result)
                 p_count += 1
-                pre_prev = pre
 
             # Forward search
             s_count = 0
-            succ_prev = index
-            while s_count < succ_step:
-                succ = self.vebtree.successor(succ_prev)
-                if succ is None or succ in visited:
+            for succ in self.index_tree.iter_successors(index):
+                if s_count >= succ_step or succ in visited:
                     break
-                if len(self.meta_clean[succ]) == 0:
-                    succ_prev = succ
+                position = self._position(succ)
+                if self._is_empty(position):
                     continue
-                # If there are multiple mosaic shared with the same index
-                # find the one that has minimum hamming distance
-                if len(self.meta_clean[succ]) > 1:
-                    tmp = []
-                    for idx, _ in enumerate(self.meta_clean[succ]):
-                        succ_dense = self.meta_clean[succ][idx]['dense_binarized']
-                        hamming_dist_tmp = bin(int(succ_dense, 2) ^ int(dense_feat, 2)).count('1')
-                        tmp.append(hamming_dist_tmp)
-                    min_index = np.argmin(tmp)
-                    hamming_dist = tmp[min_index]
-                else:
-                    min_index = 0
-                    succ_dense = self.meta_clean[succ][min_index]['dense_binarized']
-                    hamming_dist = bin(int(succ_dense, 2) ^ int(dense_feat, 2)).count('1')
-
-                # Only select high quality mosaic with threshold less than thrsh (128)
-                if hamming_dist <= thrsh:
+                result = self._match(query_index, succ, position, dense_feat, thrsh)
+                if result is not None:
                     visited[succ] = 1
-                    index_meta = self.meta_clean[succ][min_index]
-                    if not self.is_patch:
-                        res.append((query_index, succ, np.abs(succ - query_index),
-                                    hamming_dist, index_meta['slide_name'],
-                                    index_meta['diagnosis'], index_meta['site'],
-                                    index_meta['x'], index_meta['y']))
-                    else:
-                        res.append((query_index, succ, np.abs(succ - query_index),
-                                    hamming_dist, index_meta['patch_name'],
-                                    index_meta['diagnosis']))
+                    res.append(result)
                 s_count += 1
-                succ_prev = succ
         return res
 
+    def _position(self, key):
+        """
+        The position of a key of the index in the index meta
+        """
+        return int(np.searchsorted(self.meta.keys, key))
+
+    def _is_empty(self, position):
+        """
+        Whether all mosaics of the key at the given position are excluded
+        """
+        return bool(self._empty_mask(np.array([position]))[0])
+
+    def _empty_mask(self, positions):
+        """
+        Whether all mosaics of each key at the given positions are excluded
+        """
+        if self.excluded_patient is None or len(positions) == 0:
+            return np.zeros(len(positions), dtype=bool)
+        rows, counts = self.meta.rows(positions)
+        kept = self.meta.columns[PATIENT_COLUMN][rows] != self.excluded_patient
+        return np.add.reduceat(kept, np.cumsum(counts) - counts) == 0
+
+    def _match(self, query_index, key, position, dense_feat, thrsh):
+        """
+        Compare the query against the mosaics stored under the given key
+        Input:
+            query_index (int): The integer index of the query mosaic
+            key (int): The key in the index to compare with
+            position (int): The position of the key in the index meta
+            dense_feat (np.array): Packed texture feature of the query mosaic
+            thrsh (int): The maximum hamming distance of a valid result
+        Output:
+            result (tuple): The result tuple described in search, None if the
+            key has no mosaic within the threshold
+        """
+        min_dist, min_row = self._nearest_rows(np.array([position]), dense_feat)
+
+        # Only select high quality mosaic with threshold less than thrsh (128)
+        if min_dist[0] > thrsh:
+            return None
+        return self._result(query_index, key, int(min_dist[0]), min_row[0])
+
+    def _nearest_rows(self, positions, dense_feat):
+        """
+        If there are multiple mosaic shared with the same index find the one that has minimum
+        hamming distance. The codes of all given keys are compared in a single block and
+        excluded mosaics are never selected.
+        Input:
+            positions (np.array): Positions of the keys in the index meta
+            dense_feat (np.array): Packed texture feature of the query mosaic
+        Output:
+            min_dist (np.array): The minimum hamming distance of each key, EXCLUDED_DIST
+            if all of its mosaics are excluded
+            min_row (np.array): The row of the closest mosaic of each key
+        """
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows, counts = self.meta.rows(positions)
+        dists = hamming_distance(dense_feat, self.meta.codes[rows])
+        if self.excluded_patient is not None:
+            dists[self.meta.columns[PATIENT_COLUMN][rows] == self.excluded_patient] = EXCLUDED_DIST
+        offsets = np.cumsum(counts) - counts
+        min_dist = np.minimum.reduceat(dists, offsets)
+
+        # First occurrence of the minimum in each key, as np.argmin would pick
+        segment = np.repeat(np.arange(len(counts)), counts)
+        is_min = np.flatnonzero(dists == min_dist[segment])
+        _, first = np.unique(segment[is_min], return_index=True)
+        return min_dist, rows[is_min[first]]
+
+    def _result(self, query_index, key, hamming_dist, row):
+        """
+        Build the result tuple described in search from a row of the index meta
+        """
+        index_meta = self.meta.entry(row)
+        if not self.is_patch:
+            return (query_index, key, np.abs(key - query_index),
+                    hamming_dist, index_meta['slide_name'],
+                    index_meta['diagnosis'], index_meta['site'],
+                    index_meta['x'], index_meta['y'])
+        else:
+            return (query_index, key, np.abs(key - query_index),
+                    hamming_dist, index_meta['patch_name'],
+                    index_meta['diagnosis'])
+
+    def _results(self, query_index, keys, hamming_dists, rows):
+        """
+        Build the result tuples of many rows of the index meta at once, decoding
+        each column with a single gather
+        """
+        names = ['patch_name', 'diagnosis'] if self.is_patch else ['slide_name', 'diagnosis', 'site']
+        columns = []
+        for name in names:
+            vocab = self.meta.vocab[name]
+            columns.append([vocab[i] for i in self.meta.columns[name][rows].tolist()])
+        if not self.is_patch:
+            columns.extend(self.meta.coords[name][rows].tolist() for name in ['x', 'y'])
+        return list(zip([query_index] * len(rows), keys.tolist(), np.abs(keys - query_index),
+                        hamming_dists.tolist(), *columns))
+
     def preprocessing(self, latent):
         """
         Implementation of the pipeline that converts the original latent code
@@ -236,20 +634,16 @@ class HistoDatabase(object):
             res_srt_dict = [dict(zip(attribute_list, res)) for res in res_srt]
             return res_srt_dict
 
-    def _to_latent_semantic(self, latent):
+    def slides_to_indices(self, latents):
         """
-        Convert the original latent code from vq-vae by 
-        re-ordered semantic codebook
+        Convert the latent codes of many mosaics (e.g., all mosaics of a slide) into
+        their integer indices in one vectorized call
         Input:
-            latent (np.array): latent code of size 64 x 64
-        Ouput:
-            latent_semantic (np.array): The converted latent code of size 64 x 64
+            latents (np.array): N x 64 x 64 latent codes from the vq-vae encoder
+        Output:
+            mosaic_indices (np.array): int64 index of each mosaic (m_{i})
         """
-        latent_semantic = np.zeros_like(latent)
-        for i in range(latent_semantic.shape[0]):
-            for j in range(latent_semantic.shape[1]):
-                latent_semantic[i][j] = self.codebook_semantic[latent[i][j]]
-        return latent_semantic
+        return latents_to_indices(latents, self.semantic_lookup)
 
     def _slide_to_index(self, latent):
         """
@@ -259,27 +653,7 @@ class HistoDatabase(object):
         Output:
             mosaic_index: The index that represents the given mosaic (m_{i})
         """
-        result = self._to_latent_semantic(latent)
-        feat = torch.unsqueeze(torch.from_numpy(np.array(result)), 0)
-
-        num_level = list(range(len(self.pool_layers) + 1))
-        level_sum_dict = {level: None for level in num_level}
-
-        for level in num_level:
-            if level == 0:
-                level_sum_dict[level] = torch.sum(feat, (1, 2)).numpy().astype(float)
-            else:
-                feat = self.pool_layers[level - 1](feat)
-                level_sum_dict[level] = torch.sum(feat, (1, 2)).numpy().astype(float)
-
-        level_power = [0, 0, 1e6, 1e11]
-        mosaic_index = 0
-        for level, power in enumerate(level_power):
-            if level == 1:
-                mosaic_index = copy.deepcopy(level_sum_dict[level])
-            elif level > 1:
-                mosaic_index += level_sum_dict[level] * power
-        return int(mosaic_index[0])
+        return int(self.slides_to_indices(np.expand_dims(latent, 0))[0])
 
     def __str__(self):
         """
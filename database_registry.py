@@ -0,0 +1,165 @@
+"""
+Registry of the databases of several sites kept open at the same time. Switching back to a
+resident site is instant, the least recently used sites are closed once the databases exceed
+a memory budget, and sites can be preloaded in a background thread while they fit into the budget.
+"""
+import os
+import threading
+from collections import OrderedDict
+from database import HistoDatabase
+
+
+def database_size(db):
+    """
+    Estimate the memory used by a database in bytes, i.e., the size of its index meta arrays
+    (resident once their pages are touched when memory mapped) and of a pickled VEB tree
+    """
+    meta = db.meta
+    arrays = [meta.keys, meta.offsets, meta.codes]
+    arrays.extend(meta.coords.values())
+    arrays.extend(meta.columns.values())
+    size = sum(array.nbytes for array in arrays)
+    if db.index_engine == 'veb' and db.database_index_path is not None:
+        size += os.path.getsize(db.database_index_path)
+    return size
+
+
+def estimated_size(db_args):
+    """
+    Estimate the memory a database will use from the size of its files before opening it
+    Input:
+        db_args (dict): The HistoDatabase arguments of the database
+    Output:
+        size (int): The estimated number of bytes, see database_size
+    """
+    path = db_args['index_meta_path']
+    if os.path.isdir(path):
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, files in os.walk(path) for name in files if name.endswith('.npy'))
+    else:
+        size = os.path.getsize(path)
+    if db_args.get('index_engine') == 'veb' and db_args.get('database_index_path') is not None:
+        size += os.path.getsize(db_args['database_index_path'])
+    return size
+
+
+class DatabaseRegistry(object):
+    """
+    LRU of open databases bounded by a memory budget
+    Attributes:
+        memory_budget (int): The number of bytes the resident databases may use, the most
+        recently used database is kept even if it alone exceeds the budget
+        resident (OrderedDict): Site -> (HistoDatabase, estimated size), least recently used first
+    """
+
+    def __init__(self, memory_budget=16 * 2 ** 30):
+        self.memory_budget = memory_budget
+        self.resident = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, site, **db_args):
+        """
+        The database of a site, opened with the HistoDatabase arguments db_args if it is not
+        resident. Waits for a background preload of the site instead of opening it twice.
+        """
+        while True:
+            with self.lock:
+                if site in self.resident:
+                    self.resident.move_to_end(site)
+                    return self.resident[site][0]
+                loaded = self.loading.get(site)
+                if loaded is None:
+                    loaded = threading.Event()
+                    self.loading[site] = loaded
+                    break
+            loaded.wait()
+
+        try:
+            db = HistoDatabase(**db_args)
+        finally:
+            with self.lock:
+                del self.loading[site]
+            loaded.set()
+        self._insert(site, db, recent=True)
+        return db
+
+    def preload(self, sites):
+        """
+        Open databases in a background thread, one after the other, until the next one
+        would exceed the memory budget. Preloading never closes a resident database and
+        preloaded databases are the first to be closed for a site that is used.
+        Input:
+            sites (dict): Site -> HistoDatabase arguments
+        Output:
+            thread (threading.Thread): The preloading thread
+        """
+        thread = threading.Thread(target=self._preload, args=(dict(sites),), daemon=True)
+        thread.start()
+        return thread
+
+    def _preload(self, sites):
+        for site, db_args in sites.items():
+            try:
+                size = estimated_size(db_args)
+            except OSError as error:
+                print("Failed to preload the database of {}: {}".format(site, error), flush=True)
+                continue
+            with self.lock:
+                if site in self.resident or site in self.loading:
+                    continue
+                if self.memory_size() + size > self.memory_budget:
+                    print("Stopped preloading at {}, it does not fit into the memory budget".format(site),
+                          flush=True)
+                    return
+                loaded = threading.Event()
+                self.loading[site] = loaded
+            try:
+                db = HistoDatabase(**db_args)
+            except Exception as error:
+                print("Failed to preload the database of {}: {}".format(site, error), flush=True)
+                continue
+            finally:
+                with self.lock:
+                    del self.loading[site]
+                loaded.set()
+            if not self._insert(site, db, recent=False):
+                print("Stopped preloading at {}, it does not fit into the memory budget".format(site),
+                      flush=True)
+                return
+
+    def _insert(self, site, db, recent):
+        """
+        Add an open database and close the least recently used ones beyond the memory budget.
+        A preloaded database (recent=False) is dropped instead if it does not fit.
+        Output:
+            inserted (bool): Whether the database is resident
+        """
+        size = database_size(db)
+        with self.lock:
+            if not recent and self.memory_size() + size > self.memory_budget:
+                return False
+            self.resident[site] = (db, size)
+            self.resident.move_to_end(site, last=recent)
+            while len(self.resident) > 1 and self.memory_size() > self.memory_budget:
+                evicted, _ = self.resident.popitem(last=False)
+                print("Closed the database of {} to stay within the memory budget".format(evicted), flush=True)
+        return True
+
+    def memory_size(self):
+        return sum(size for _, size in self.resident.values())
+
+    def resident_sites(self):
+        """
+        The resident sites, least recently used first
+        """
+        with self.lock:
+            return list(self.resident.keys())
+
+    def evict(self, site):
+        with self.lock:
+            self.resident.pop(site, None)
+
+    def clear(self):
+        with self.lock:
+            self.resident.clear()
@@ -38,7 +38,8 @@ class Mosaic_Bag_FP(torch.utils.data.Dataset):
             file_path (string): Path to the .h5 file containing patched data.
             wsi (openslide object): Whole slide image loaded by openslide
             resolution (int): The resolution of the wsi
-            custom_transforms (callable, optional): The transform to be applied on a sample
+            custom_transforms (callable, optional): The transform to be applied on a sample,
+            or a tuple of transforms that are all applied to the same region read
         """
         self.wsi = wsi
         self.resolution = resolution
@@ -66,5 +67,7 @@ class Mosaic_Bag_FP(torch.utils.data.Dataset):
                                    self.patch_level,
                                    (self.patch_size, self.patch_size)).convert('RGB')
         img = img.resize((self.target_patch_size, self.target_patch_size))
+        if isinstance(self.roi_transforms, (tuple, list)):
+            return tuple(transform(img) for transform in self.roi_transforms), self.dset[idx]
         img = self.roi_transforms(img)
         return img, self.dset[idx]
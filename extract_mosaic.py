@@ -3,32 +3,28 @@ import os
 import glob
 import pickle
 
-from sklearn.utils._param_validation import InvalidParameterError
-
-# HANDLE OS SPECIFIC OPENSLIDE IMPORT
-if hasattr(os, 'add_dll_directory'):
-    import SISH_Fork.openslide_win_config
-    with os.add_dll_directory(SISH_Fork.openslide_win_config.get_openslide_path()):
-        import openslide
-else:
-    import openslide
-
 import argparse
+import csv
 import time
 import cv2 as cv
 import numpy as np
 import multiprocessing as mp
+from collections import deque
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
 from skimage.feature import local_binary_pattern
 from sklearn.cluster import KMeans
+from slide_handles import get_slide, read_downsampled, slide_pool, slide_chunksize
+from artifacts_removal import save_clean_mosaic
 
 np.random.seed(0)
 
 color = ('r', 'g', 'b')  # Denote the channel used to extract 5x histogram
 num_cluster = 9  # Number of cluster used in the first stage K-mean clustering
 sample_rate = 0.05  # Number of cluster (sample_rate * cluster_size) used in the second stage K-mean clustering (spatial clustering)
+feature_block_size = 32  # Number of patches whose features are computed together by patch_features
+kmeans_tile_size = 10000  # Slides with more clean patches are clustered tile by tile
 
 
 def local_binary_pattern_hist(img_imp):
@@ -45,20 +41,26 @@ def local_binary_pattern_hist(img_imp):
     return hist
 
 
-def pre_filtering(coord, slide_name, patch_size):
+def pre_filtering(coord, slide_name, patch_size, low_res=False):
     """
     Filter out the white region and calculate the rgb/lbp histogram for a patch in the given slide.
     Input:
         slide_name (str): The slide to process
         coord (np.array): The coordinate of the patch in the slide
         patch_size (int): The height and width of the patch
+        low_res (bool): Whether to read the patch from the pyramid level closest to the
+        256 px used by the filter and the histograms instead of level 0. The artifact
+        classifier decides differently on some textured patches, see bench_lowres_filter
     Output:
         hist_feat (np.array): RGB histogram of patch in coord from the slide
         lbp_feat (np.array): LBP histogram of patch in the coord from the slide
     """
     hist_feat = []
-    wsi = openslide.open_slide(slide_name)
-    patch = wsi.read_region((coord[0], coord[1]), 0, (patch_size, patch_size))
+    wsi = get_slide(slide_name)
+    if low_res:
+        patch = read_downsampled(wsi, coord, patch_size)
+    else:
+        patch = wsi.read_region((coord[0], coord[1]), 0, (patch_size, patch_size))
 
     # Convert to 5x to do filtering
     patch_grey = patch.convert('L').resize((256, 256))
@@ -79,11 +81,230 @@ def pre_filtering(coord, slide_name, patch_size):
     return hist_feat, lbp_feat
 
 
-def process_slides(slide_data_path, slide_patch_path, save_path, num_cpu, sample_rate=0.1):
-    ignore_slide_id = ['TCGA-06-1086-01Z-00-DX2.e1961f1f-a823-4775-acf7-04a46f05e15e',
-                       'C3N-02678-21', 'TCGA-AN-A0XW-01Z-00-DX1.811E11E7-FA67-46BB-9BC6-1FD0106B789D',
-                       'TCGA-DQ-5630-01Z-00-DX1.07FE0581-2412-43DA-96A9-0DA192DAED3D']
+def grey_levels(rgb):
+    """
+    Convert a block of RGB patches to grey scale like PIL's convert('L') (ITU-R 601-2 luma)
+    Input:
+        rgb (np.array): N x H x W x 3 uint8 patches
+    Output:
+        grey (np.array): N x H x W uint8 patches
+    """
+    rgb = rgb.astype(np.uint32)
+    grey = rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000
+    return (grey >> 16).astype(np.uint8)
+
+
+def rgb_histograms(rgb):
+    """
+    The 256 bin histogram of each channel of a block of RGB patches, like three cv.calcHist calls
+    Input:
+        rgb (np.array): N x H x W x 3 uint8 patches
+    Output:
+        hist (np.array): N x 768 float32 histograms, channel after channel
+    """
+    n = len(rgb)
+    bins = rgb.reshape(n, rgb.shape[1] * rgb.shape[2], 3).astype(np.int64) + np.arange(3) * 256
+    bins += np.arange(n)[:, None, None] * 768
+    return np.bincount(bins.ravel(), minlength=n * 768).reshape(n, 768).astype(np.float32)
+
+
+def local_binary_patterns(grey, points=8, radius=1):
+    """
+    The rotation invariant local binary pattern ('ror') of a block of grey scale patches,
+    identical to skimage's local_binary_pattern applied to each patch
+    Input:
+        grey (np.array): N x H x W uint8 patches
+        points (int): The number of circularly symmetric neighbours
+        radius (int): The radius of the circle
+    Output:
+        lbp (np.array): N x H x W uint8 patterns
+    """
+    grey = np.asarray(grey, dtype=np.float64)
+    _, height, width = grey.shape
+    # Neighbours outside of the patch are 0
+    padded = np.pad(grey, ((0, 0), (radius, radius), (radius, radius)))
+    angles = 2 * np.pi * np.arange(points) / points
+    row_offsets = np.round(-radius * np.sin(angles), 5)
+    col_offsets = np.round(radius * np.cos(angles), 5)
+
+    def shifted(row, col):
+        return padded[:, radius + row:radius + row + height, radius + col:radius + col + width]
+
+    lbp = np.zeros(grey.shape, dtype=np.uint8)
+    for i, (row_offset, col_offset) in enumerate(zip(row_offsets, col_offsets)):
+        if row_offset == int(row_offset) and col_offset == int(col_offset):
+            lbp |= (shifted(int(row_offset), int(col_offset)) >= grey).astype(np.uint8) << i
+            continue
+        # Bilinear interpolation with the weights computed at the absolute positions like skimage
+        rows = np.arange(height) + row_offset
+        cols = np.arange(width) + col_offset
+        min_row, max_row = int(np.floor(row_offset)), int(np.ceil(row_offset))
+        min_col, max_col = int(np.floor(col_offset)), int(np.ceil(col_offset))
+        dr = (rows - np.floor(rows))[:, None]
+        dc = (cols - np.floor(cols))[None, :]
+        top = (1 - dc) * shifted(min_row, min_col) + dc * shifted(min_row, max_col)
+        bottom = (1 - dc) * shifted(max_row, min_col) + dc * shifted(max_row, max_col)
+        texture = (1 - dr) * top + dr * bottom
+        lbp |= (texture - grey >= 0).astype(np.uint8) << i
+
+    # The smallest of all bit rotations
+    rotated = lbp
+    for _ in range(1, points):
+        rotated = (rotated >> 1) | ((rotated & 1) << (points - 1))
+        np.minimum(lbp, rotated, out=lbp)
+    return lbp
+
+
+def local_binary_pattern_hists(grey):
+    """
+    The local binary pattern histogram of a block of grey scale patches, see local_binary_pattern_hist
+    Input:
+        grey (np.array): N x H x W uint8 patches
+    Output:
+        hist (np.array): N x 128 density histograms
+    """
+    n = len(grey)
+    lbp = local_binary_patterns(grey).reshape(n, grey.shape[1] * grey.shape[2]).astype(np.int64)
+    counts = np.bincount((lbp + np.arange(n)[:, None] * 256).ravel(),
+                         minlength=n * 256).reshape(n, 256)[:, :128]
+    return counts / counts.sum(axis=1, keepdims=True)
+
+
+def read_patches(coords, slide_name, patch_size):
+    """
+    Read a block of patches of a slide scaled down to 256 px
+    Output:
+        rgb (np.array): N x 256 x 256 x 3 uint8 patches
+    """
+    wsi = get_slide(slide_name)
+    return np.stack([np.array(read_downsampled(wsi, coord, patch_size).convert('RGB'))
+                     for coord in coords])
+
+
+def read_full_patches(coords, slide_name, patch_size):
+    """
+    Read a block of patches of a slide at level 0 and scale them down to 256 px like pre_filtering
+    Output:
+        rgb (np.array): N x 256 x 256 x 3 uint8 patches
+        grey (np.array): N x 256 x 256 uint8 patches, scaled down after the grey scale conversion
+    """
+    if len(coords) == 0:
+        return np.zeros((0, 256, 256, 3), dtype=np.uint8), np.zeros((0, 256, 256), dtype=np.uint8)
+    wsi = get_slide(slide_name)
+    rgb = []
+    grey = []
+    for coord in coords:
+        patch = wsi.read_region((int(coord[0]), int(coord[1])), 0, (patch_size, patch_size))
+        grey.append(np.array(patch.convert('L').resize((256, 256))))
+        rgb.append(np.array(patch.convert('RGB').resize((256, 256))))
+    return np.stack(rgb), np.stack(grey)
+
+
+def white_patches(grey):
+    """
+    Whether more than 90 percent of each grey scale patch is white (> 235)
+    """
+    return np.mean(grey > 235, axis=(1, 2)) > 0.9
+
+
+def mosaic_whiteness(coords, slide_name, patch_size):
+    """
+    The artifacts_removal decision of a block of mosaics, read from the pyramid level closest to 256 px
+    Output:
+        white (np.array): Whether each mosaic is white
+    """
+    return white_patches(grey_levels(read_patches(coords, slide_name, patch_size)))
+
+
+def patch_features(coords, slide_name, patch_size, low_res_features=False):
+    """
+    Filter out the white region and calculate the rgb/lbp histograms of a block of patches in the
+    given slide in one vectorized pass. The white region filter reads the patches from the pyramid
+    level closest to 256 px, the histograms of the patches that are not white are computed from
+    level 0 as in pre_filtering, or from the same low resolution read with low_res_features
+    (the same results as pre_filtering with low_res=True).
+    Input:
+        coords (np.array): The coordinates of the patches in the slide
+        slide_name (str): The slide to process
+        patch_size (int): The height and width of the patches
+        low_res_features (bool): Whether to compute the histograms from the low resolution read
+    Output:
+        white (np.array): Whether each patch is white
+        hist_feat (np.array): N x 768 RGB histograms of the patches that are not white
+        lbp_feat (np.array): N x 128 LBP histograms of the patches that are not white
+    """
+    rgb = read_patches(coords, slide_name, patch_size)
+    grey = grey_levels(rgb)
+    white = white_patches(grey)
+    if low_res_features:
+        rgb, grey = rgb[~white], grey[~white]
+    else:
+        rgb, grey = read_full_patches(coords[~white], slide_name, patch_size)
+    return white, rgb_histograms(rgb), local_binary_pattern_hists(grey)
 
+
+def spatial_tiles(coords, tile_size):
+    """
+    Split patches into spatially compact tiles of at most tile_size patches by cutting the
+    larger side of their bounding box at the median, recursively
+    Input:
+        coords (np.array): The coordinates of the patches
+        tile_size (int): The maximum number of patches per tile
+    Output:
+        tiles (list): The indices of the patches of each tile
+    """
+    tiles = []
+    stack = [np.arange(len(coords))]
+    while len(stack) > 0:
+        index = stack.pop()
+        if len(index) <= tile_size:
+            tiles.append(index)
+            continue
+        tile = coords[index]
+        axis = int(np.argmax(tile.max(axis=0) - tile.min(axis=0)))
+        order = index[np.argsort(tile[:, axis], kind='stable')]
+        stack.append(order[len(order) // 2:])
+        stack.append(order[:len(order) // 2])
+    return tiles
+
+
+def select_mosaic(coords, sample_rate, seed=0, tile_size=None):
+    """
+    Select the mosaic of a slide by spatial K-means clustering of its clean patches into
+    sample_rate * #patches clusters. Slides with more than kmeans_tile_size patches are split
+    into spatially compact tiles that are clustered separately, so the time grows linearly
+    with the number of patches and the memory is bounded by the tile size.
+    Input:
+        coords (np.array): The coordinates of the clean patches
+        sample_rate (float): The number of mosaics per clean patch
+        seed (int): The random state of the clustering
+        tile_size (int): The maximum number of patches clustered together, defaults to
+        kmeans_tile_size
+    Output:
+        mosaic (np.array): The coordinates of the mosaics, None if the slide has no clean patch
+    """
+    if len(coords) == 0:
+        return None
+    tile_size = kmeans_tile_size if tile_size is None else tile_size
+    coords = np.asarray(coords)
+    mosaic = []
+    for index in spatial_tiles(coords, tile_size):
+        tile = coords[index]
+        # Tiny slides keep at least one mosaic
+        n_clusters = max(1, int(sample_rate * len(tile)))
+        if n_clusters >= len(tile):
+            mosaic.append(tile.astype(int))
+            continue
+        model = KMeans(n_clusters=n_clusters, random_state=seed)
+        model.fit(tile)
+        mosaic.append(model.cluster_centers_.astype(int))
+    return np.concatenate(mosaic, 0)
+
+
+def load_trash_classifier():
+    """
+    Load the logistic regression on LBP histograms that detects artifact patches
+    """
     clf_path = "./checkpoints/trash_lgrlbp.pkl"
     try:
         with open(clf_path, 'rb') as handle:
@@ -97,61 +318,188 @@ def process_slides(slide_data_path, slide_patch_path, save_path, num_cpu, sample
             clf_path = os.path.dirname(os.path.dirname(os.getcwd())) + "/SISH_Fork/checkpoints/trash_lgrlbp.pkl"
             with open(clf_path, 'rb') as handle:
                 clf = pickle.load(handle)
+    return clf
 
 
-    if not os.path.exists(save_path):
-        os.makedirs(os.path.join(save_path, 'coord'))
-
-    total = len(glob.glob(os.path.join(slide_patch_path, "*")))
-    progress = 1
-    pool = mp.Pool(num_cpu)
+def slide_jobs(slide_data_path, slide_patch_path, save_path, remove_artifacts=False):
+    """
+    The slides of a directory whose mosaics still have to be extracted
+    Input:
+        slide_data_path (str): The directory of the slides
+        slide_patch_path (str): The directory of the patch h5 files of the slides
+        save_path (str): The directory the mosaics are written to (into save_path/coord)
+        remove_artifacts (bool): Whether the slides are done only once their mosaics are in
+        save_path/coord_clean, see save_slide
+    Output:
+        jobs (list): One dictionary with slide_key, slide_path, patch_path and save_path per slide
+    """
+    ignore_slide_id = ['TCGA-06-1086-01Z-00-DX2.e1961f1f-a823-4775-acf7-04a46f05e15e',
+                       'C3N-02678-21', 'TCGA-AN-A0XW-01Z-00-DX1.811E11E7-FA67-46BB-9BC6-1FD0106B789D',
+                       'TCGA-DQ-5630-01Z-00-DX1.07FE0581-2412-43DA-96A9-0DA192DAED3D']
+    done_dir = os.path.join(save_path, 'coord_clean' if remove_artifacts else 'coord')
+    os.makedirs(os.path.join(save_path, 'coord'), exist_ok=True)
+    os.makedirs(done_dir, exist_ok=True)
+    done = set(os.listdir(done_dir))
 
+    jobs = []
     for slide_to_process in glob.glob(os.path.join(slide_patch_path, "*")):
         slide_key = os.path.basename(slide_to_process).replace(".h5", "")
         if slide_key in ignore_slide_id:
             continue
-
-        if slide_key + ".h5" in os.listdir(os.path.join(save_path, 'coord')):
+        if slide_key + ".h5" in done:
             print(f"Skip {slide_key}", flush=True)
-            progress += 1
             continue
+        jobs.append({'slide_key': slide_key,
+                     'slide_path': os.path.join(slide_data_path, f"{slide_key}.svs"),
+                     'patch_path': os.path.join(slide_patch_path, f"{slide_key}.h5"),
+                     'save_path': save_path})
+    return jobs
 
-        t_start = time.time()
-        slide_path = os.path.join(slide_data_path, f"{slide_key}.svs")
-        patch_path = os.path.join(slide_patch_path, f"{slide_key}.h5")
-
-        with h5py.File(patch_path, 'r') as hf:
-            coords = hf['coords'][:]
-            patch_size = hf['coords'].attrs['patch_size']
-
-        results = pool.starmap(pre_filtering, [(coord, slide_path, patch_size) for coord in coords])
 
-        white_index = [0 if r[0] is not None else 1 for r in results]
-        slide_rgbhist_feat = [r[0] for r in results if r[0] is not None]
-        slide_lbphist_feat = [np.expand_dims(r[1], 0) for r in results if r[1] is not None]
-
-        trash_pred = clf.predict(np.concatenate(slide_lbphist_feat, 0))
-        coords_nonwhite = coords[np.array(white_index) == 0]
+def submit_slide(pool, job, num_cpu, low_res_features=False):
+    """
+    Queue the feature extraction of all patches of a slide in the pool
+    Output:
+        pending (dict): The job with its coordinates and the AsyncResult of its features
+    """
+    t_start = time.time()
+    with h5py.File(job['patch_path'], 'r') as hf:
+        coords = hf['coords'][:]
+        patch_size = hf['coords'].attrs['patch_size']
+    block_size = min(feature_block_size, slide_chunksize(len(coords), num_cpu))
+    blocks = [coords[start:start + block_size] for start in range(0, len(coords), block_size)]
+    result = pool.starmap_async(patch_features, [(block, job['slide_path'], patch_size, low_res_features)
+                                                 for block in blocks])
+    return dict(job, coords=coords, patch_size=patch_size, result=result, t_start=t_start)
+
+
+def select_slide(pending, clf, sample_rate, pool=None, num_cpu=1):
+    """
+    Wait for the features of a slide, remove its white and artifact patches and select its mosaic.
+    Given a pool, the white mosaics are then checked by the pool like artifacts_removal.py does,
+    without waiting for the check, see save_slide.
+    Output:
+        selected (dict): The job with its mosaic (None if it failed), its row in the timing report
+        and the pending white check of its mosaic (None without a pool)
+    """
+    results = pending['result'].get()
+    t_features = time.time()
+    coords = pending['coords']
+    slide_key = pending['slide_key']
+    timing = {'slide': slide_key, 'patches': len(coords), 'clean': 0, 'mosaics': 0, 'artifacts': 0,
+              'features_s': t_features - pending['t_start'], 'selection_s': 0., 'total_s': 0.}
+
+    if len(results) > 0:
+        white_index = np.concatenate([r[0] for r in results])
+        slide_rgbhist_feat = np.concatenate([r[1] for r in results], 0)
+        slide_lbphist_feat = np.concatenate([r[2] for r in results], 0)
+        trash_pred = clf.predict(slide_lbphist_feat) if len(slide_lbphist_feat) > 0 else np.zeros(0)
+        coords_nonwhite = coords[~white_index]
         coords_clean = coords_nonwhite[trash_pred == 0]
-
-        model = KMeans(n_clusters=int(sample_rate * len(coords_clean)), random_state=0)
-
-        try:
-            model.fit(coords_clean)
-        except InvalidParameterError:
-            print(f"FAILED TO GENERATE MOSAIC FOR {slide_to_process}, SKIPPING", flush=True)
-            progress += 1
-            continue
-        mosaic = model.cluster_centers_.astype(int)
-
-        save_name = os.path.join(save_path, 'coord', f"{slide_key}.h5")
+    else:
+        coords_clean = coords
+    timing['clean'] = len(coords_clean)
+
+    mosaic = select_mosaic(coords_clean, sample_rate)
+    white = None
+    if mosaic is None:
+        print(f"FAILED TO GENERATE MOSAIC FOR {pending['patch_path']}, SKIPPING", flush=True)
+    else:
+        timing['mosaics'] = len(mosaic)
+        if pool is not None:
+            block_size = min(feature_block_size, slide_chunksize(len(mosaic), num_cpu))
+            blocks = [mosaic[start:start + block_size] for start in range(0, len(mosaic), block_size)]
+            white = pool.starmap_async(mosaic_whiteness, [(block, pending['slide_path'], pending['patch_size'])
+                                                          for block in blocks])
+    timing['selection_s'] = time.time() - t_features
+    return dict(pending, mosaic=mosaic, timing=timing, white=white)
+
+
+def save_slide(selected):
+    """
+    Write the mosaic of a slide selected by select_slide. With a white check, the mosaic is also
+    written into coord_clean and coord_artifacts. The mosaic is written into coord last, so a
+    slide that is interrupted before is extracted again by the next run.
+    Output:
+        timing (dict): The row of the slide in the timing report, features_s is the time from
+        queueing the slide until its features are ready and includes waiting for earlier slides
+    """
+    mosaic = selected['mosaic']
+    slide_key = selected['slide_key']
+    timing = selected['timing']
+    if mosaic is not None:
+        if selected['white'] is not None:
+            artifacts_indicator = np.concatenate(selected['white'].get()).astype(int)
+            save_clean_mosaic(selected['save_path'], slide_key, mosaic, artifacts_indicator)
+            timing['artifacts'] = int(np.sum(artifacts_indicator))
+        save_name = os.path.join(selected['save_path'], 'coord', f"{slide_key}.h5")
         with h5py.File(save_name, 'w') as hf:
             hf.create_dataset("coords", data=mosaic)
 
-        print(f"\nProcessing {slide_key} took: {time.time() - t_start}s\n", flush=True)
-        progress += 1
+    timing['total_s'] = time.time() - selected['t_start']
+    print(f"\nProcessing {slide_key} took: {timing['total_s']}s\n", flush=True)
+    return timing
 
-    pool.close()
+
+def extract_mosaics(jobs, num_cpu, sample_rate=0.1, concurrent_slides=2, timing_csv=None,
+                    remove_artifacts=False, low_res_features=False):
+    """
+    Extract the mosaics of many slides as a pipeline: the patch features of the next slides are
+    computed by the pool while the main process removes the artifacts of a slide, clusters
+    it and writes its mosaic. With remove_artifacts, a slide is written after the next slide
+    is selected, so the white check of its mosaic runs in the pool behind the features that
+    were queued before it and the main process does not wait for them.
+    Input:
+        jobs (list): The slides to process, see slide_jobs
+        num_cpu (int): The number of worker processes
+        sample_rate (float): The number of mosaics per clean patch
+        concurrent_slides (int): The number of slides queued in the pool at the same time
+        timing_csv (str): Optional path of a CSV report with the timing of every slide
+        remove_artifacts (bool): Whether to also write coord_clean and coord_artifacts, which
+        saves the separate pass of artifacts_removal.py over all mosaics
+        low_res_features (bool): Whether the RGB/LBP histograms are computed from the pyramid
+        level closest to 256 px instead of level 0 (see patch_features)
+    Output:
+        timings (list): The timing of every slide
+    """
+    clf = load_trash_classifier()
+    pool = slide_pool(num_cpu)
+    artifacts_pool = pool if remove_artifacts else None
+    # The number of selected slides waiting for their white check
+    pending_checks = 1 if remove_artifacts else 0
+    timings = []
+    queued = deque()
+    selected = deque()
+    try:
+        for job in jobs:
+            queued.append(submit_slide(pool, job, num_cpu, low_res_features))
+            if len(queued) >= concurrent_slides:
+                selected.append(select_slide(queued.popleft(), clf, sample_rate, artifacts_pool, num_cpu))
+            while len(selected) > pending_checks:
+                timings.append(save_slide(selected.popleft()))
+        while len(queued) > 0:
+            selected.append(select_slide(queued.popleft(), clf, sample_rate, artifacts_pool, num_cpu))
+            while len(selected) > pending_checks:
+                timings.append(save_slide(selected.popleft()))
+        while len(selected) > 0:
+            timings.append(save_slide(selected.popleft()))
+    finally:
+        pool.close()
+        pool.join()
+
+    if timing_csv is not None and len(timings) > 0:
+        with open(timing_csv, 'w', newline='') as handle:
+            writer = csv.DictWriter(handle, fieldnames=list(timings[0].keys()))
+            writer.writeheader()
+            writer.writerows(timings)
+    return timings
+
+
+def process_slides(slide_data_path, slide_patch_path, save_path, num_cpu, sample_rate=0.1,
+                   concurrent_slides=2, timing_csv=None, remove_artifacts=False, low_res_features=False):
+    jobs = slide_jobs(slide_data_path, slide_patch_path, save_path, remove_artifacts)
+    return extract_mosaics(jobs, num_cpu, sample_rate, concurrent_slides, timing_csv, remove_artifacts,
+                           low_res_features)
 
 
 if __name__ == "__main__":
@@ -159,7 +507,19 @@ if __name__ == "__main__":
     parser.add_argument("--slide_data_path", required=True)
     parser.add_argument("--slide_patch_path", required=True)
     parser.add_argument("--save_path", required=True)
+    parser.add_argument("--num_cpu", type=int, default=mp.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--concurrent_slides", type=int, default=2,
+                        help="Number of slides whose patches are processed at the same time")
+    parser.add_argument("--timing_csv", type=str, default=None,
+                        help="Path of a CSV report with the timing of every slide")
+    parser.add_argument("--remove_artifacts", action='store_true',
+                        help="Also write coord_clean and coord_artifacts, so artifacts_removal.py is not needed")
+    parser.add_argument("--low_res_features", action='store_true',
+                        help="Compute the RGB/LBP histograms from the pyramid level closest to 256 px "
+                             "instead of level 0, faster but changes some artifact classifier decisions")
     args = parser.parse_args()
 
-    num_cpu = mp.cpu_count()
-    process_slides(args.slide_data_path, args.slide_patch_path, args.save_path, num_cpu=num_cpu)
+    process_slides(args.slide_data_path, args.slide_patch_path, args.save_path, num_cpu=args.num_cpu,
+                   concurrent_slides=args.concurrent_slides, timing_csv=args.timing_csv,
+                   remove_artifacts=args.remove_artifacts, low_res_features=args.low_res_features)
@@ -2,12 +2,66 @@ import argparse
 import os
 import pickle
 import glob
+import multiprocessing as mp
 from database import HistoDatabase
+from query_cache import QueryCache
+from sharded_database import ShardedHistoDatabase
 from tqdm import tqdm
 import search_adapter
 
+# The database of a worker process. Each worker holds its own HistoDatabase object, so the
+# leave-one-patient-out state is per worker while the memory mapped index meta is shared.
+_worker_db = None
 
-def run(db: HistoDatabase, site, latent_path="./DATA/LATENT"):
+
+def _init_worker(db_args):
+    """
+    Open the database in a worker process. With fork the database loaded by the parent
+    is inherited and db_args is None.
+    """
+    global _worker_db
+    if db_args is not None:
+        _worker_db = HistoDatabase(**db_args)
+
+
+def _query_worker(task):
+    """
+    Query one slide in a worker process
+    Input:
+        task (tuple): (site, latent path, speed record path)
+    Output:
+        results (dict): The results of the slide, empty if it was ignored
+        pid (int): The worker process
+        cache_stats (dict): The statistics of the query cache of the worker so far, None without a cache
+    """
+    site, latent, speed_record_path = task
+    results = {}
+    search_adapter.run_query(site, latent, _worker_db, speed_record_path, results)
+    return results, os.getpid(), _worker_db.cache_stats()
+
+
+def merge_cache_stats(worker_stats):
+    """
+    Sum the query cache statistics of the workers (see QueryCache.stats). The disk counts of
+    a worker only include its own writes, the largest one is reported (see run).
+    """
+    if len(worker_stats) == 0:
+        return None
+    stats = {name: sum(s[name] for s in worker_stats)
+             for name in ['hits', 'misses', 'disk_hits', 'memory_entries']}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+    stats['disk_entries'] = max(s['disk_entries'] for s in worker_stats)
+    stats['disk_bytes'] = max(s['disk_bytes'] for s in worker_stats)
+    return stats
+
+
+def run(db: HistoDatabase, site, latent_path="./DATA/LATENT", workers=1):
+    """
+    Query all slides of a site and write their results
+    Output:
+        cache_stats (dict): The statistics of the query cache summed over all workers, None without a cache
+    """
     if site == 'organ':
         save_path = os.path.join("QUERY_RESULTS", site)
         latent_all = os.path.join(latent_path, "*", "*", "*", "vqvae", "*")
@@ -26,12 +80,41 @@ def run(db: HistoDatabase, site, latent_path="./DATA/LATENT"):
         if not os.path.exists(speed_record_path):
             os.makedirs(speed_record_path)
 
+    # Sorted so the results are merged in the same order for any number of workers
+    latents = sorted(glob.glob(latent_all))
     results = {}
-    for latent in tqdm(glob.glob(latent_all)):
-        search_adapter.run_query(site, latent, db, speed_record_path, results)
+    if workers <= 1:
+        for latent in tqdm(latents):
+            search_adapter.run_query(site, latent, db, speed_record_path, results)
+        cache_stats = db.cache_stats()
+    else:
+        global _worker_db
+        if 'fork' in mp.get_all_start_methods():
+            # The workers share the pages of the database loaded here
+            ctx = mp.get_context('fork')
+            _worker_db = db
+            db_args = None
+        else:
+            ctx = mp.get_context('spawn')
+            db_args = db.init_args()
+        tasks = [(site, latent, speed_record_path) for latent in latents]
+        # The queries run on the copy of the query cache in each worker, keep the latest stats of each
+        worker_stats = {}
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(db_args,)) as pool:
+            for slide_results, pid, stats in tqdm(pool.imap(_query_worker, tasks), total=len(tasks)):
+                results.update(slide_results)
+                if stats is not None:
+                    worker_stats[pid] = stats
+        _worker_db = None
+        cache_stats = merge_cache_stats(list(worker_stats.values()))
+        if cache_stats is not None and db.query_cache.cache_dir is not None:
+            # The workers share the on-disk store, count it once they are done
+            disk = QueryCache(0, db.query_cache.cache_dir)
+            cache_stats.update(disk_entries=disk.disk_entries, disk_bytes=disk.disk_bytes)
 
     with open(os.path.join(save_path, "results.pkl"), 'wb') as handle:
         pickle.dump(results, handle)
+    return cache_stats
 
 
 if __name__ == "__main__":
@@ -44,15 +127,40 @@ if __name__ == "__main__":
                         help="The site where the database is built")
     parser.add_argument("--db_index_path", type=str, required=True,
                         help="Path to the veb tree that stores all indices")
-    parser.add_argument("--index_meta_path", type=str, required=True,
-                        help="Path to the meta data of each index")
+    parser.add_argument("--index_meta_path", type=str, nargs='+', required=True,
+                        help="Path to the meta data of each index (snapshot, columnar store or meta.pkl). "
+                             "Several paths (e.g., the database of each site for the organ search) "
+                             "are searched as the shards of one database")
     parser.add_argument("--codebook_semantic", type=str, required=True,
                         help="Path to the semantic codebook from vq-vae")
+    parser.add_argument("--index_engine", type=str, default="sorted", choices=['sorted', 'veb'],
+                        help="Index engine used for the predecessor/successor search")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes that query slides in parallel")
+    parser.add_argument("--query_cache", type=str, default=None,
+                        help="Directory of the on-disk query cache, no cache if not given")
+    parser.add_argument("--cache_size", type=int, default=100000,
+                        help="Number of cached mosaics kept in memory")
     args = parser.parse_args()
 
-    database = HistoDatabase(database_index_path=args.db_index_path,
-                             index_meta_path=args.index_meta_path,
-                             codebook_semantic=args.codebook_semantic)
+    if args.query_cache is not None and args.index_engine != 'sorted':
+        parser.error("--query_cache is only supported by the sorted index engine")
+    if len(args.index_meta_path) > 1:
+        # The shards are already searched in parallel worker processes
+        if args.workers > 1 or args.query_cache is not None or args.index_engine != 'sorted':
+            parser.error("A sharded database does not support --workers, --query_cache or the veb engine")
+        database = ShardedHistoDatabase(args.index_meta_path, args.codebook_semantic)
+        run(database, args.site, args.latent_path)
+        database.close()
+    else:
+        database = HistoDatabase(database_index_path=args.db_index_path,
+                                 index_meta_path=args.index_meta_path[0],
+                                 codebook_semantic=args.codebook_semantic,
+                                 index_engine=args.index_engine,
+                                 query_cache=QueryCache(args.cache_size, args.query_cache)
+                                 if args.query_cache is not None else None)
 
-    # Changed so adapter files can run the functionality as well.
-    run(database, args.site, args.latent_path)
+        # Changed so adapter files can run the functionality as well.
+        cache_stats = run(database, args.site, args.latent_path, workers=args.workers)
+        if cache_stats is not None:
+            print("Query cache: {}".format(cache_stats), flush=True)
@@ -15,6 +15,7 @@ if __name__ == "__main__":
     parser.add_argument("--db_index_path", type=str, required=True)
     parser.add_argument("--index_meta_path", type=str, required=True)
     parser.add_argument("--codebook_semantic", type=str, default="./checkpoints/codebook_semantic.pt")
+    parser.add_argument("--index_engine", type=str, default="sorted", choices=['sorted', 'veb'])
     args = parser.parse_args()
 
     # Create saving path
@@ -31,7 +32,8 @@ if __name__ == "__main__":
     db = HistoDatabase(database_index_path=args.db_index_path,
                        index_meta_path=args.index_meta_path,
                        codebook_semantic=args.codebook_semantic,
-                       is_patch=True)
+                       is_patch=True,
+                       index_engine=args.index_engine)
     t_acc = 0
     query_count = 0
     results = {}
@@ -0,0 +1,343 @@
+"""
+Columnar storage of the index meta data. Replaces the dictionary in meta.pkl that maps
+each index key to a list of per-mosaic dictionaries by flat arrays:
+    keys.npy      (K,)    int64   sorted unique index keys
+    offsets.npy   (K + 1) int64   CSR offsets, the mosaics of keys[i] are rows offsets[i]:offsets[i + 1]
+    codes.npy     (N x 128) uint8 packed texture codes (see texture_codes.py)
+    x.npy, y.npy  (N,)    int32   mosaic coordinates (slide databases only)
+    <column>.npy  (N,)    int32   dictionary encoded string columns (slide_name, diagnosis, ...)
+    patient.npy   (N,)    int32   dictionary encoded patient id of each mosaic (slide databases only)
+    vocab.json                    the values of each dictionary encoded column (vocab.pkl in version 1 stores)
+    header.json                   format version, column names and content checksum
+The arrays are opened with np.load(mmap_mode='r'), so opening a store is near-instant, the pages
+are shared by all processes that open the same store and a search only reads the pages it touches.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+from texture_codes import pack_codes
+
+FORMAT_VERSION = 2
+SLIDE_COLUMNS = ['slide_name', 'diagnosis', 'site', 'slide_ext']
+PATIENT_COLUMN = 'patient'
+PATCH_COLUMNS = ['patch_name', 'diagnosis']
+COORD_COLUMNS = ['x', 'y']
+
+
+class ColumnarMeta(object):
+    """
+    Columnar index meta data
+    Attributes:
+        keys (np.array): Sorted unique int64 index keys
+        offsets (np.array): CSR offsets of the mosaics of each key
+        codes (np.array): Packed texture code of each mosaic
+        coords (dict): Coordinate columns (x, y) of each mosaic, empty for patch databases
+        columns (dict): Dictionary encoded id of each mosaic per string column
+        vocab (dict): The decoded values of each string column
+        is_patch (bool): Whether the store holds a patch database
+    """
+    # Number of rows hashed at once by checksum
+    checksum_chunk = 1 << 20
+
+    def __init__(self, keys, offsets, codes, coords, columns, vocab, checksum=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.codes = codes
+        self.coords = coords
+        self.columns = columns
+        self.vocab = vocab
+        self.is_patch = 'patch_name' in columns
+        self._checksum = checksum
+
+    @classmethod
+    def from_dict(cls, meta):
+        """
+        Build the columnar meta data from the dictionary stored in meta.pkl
+        Input:
+            meta (dict): Index key -> list of mosaic meta data
+        Output:
+            store (ColumnarMeta): The in-memory columnar meta data
+        """
+        keys = sorted(meta.keys())
+        entries = [entry for key in keys for entry in meta[key]]
+        counts = np.array([len(meta[key]) for key in keys], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        is_patch = len(entries) > 0 and 'patch_name' in entries[0]
+        names = PATCH_COLUMNS if is_patch else SLIDE_COLUMNS
+        codes = [entry['dense_binarized'] for entry in entries]
+        if len(codes) > 0 and isinstance(codes[0], str):
+            codes = pack_codes(codes)
+        else:
+            codes = np.stack([pack_codes(code) for code in codes]) if len(codes) > 0 \
+                else np.zeros((0, 128), dtype=np.uint8)
+
+        coords = {}
+        if not is_patch:
+            for name in COORD_COLUMNS:
+                coords[name] = np.array([entry[name] for entry in entries], dtype=np.int32)
+
+        columns = {}
+        vocab = {}
+        for name in names:
+            columns[name], vocab[name] = encode_column([entry[name] for entry in entries])
+        if not is_patch:
+            columns[PATIENT_COLUMN], vocab[PATIENT_COLUMN] = encode_patients(columns['slide_name'],
+                                                                             vocab['slide_name'])
+        return cls(np.array([int(key) for key in keys], dtype=np.int64), offsets,
+                   codes, coords, columns, vocab)
+
+    @classmethod
+    def concat(cls, stores):
+        """
+        Merge several stores into one. The mosaics of a key found in several stores
+        are kept in the order of the stores.
+        Input:
+            stores (list): The ColumnarMeta stores to merge
+        Output:
+            store (ColumnarMeta): The in-memory merged store
+        """
+        row_keys = np.concatenate([np.repeat(np.asarray(store.keys), np.diff(store.offsets))
+                                   for store in stores])
+        order = np.argsort(row_keys, kind='stable')
+        keys, counts = np.unique(row_keys[order], return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        codes = np.concatenate([np.asarray(store.codes) for store in stores])[order]
+        coords = {name: np.concatenate([np.asarray(store.coords[name]) for store in stores])[order]
+                  for name in stores[0].coords}
+
+        columns = {}
+        vocab = {}
+        for name in stores[0].columns:
+            # Map the ids of each store into the merged vocabulary
+            merged = {}
+            ids = []
+            for store in stores:
+                remap = np.array([merged.setdefault(value, len(merged)) for value in store.vocab[name]],
+                                 dtype=np.int32)
+                ids.append(remap[np.asarray(store.columns[name])])
+            columns[name] = np.concatenate(ids)[order]
+            vocab[name] = list(merged.keys())
+        return cls(keys.astype(np.int64), offsets, codes, coords, columns, vocab)
+
+    @classmethod
+    def open(cls, store_path, mmap_mode='r'):
+        """
+        Open a columnar meta store written by save
+        Input:
+            store_path (str): The directory of the store
+            mmap_mode (str): Memory-map mode passed to np.load, None loads the arrays in memory
+        Output:
+            store (ColumnarMeta): The memory mapped columnar meta data
+        """
+        with open(os.path.join(store_path, 'header.json'), 'r') as handle:
+            header = json.load(handle)
+        if header['version'] == FORMAT_VERSION:
+            with open(os.path.join(store_path, 'vocab.json'), 'r') as handle:
+                vocab = json.load(handle)
+        elif header['version'] == 1:
+            # Stores written before the vocabularies were stored as JSON
+            with open(os.path.join(store_path, 'vocab.pkl'), 'rb') as handle:
+                vocab = pickle.load(handle)
+        else:
+            raise ValueError("Unsupported columnar meta version {} in {}"
+                             .format(header['version'], store_path))
+
+        def load(name):
+            return np.load(os.path.join(store_path, name + '.npy'), mmap_mode=mmap_mode)
+
+        coords = {name: load(name) for name in header['coords']}
+        columns = {name: load(name) for name in header['columns']}
+        if 'slide_name' in columns and PATIENT_COLUMN not in columns:
+            # Stores written before the patient column existed
+            columns[PATIENT_COLUMN], vocab[PATIENT_COLUMN] = encode_patients(columns['slide_name'],
+                                                                             vocab['slide_name'])
+        return cls(load('keys'), load('offsets'), load('codes'), coords, columns, vocab,
+                   checksum=header.get('checksum'))
+
+    def save(self, store_path):
+        """
+        Write the store into a directory, see the module docstring for the layout
+        """
+        os.makedirs(store_path, exist_ok=True)
+        arrays = {'keys': self.keys, 'offsets': self.offsets, 'codes': self.codes}
+        arrays.update(self.coords)
+        arrays.update(self.columns)
+        for name, array in arrays.items():
+            np.save(os.path.join(store_path, name + '.npy'), np.ascontiguousarray(array))
+        self.save_header(store_path)
+
+    def save_header(self, store_path):
+        """
+        Write the vocabularies and the header of a store whose arrays are already written
+        (e.g., streamed into the .npy files by build_journal.py)
+        """
+        with open(os.path.join(store_path, 'vocab.json'), 'w') as handle:
+            json.dump({name: list(values) for name, values in self.vocab.items()}, handle)
+        header = {'version': FORMAT_VERSION, 'num_keys': len(self.keys),
+                  'num_entries': len(self.codes), 'coords': list(self.coords.keys()),
+                  'columns': list(self.columns.keys()), 'checksum': self.checksum()}
+        with open(os.path.join(store_path, 'header.json'), 'w') as handle:
+            json.dump(header, handle)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def checksum(self):
+        """
+        SHA-1 of the content of the store, which identifies the version of a database
+        (e.g., in the keys of query_cache.QueryCache). Stores written by save carry it in
+        their header, otherwise it is computed once on first use.
+        """
+        if self._checksum is None:
+            digest = hashlib.sha1()
+            arrays = [('keys', self.keys), ('offsets', self.offsets), ('codes', self.codes)]
+            arrays.extend(sorted(self.coords.items()))
+            arrays.extend((name, array) for name, array in sorted(self.columns.items())
+                          if name != PATIENT_COLUMN)
+            for name, array in arrays:
+                digest.update("{}:{}:{}".format(name, array.dtype.str, array.shape).encode('ascii'))
+                for start in range(0, len(array), self.checksum_chunk):
+                    digest.update(np.ascontiguousarray(array[start:start + self.checksum_chunk]))
+            digest.update(pickle.dumps({name: values for name, values in self.vocab.items()
+                                        if name != PATIENT_COLUMN}, protocol=4))
+            self._checksum = digest.hexdigest()
+        return self._checksum
+
+    def select(self, keep):
+        """
+        Keep a subset of the mosaics, e.g., to delete slides from a database
+        Input:
+            keep (np.array): Boolean mask over the rows of the store
+        Output:
+            store (ColumnarMeta): The in-memory store of the kept rows, keys without
+            any kept mosaic are removed
+        """
+        row_keys = np.repeat(np.asarray(self.keys), np.diff(self.offsets))[keep]
+        keys, counts = np.unique(row_keys, return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        coords = {name: np.asarray(column)[keep] for name, column in self.coords.items()}
+        columns = {name: np.asarray(column)[keep] for name, column in self.columns.items()}
+        return ColumnarMeta(keys.astype(np.int64), offsets, np.asarray(self.codes)[keep],
+                            coords, columns, dict(self.vocab))
+
+    def slide_rows(self, slide_names):
+        """
+        Boolean mask of the rows that belong to the given slides
+        """
+        slide_names = set(slide_names)
+        ids = [i for i, name in enumerate(self.vocab['slide_name']) if name in slide_names]
+        return np.isin(self.columns['slide_name'], ids)
+
+    def rows(self, positions):
+        """
+        Expand key positions into the rows of their mosaics
+        Input:
+            positions (np.array): Positions into self.keys
+        Output:
+            rows (np.array): The rows of all mosaics of the given keys, key after key
+            counts (np.array): The number of mosaics of each key
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = np.asarray(self.offsets[positions])
+        counts = np.asarray(self.offsets[positions + 1]) - starts
+        segment_starts = np.cumsum(counts) - counts
+        rows = np.repeat(starts - segment_starts, counts) + np.arange(counts.sum(), dtype=np.int64)
+        return rows, counts
+
+    def entry(self, row):
+        """
+        Decode one mosaic into the dictionary format of meta.pkl
+        """
+        entry = {name: self.vocab[name][self.columns[name][row]] for name in self.columns
+                 if name != PATIENT_COLUMN}
+        for name in self.coords:
+            entry[name] = int(self.coords[name][row])
+        entry['dense_binarized'] = np.array(self.codes[row])
+        return entry
+
+    def to_dict(self):
+        """
+        Convert the store back into the dictionary format of meta.pkl
+        """
+        meta = {}
+        for pos, key in enumerate(self.keys.tolist()):
+            meta[key] = [self.entry(row) for row in range(self.offsets[pos], self.offsets[pos + 1])]
+        return meta
+
+
+def encode_column(values):
+    """
+    Dictionary encode a column
+    Input:
+        values (list): The value of each row
+    Output:
+        ids (np.array): int32 id of each row
+        vocab (list): The distinct values, vocab[ids[i]] == values[i]
+    """
+    lookup = {}
+    ids = np.empty(len(values), dtype=np.int32)
+    for row, value in enumerate(values):
+        if value not in lookup:
+            lookup[value] = len(lookup)
+        ids[row] = lookup[value]
+    return ids, list(lookup.keys())
+
+
+def patient_of(slide_name):
+    """
+    The patient id used in leave-one-patient-out evaluation, i.e., the third field
+    of a TCGA barcode. Slides named differently are their own patient.
+    """
+    fields = slide_name.split("-")
+    return fields[2] if len(fields) > 2 else slide_name
+
+
+def encode_patients(slide_ids, slide_vocab):
+    """
+    Dictionary encode the patient of each row from its dictionary encoded slide name,
+    so the slide names are only split once per slide
+    Input:
+        slide_ids (np.array): The slide_name id of each row
+        slide_vocab (list): The slide names
+    Output:
+        ids (np.array): int32 patient id of each row
+        vocab (list): The distinct patient ids
+    """
+    slide_patient, vocab = encode_column([patient_of(name) for name in slide_vocab])
+    return slide_patient[np.asarray(slide_ids)], vocab
+
+
+def load_columnar_meta(index_meta_path):
+    """
+    Load the index meta as a ColumnarMeta, either by memory mapping a columnar store
+    directory or by converting a meta.pkl file in memory
+    Input:
+        index_meta_path (str): The path to a columnar store or to meta.pkl
+    Output:
+        store (ColumnarMeta): The columnar meta data
+    """
+    if os.path.isdir(index_meta_path):
+        return ColumnarMeta.open(index_meta_path)
+    with open(index_meta_path, 'rb') as handle:
+        meta = pickle.load(handle)
+    return ColumnarMeta.from_dict(meta)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert meta.pkl into a columnar meta store")
+    parser.add_argument("--index_meta_path", type=str, required=True,
+                        help="Path to the meta data of each index (meta.pkl)")
+    parser.add_argument("--save_path", type=str, default=None,
+                        help="Directory of the columnar store, defaults to index_meta/columnar")
+    args = parser.parse_args()
+
+    save_path = args.save_path
+    if save_path is None:
+        save_path = os.path.join(os.path.dirname(args.index_meta_path), 'columnar')
+    store = load_columnar_meta(args.index_meta_path)
+    store.save(save_path)
+    print("Wrote {} keys and {} mosaics to {}".format(len(store.keys), len(store.codes), save_path))
@@ -0,0 +1,62 @@
+"""
+Conversion of VQ-VAE latent codes into the integer index of a mosaic (m_{i}), vectorized over
+all mosaics of a slide. The semantic codebook is applied through a lookup array and the three
+2 x 2 average pooling levels are computed with reshape-and-mean in NumPy.
+"""
+import numpy as np
+
+# Weight of the sum of each pooling level (level 0 is the latent itself and is not used)
+LEVEL_POWER = [0, 0, 1e6, 1e11]
+
+
+def semantic_lookup(codebook_semantic):
+    """
+    Turn the semantic codebook into an array that maps old codewords to the new ones
+    Input:
+        codebook_semantic (dict, torch.Tensor or np.array): The re-ordered semantic codebook
+    Output:
+        lookup (np.array): lookup[old codeword] = new codeword
+    """
+    if isinstance(codebook_semantic, dict):
+        lookup = np.zeros(max(int(k) for k in codebook_semantic.keys()) + 1, dtype=np.int64)
+        for old, new in codebook_semantic.items():
+            lookup[int(old)] = int(new)
+        return lookup
+    return np.asarray(codebook_semantic)
+
+
+def _avg_pool(feat):
+    """
+    2 x 2 average pooling of N x H x W codes. Integer codes are floor divided as
+    torch.nn.AvgPool2d does for integer tensors.
+    """
+    n, h, w = feat.shape
+    blocks = feat[:, :h // 2 * 2, :w // 2 * 2].reshape(n, h // 2, 2, w // 2, 2)
+    if np.issubdtype(feat.dtype, np.integer):
+        return blocks.sum(axis=(2, 4)) // 4
+    return blocks.sum(axis=(2, 4)) / 4
+
+
+def latents_to_indices(latents, lookup):
+    """
+    Convert the latent codes of many mosaics into their integer indices
+    Input:
+        latents (N x 64 x 64 np.array): Latent codes from the VQ-VAE encoder
+        lookup (np.array): The semantic codebook as returned by semantic_lookup
+    Output:
+        indices (np.array): int64 index of each mosaic
+    """
+    latents = np.asarray(latents)
+    feat = lookup[latents].astype(latents.dtype)
+
+    mosaic_index = None
+    for level, power in enumerate(LEVEL_POWER):
+        if level == 0:
+            continue
+        feat = _avg_pool(feat)
+        level_sum = feat.sum(axis=(1, 2)).astype(float)
+        if level == 1:
+            mosaic_index = level_sum
+        else:
+            mosaic_index += level_sum * power
+    return mosaic_index.astype(np.int64)
@@ -0,0 +1,128 @@
+"""
+Cache of the keys accepted in the search windows of a mosaic before leave-one-patient-out is
+applied, from which HistoDatabase replays the search for any held-out patient. Entries are kept in
+an in-memory LRU and, optionally, as one pickle per entry on disk so that they survive restarts
+and are shared by the workers of main_search. The cache key is built by
+HistoDatabase from the mosaic index, its texture code, the search parameters and the checksum of
+the database, so a rebuilt database never serves stale results.
+"""
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """
+    In-memory LRU with an optional on-disk store
+    Attributes:
+        max_entries (int): The number of entries kept in memory
+        cache_dir (str): The directory of the on-disk store, None keeps the cache in memory only
+        hits (int): The number of lookups answered from memory or disk
+        misses (int): The number of lookups that had to be searched
+        disk_entries (int): The number of entries in the on-disk store
+        disk_bytes (int): The size of the on-disk store in bytes
+    """
+
+    def __init__(self, max_entries=100000, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.disk_entries = 0
+        self.disk_bytes = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Counted once, then kept up to date by put
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if name.endswith('.pkl'):
+                        self.disk_entries += 1
+                        self.disk_bytes += os.path.getsize(os.path.join(root, name))
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Hash the parts of a cache key (ints, strings and bytes) into a hex digest
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = repr(part).encode('ascii')
+            digest.update(len(part).to_bytes(8, 'little'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        # Two levels of sub-directories keep the number of files per directory small
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key + '.pkl')
+
+    def get(self, key):
+        """
+        Look up an entry, None if it is not cached
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as handle:
+                    value = pickle.load(handle)
+                self._remember(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Store an entry in memory and, if enabled, on disk
+        """
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so concurrent workers never read a partial entry
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'wb') as handle:
+                pickle.dump(value, handle)
+            size = os.path.getsize(tmp_path)
+            if os.path.exists(path):
+                self.disk_bytes -= os.path.getsize(path)
+            else:
+                self.disk_entries += 1
+            os.replace(tmp_path, path)
+            self.disk_bytes += size
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop the in-memory entries and reset the counters, the on-disk store is kept
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def stats(self):
+        """
+        The disk counts include the entries found when the cache was opened and those written
+        by this process since, not those written by other processes in the meantime
+        Output:
+            stats (dict): Hits, misses, hit rate and the size of the memory and disk stores
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'memory_entries': len(self.entries), 'disk_entries': self.disk_entries,
+                'disk_bytes': self.disk_bytes}
@@ -0,0 +1,417 @@
+"""
+Long-running HTTP query service. The databases of one or more sites are opened once in a pool of
+worker processes and queried with JSON requests:
+    POST /query/slide   {"site", "latent_path" [, "densefeat_path"]} or {"site", "latents", "dense_feats"}
+    POST /query/mosaic  {"site", "latent" or "index", "dense_feat"}
+    GET  /health        the sites and the number of workers
+    GET  /metrics       request, batch and latency statistics
+Both queries accept an optional "patient_id" that is left out of the search (leave-one-patient-out)
+and "params" overriding the search parameters (pre_step, succ_step, C, T, thrsh). A slide query
+returns one result list per mosaic and a mosaic query a single result list, in the format of
+HistoDatabase.postprocessing. Mosaic queries that arrive together are batched into one search.
+Slide queries by path are only accepted for files under the --data_root of the server, since the
+densenet pkl of a slide is unpickled. A texture feature is a '0'/'1' string or a list of 1024 bits
+or 128 packed bytes. A query that is not answered within --query_timeout seconds fails with 504.
+Run with
+    python query_server.py --site brain=./DATABASES/brain/snapshot --site lung=./DATABASES/lung/snapshot
+"""
+import argparse
+import json
+import os
+import pickle
+import queue
+import threading
+import time
+import traceback
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import h5py
+import numpy as np
+import torch
+from database import HistoDatabase
+from mosaic_index import semantic_lookup, latents_to_indices
+from texture_codes import pack_codes, CODE_BITS
+
+SEARCH_PARAMS = ['pre_step', 'succ_step', 'C', 'T', 'thrsh']
+
+# Seconds warm_up waits for all workers to open the databases
+WARM_UP_TIMEOUT = 3600
+
+# Seconds a request waits for its search results by default
+QUERY_TIMEOUT = 600
+
+# The databases of a worker process, site -> HistoDatabase
+_worker_dbs = None
+_worker_barrier = None
+
+
+def _init_worker(site_args, barrier):
+    global _worker_dbs, _worker_barrier
+    _worker_dbs = {site: HistoDatabase(**args) for site, args in site_args.items()}
+    _worker_barrier = barrier
+
+
+def _warm_up_task():
+    """
+    Block until one of these tasks runs in every worker, so every worker ran _init_worker
+    """
+    _worker_barrier.wait(WARM_UP_TIMEOUT)
+    return os.getpid()
+
+
+def _query_task(site, patient_id, indices, dense_feats, params):
+    """
+    Search mosaic indices in a worker process
+    """
+    db = _worker_dbs[site]
+    db.leave_one_patient(patient_id)
+    return db.query_indices(indices, dense_feats, **params)
+
+
+def _query_slide_task(site, patient_id, latent_path, densefeat_path, params):
+    """
+    Search all mosaics of a slide stored as latent h5 + densenet pkl in a worker process
+    """
+    with h5py.File(latent_path, 'r') as hf:
+        latents = hf['features'][:]
+    with open(densefeat_path, 'rb') as handle:
+        dense_feats = pickle.load(handle)
+    db = _worker_dbs[site]
+    return _query_task(site, patient_id, db.slides_to_indices(latents), dense_feats, params)
+
+
+def _to_json(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Cannot serialize {}".format(type(value)))
+
+
+class QueryService(object):
+    """
+    The worker pool, the batching of mosaic queries and the metrics of the server
+    Attributes:
+        sites (dict): Site -> index meta path of its database (snapshot, columnar store or meta.pkl)
+        data_root (str): The directory slide queries by path may read from, None to only
+        accept slides sent as arrays
+        workers (int): The number of worker processes
+        batch_size (int): The maximum number of mosaics searched in one batch
+        batch_wait (float): Seconds a mosaic query waits for others to share its batch
+        query_timeout (float): Seconds a request waits for its search results
+    """
+
+    def __init__(self, sites, codebook_semantic, workers=4, batch_size=64, batch_wait=0.005,
+                 is_patch=False, index_engine='sorted', data_root=None, query_timeout=QUERY_TIMEOUT):
+        self.sites = dict(sites)
+        self.data_root = os.path.realpath(data_root) if data_root is not None else None
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.query_timeout = query_timeout
+        self.semantic_lookup = semantic_lookup(torch.load(codebook_semantic))
+
+        site_args = {site: {'database_index_path': None, 'index_meta_path': path,
+                            'codebook_semantic': codebook_semantic, 'is_patch': is_patch,
+                            'index_engine': index_engine}
+                     for site, path in self.sites.items()}
+        # Spawned workers open the memory mapped databases themselves, forking a threaded server is unsafe
+        ctx = mp.get_context('spawn')
+        self.executor = ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker,
+                                            initargs=(site_args, ctx.Barrier(workers)))
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'slide_requests': 0, 'mosaic_requests': 0, 'mosaics': 0,
+                         'batches': 0, 'batched_mosaics': 0, 'errors': 0}
+        self.latencies = deque(maxlen=10000)
+
+        self.pending = queue.Queue()
+        self.batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        self.batcher.start()
+
+    def warm_up(self):
+        """
+        Start all workers and wait until every one of them has opened the databases.
+        The tasks wait for each other on a barrier, so each one runs in a different worker.
+        """
+        futures = [self.executor.submit(_warm_up_task) for _ in range(self.workers)]
+        pids = set(future.result() for future in futures)
+        if len(pids) != self.workers:
+            raise RuntimeError("Only {} of {} workers started".format(len(pids), self.workers))
+
+    def _search_params(self, params):
+        params = dict(params or {})
+        unknown = set(params) - set(SEARCH_PARAMS)
+        if len(unknown) > 0:
+            raise ValueError("Unknown search parameters {}".format(sorted(unknown)))
+        return {name: int(value) for name, value in params.items()}
+
+    def _check_site(self, site):
+        if site not in self.sites:
+            raise ValueError("Unknown site {}, the server holds {}".format(site, sorted(self.sites)))
+
+    def _data_path(self, path):
+        """
+        Resolve a path sent by a client, it has to lie under data_root
+        """
+        if self.data_root is None:
+            raise ValueError("The server has no --data_root, send the latents and dense_feats instead of paths")
+        resolved = os.path.realpath(os.path.join(self.data_root, path))
+        if os.path.commonpath([resolved, self.data_root]) != self.data_root:
+            raise ValueError("{} is outside of the data root of the server".format(path))
+        return resolved
+
+    def _record(self, counter, count, t_start):
+        with self.lock:
+            self.counters[counter] += 1
+            self.counters['mosaics'] += count
+            self.latencies.append(time.time() - t_start)
+
+    def query_slide(self, site, latents=None, dense_feats=None, latent_path=None,
+                    densefeat_path=None, patient_id=None, params=None):
+        """
+        Search all mosaics of a slide, given either as arrays or as the paths of its
+        latent h5 and densenet pkl (by default next to the h5 as in search_adapter),
+        relative to data_root or absolute paths under it
+        Output:
+            results (list): The sorted results of each mosaic
+        """
+        t_start = time.time()
+        self._check_site(site)
+        params = self._search_params(params)
+        if latent_path is not None:
+            if densefeat_path is None:
+                densefeat_path = latent_path.replace("vqvae", "densenet").replace(".h5", ".pkl")
+            latent_path = self._data_path(latent_path)
+            densefeat_path = self._data_path(densefeat_path)
+            future = self.executor.submit(_query_slide_task, site, patient_id,
+                                          latent_path, densefeat_path, params)
+        else:
+            indices = latents_to_indices(np.asarray(latents), self.semantic_lookup)
+            future = self.executor.submit(_query_task, site, patient_id, indices,
+                                          self._pack(dense_feats), params)
+        results = future.result(self.query_timeout)
+        self._record('slide_requests', len(results), t_start)
+        return results
+
+    def query_mosaic(self, site, dense_feat, latent=None, index=None, patient_id=None, params=None):
+        """
+        Search one mosaic, given by its latent code or its integer index. Mosaic queries
+        with the same site, patient and parameters are batched.
+        Output:
+            results (list): The sorted results of the mosaic
+        """
+        t_start = time.time()
+        self._check_site(site)
+        params = self._search_params(params)
+        if index is None:
+            index = latents_to_indices(np.asarray(latent)[None], self.semantic_lookup)[0]
+        dense_feat = self._pack([dense_feat])[0]
+        future = Future()
+        self.pending.put(((site, patient_id, tuple(sorted(params.items()))),
+                          int(index), dense_feat, future))
+        results = future.result(self.query_timeout)
+        self._record('mosaic_requests', 1, t_start)
+        return results
+
+    @staticmethod
+    def _pack(dense_feats):
+        """
+        Texture features as '0'/'1' strings of CODE_BITS characters or as lists of
+        CODE_BITS bits or CODE_BITS / 8 packed bytes, anything else raises a ValueError
+        """
+        dense_feats = list(dense_feats)
+        if len(dense_feats) > 0 and all(isinstance(code, str) for code in dense_feats):
+            if any(len(code) != CODE_BITS or code.strip('01') != '' for code in dense_feats):
+                raise ValueError("A texture feature string needs {} '0'/'1' characters".format(CODE_BITS))
+            return pack_codes(dense_feats)
+        codes = np.asarray(dense_feats)
+        if len(codes) == 0:
+            return pack_codes([])
+        if codes.ndim != 2 or codes.dtype.kind not in 'biu' or codes.shape[1] not in (CODE_BITS, CODE_BITS // 8):
+            raise ValueError("A texture feature needs {} bits or {} packed bytes".format(CODE_BITS, CODE_BITS // 8))
+        if codes.shape[1] == CODE_BITS:
+            if np.any((codes != 0) & (codes != 1)):
+                raise ValueError("The bits of a texture feature have to be 0 or 1")
+            return pack_codes(codes.astype(bool))
+        if np.any((codes < 0) | (codes > 255)):
+            raise ValueError("The packed bytes of a texture feature have to be in [0, 255]")
+        return codes.astype(np.uint8)
+
+    def _batch_loop(self):
+        """
+        Collect the pending mosaic queries for up to batch_wait seconds and search
+        the queries that share a site, a patient and parameters together
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.pending.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+
+            groups = {}
+            for group, index, dense_feat, future in batch:
+                groups.setdefault(group, []).append((index, dense_feat, future))
+            for (site, patient_id, params), items in groups.items():
+                futures = [future for _, _, future in items]
+                # A failing group fails its own requests, the batcher keeps serving the others
+                try:
+                    indices = np.array([index for index, _, _ in items], dtype=np.int64)
+                    dense_feats = np.stack([dense_feat for _, dense_feat, _ in items])
+                    task = self.executor.submit(_query_task, site, patient_id, indices,
+                                                dense_feats, dict(params))
+                except Exception as error:
+                    for future in futures:
+                        future.set_exception(error)
+                    continue
+                with self.lock:
+                    self.counters['batches'] += 1
+                    self.counters['batched_mosaics'] += len(items)
+                task.add_done_callback(lambda task, futures=futures: self._dispatch(task, futures))
+
+    @staticmethod
+    def _dispatch(task, futures):
+        error = task.exception()
+        for position, future in enumerate(futures):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(task.result()[position])
+
+    def health(self):
+        return {'status': 'ok', 'sites': sorted(self.sites), 'workers': self.workers}
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.counters)
+            latencies = np.array(self.latencies)
+        metrics['uptime'] = time.time() - self.started
+        metrics['mean_batch_size'] = metrics['batched_mosaics'] / max(metrics['batches'], 1)
+        if len(latencies) > 0:
+            metrics['latency_mean'] = float(latencies.mean())
+            metrics['latency_p50'] = float(np.percentile(latencies, 50))
+            metrics['latency_p95'] = float(np.percentile(latencies, 95))
+        return metrics
+
+    def close(self):
+        self.pending.put(None)
+        self.executor.shutdown()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    The JSON endpoints of the server, see the module docstring
+    """
+    service = None
+
+    def _send(self, status, body):
+        payload = json.dumps(body, default=_to_json).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, self.service.health())
+        elif self.path == '/metrics':
+            self._send(200, self.service.metrics())
+        else:
+            self._send(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            common = {'patient_id': request.get('patient_id'), 'params': request.get('params')}
+            if self.path == '/query/slide':
+                results = self.service.query_slide(request['site'], latents=request.get('latents'),
+                                                   dense_feats=request.get('dense_feats'),
+                                                   latent_path=request.get('latent_path'),
+                                                   densefeat_path=request.get('densefeat_path'),
+                                                   **common)
+            elif self.path == '/query/mosaic':
+                results = self.service.query_mosaic(request['site'], request['dense_feat'],
+                                                    latent=request.get('latent'),
+                                                    index=request.get('index'), **common)
+            else:
+                self._send(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+                return
+        except (KeyError, ValueError, TypeError) as error:
+            with self.service.lock:
+                self.service.counters['errors'] += 1
+            self._send(400, {'error': repr(error)})
+            return
+        except FutureTimeoutError:
+            with self.service.lock:
+                self.service.counters['errors'] += 1
+            self._send(504, {'error': 'No results within {} seconds'.format(self.service.query_timeout)})
+            return
+        except Exception:
+            with self.service.lock:
+                self.service.counters['errors'] += 1
+            self._send(500, {'error': traceback.format_exc()})
+            return
+        self._send(200, {'results': results})
+
+    def log_message(self, format, *args):
+        # The metrics endpoint replaces the per-request log lines
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve SISH queries over HTTP")
+    parser.add_argument("--site", type=str, action='append', required=True,
+                        help="SITE=INDEX_META_PATH of a database to serve, can be repeated")
+    parser.add_argument("--codebook_semantic", type=str, default="./checkpoints/codebook_semantic.pt",
+                        help="Path to the semantic codebook from vq-vae")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of worker processes that search the databases")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Maximum number of mosaic queries searched together")
+    parser.add_argument("--batch_wait", type=float, default=0.005,
+                        help="Seconds a mosaic query waits for others to share its batch")
+    parser.add_argument("--is_patch", action='store_true',
+                        help="Serve patch databases")
+    parser.add_argument("--data_root", type=str, default=None,
+                        help="Directory of the latent h5 and densenet pkl files that slide queries may "
+                             "name by path, without it slides are only accepted as arrays")
+    parser.add_argument("--query_timeout", type=float, default=QUERY_TIMEOUT,
+                        help="Seconds a request waits for its search results before failing with 504")
+    args = parser.parse_args()
+
+    sites = dict(site.split("=", 1) for site in args.site)
+    service = QueryService(sites, args.codebook_semantic, workers=args.workers,
+                           batch_size=args.batch_size, batch_wait=args.batch_wait,
+                           is_patch=args.is_patch, data_root=args.data_root,
+                           query_timeout=args.query_timeout)
+    print("Opening the databases of {} in {} workers...".format(sorted(sites), args.workers), flush=True)
+    service.warm_up()
+    QueryHandler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    print("Serving on http://{}:{}".format(args.host, args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
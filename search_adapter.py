@@ -44,8 +44,9 @@ def run_query(site: str, latent_path: str, db: HistoDatabase, speed_record_path:
     # Remove the current patient from the database for leave-one-patient out evaluation
     # Implement your own to fit your own to fit your data.
     if not slide_id.startswith('TCGA'):
-        # Implementation of your own leave-one out strategy to fit your data
-        pass
+        # Implementation of your own leave-one out strategy to fit your data.
+        # Until then the whole database is searched, never the patient held out for a previous slide
+        db.leave_one_patient(None)
     else:
         # Leave-one-patient out in TCGA cohort
         patient_id = slide_id.split("-")[2]
@@ -60,15 +61,8 @@ def run_query(site: str, latent_path: str, db: HistoDatabase, speed_record_path:
 
     # Query
     t_start = time.time()
-    temp_results = []
-
-    i = 0
-    for idx, patch_latent in enumerate(feat):
-        if i % 10 == 0:
-            print(f"Processed {i} patches...", flush=True)
-        res = db.query(patch_latent, densefeat[idx])
-        temp_results.append(res)
-        i += 1
+    temp_results = db.query_batch(feat, densefeat)
+    print(f"Processed {len(temp_results)} patches", flush=True)
 
     # Write speed recording
     t_elapse = time.time() - t_start
@@ -127,6 +121,10 @@ def individual_search(database: HistoDatabase, site: str, latent_path: str) -> N
     min_10_hamming_dist = sorted_accumulated_results[:10]
     print(f"Min 10 hamming dist by slides: {min_10_hamming_dist}")
 
+    cache_stats = database.cache_stats()
+    if cache_stats is not None:
+        print(f"Query cache: {cache_stats}")
+
     # Save results
     print("Writing results to results.pkl...")
     with open(os.path.join(save_path, "results.pkl"), 'wb') as handle:
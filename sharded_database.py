@@ -0,0 +1,269 @@
+"""
+A database split into shards, e.g., one database per anatomic site for the organ search or
+the key ranges of a database that does not fit into the memory of one process. Every shard
+is a HistoDatabase opened in its own worker process, a query is sent to all shards at once and
+the keys in the windows of each mosaic are merged across the shards, so the walks over the merged
+windows give the results of a single database holding all shards.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import traceback
+import numpy as np
+import torch
+from database import HistoDatabase
+from meta_store import load_columnar_meta
+from mosaic_index import semantic_lookup, latents_to_indices
+
+
+def _shard_worker(conn, db_args):
+    """
+    Serve the calls of ShardedHistoDatabase on one shard until None is received
+    """
+    try:
+        db = HistoDatabase(**db_args)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ready', None))
+    while True:
+        call = conn.recv()
+        if call is None:
+            break
+        name, args, kwargs = call
+        try:
+            conn.send(('ok', getattr(db, name)(*args, **kwargs)))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class ShardedHistoDatabase(object):
+    """
+    The FISH database split into shards that are searched in parallel
+    Attributes:
+        shard_paths (list): The index meta path of each shard (see HistoDatabase)
+        is_patch (bool): Whether the shards are patch databases
+        parallel (bool): Whether each shard is searched in its own worker process
+    """
+
+    def __init__(self, shard_paths, codebook_semantic, is_patch=False,
+                 index_engine='sorted', parallel=True):
+        """
+        The initializer for ShardedHistoDatabase
+        Input:
+            shard_paths (list): The index meta path of each shard, i.e., a snapshot,
+            a columnar meta store or a meta.pkl
+            codebook_semantic (str): The path to the semantic codebook from vq-vae encoder,
+            shared by all shards
+            is_patch (bool): Whether to use patch only mode (for patch only database)
+            index_engine (str): The index engine of the shards, only 'sorted' is supported
+            since the shards have no VEB tree of their own
+            parallel (bool): Whether to open each shard in a worker process, otherwise
+            the shards are opened and searched one after the other in this process
+        Output: None
+        """
+        if index_engine != 'sorted':
+            raise NotImplementedError("Shards only support the sorted index engine")
+        self.shard_paths = list(shard_paths)
+        self.is_patch = is_patch
+        self.parallel = parallel
+        self.codebook_semantic = torch.load(codebook_semantic)
+        self.semantic_lookup = semantic_lookup(self.codebook_semantic)
+
+        shard_args = [{'database_index_path': None, 'index_meta_path': path,
+                       'codebook_semantic': codebook_semantic, 'is_patch': is_patch,
+                       'index_engine': index_engine}
+                      for path in self.shard_paths]
+        self.shards = []
+        self.workers = []
+        if not self.parallel:
+            self.shards = [HistoDatabase(**args) for args in shard_args]
+            return
+
+        # The shards are opened concurrently, each worker only maps the pages of its own shard
+        ctx = mp.get_context('spawn')
+        for args in shard_args:
+            conn, worker_conn = ctx.Pipe()
+            worker = ctx.Process(target=_shard_worker, args=(worker_conn, args), daemon=True)
+            worker.start()
+            self.workers.append((worker, conn))
+        for path, (_, conn) in zip(self.shard_paths, self.workers):
+            status, message = conn.recv()
+            if status == 'error':
+                self.close()
+                raise RuntimeError("Failed to open shard {}:\n{}".format(path, message))
+
+    def _call(self, name, *args, **kwargs):
+        """
+        Call a HistoDatabase method on every shard
+        Output:
+            results (list): The return value of each shard, in shard order
+        """
+        if not self.parallel:
+            return [getattr(shard, name)(*args, **kwargs) for shard in self.shards]
+        for _, conn in self.workers:
+            conn.send((name, args, kwargs))
+        results = []
+        errors = []
+        for path, (_, conn) in zip(self.shard_paths, self.workers):
+            status, value = conn.recv()
+            if status == 'error':
+                errors.append("Shard {}:\n{}".format(path, value))
+            results.append(value)
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+        return results
+
+    # The seeds and the sorted result dictionaries are the same as those of a single database
+    _seed_index = HistoDatabase._seed_index
+    postprocessing = HistoDatabase.postprocessing
+
+    @staticmethod
+    def _merge(seeds, shard_candidates, pre_step, succ_step, thrsh):
+        """
+        Merge the window candidates of a mosaic from all shards and walk the merged windows.
+        Every shard holds the pre_step/succ_step keys closest to each seed among its own keys,
+        so the windows of the merged keys are those of a single database holding all shards.
+        A key held by several shards keeps its closest mosaic, from the first shard on ties.
+        Input:
+            seeds (np.array): The seeds of the mosaic
+            shard_candidates (list): The window candidates of the mosaic from each shard,
+            see HistoDatabase.window_candidates
+            (see HistoDatabase.query for the search parameters)
+        Output:
+            res (list): The result tuples of the mosaic, as HistoDatabase.search returns them
+        """
+        keys = np.concatenate([keys for keys, _, _ in shard_candidates])
+        dists = np.concatenate([dists for _, dists, _ in shard_candidates])
+        shard = np.concatenate([np.full(len(keys), i) for i, (keys, _, _) in enumerate(shard_candidates)])
+        # Each key points to its result tuple in the concatenated results of the shards
+        accepted = dists <= thrsh
+        result_slot = np.cumsum(accepted) - 1
+        results = [res for _, _, shard_results in shard_candidates for res in shard_results]
+
+        order = np.lexsort((shard, dists, keys))
+        keys, first = np.unique(keys[order], return_index=True)
+        dists = dists[order][first]
+        result_slot = result_slot[order][first]
+
+        found = []
+        visited = np.zeros(len(keys), dtype=bool)
+        for seed in seeds:
+            pre_end = int(np.searchsorted(keys, seed, side='left'))
+            succ_start = int(np.searchsorted(keys, seed, side='right'))
+            for walk in (np.arange(pre_end - 1, max(pre_end - pre_step, 0) - 1, -1),
+                         np.arange(succ_start, min(succ_start + succ_step, len(keys)))):
+                hits = np.flatnonzero(visited[walk])
+                if len(hits) > 0:
+                    walk = walk[:hits[0]]
+                walk = walk[dists[walk] <= thrsh]
+                visited[walk] = True
+                found.extend(result_slot[walk].tolist())
+        return [results[slot] for slot in found]
+
+    def cache_stats(self):
+        """
+        The shards have no query cache
+        """
+        return None
+
+    def leave_one_patient(self, patient_id):
+        self._call('leave_one_patient', patient_id)
+
+    def query(self, patch, dense_feat, **params):
+        """
+        Query all shards with a mosaic, see HistoDatabase.query for the parameters
+        """
+        return self.query_by_index(self.preprocessing(patch), dense_feat, **params)
+
+    def query_by_index(self, index, dense_feat, **params):
+        """
+        Query all shards with a mosaic index, see HistoDatabase.query_by_index
+        """
+        return self.query_indices([int(index)], [dense_feat], **params)[0]
+
+    def query_batch(self, latents, dense_feats, **params):
+        """
+        Query all shards with all mosaics of a slide, see HistoDatabase.query_batch.
+        The indices are computed once and sent to the shards.
+        """
+        return self.query_indices(self.slides_to_indices(latents), dense_feats, **params)
+
+    def query_indices(self, indices, dense_feats,
+                      pre_step=375, succ_step=375,
+                      C=50, T=10, thrsh=128):
+        """
+        Query all shards with many mosaic indices, see HistoDatabase.query_indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_candidates = self._call('window_candidates', indices, dense_feats,
+                                      pre_step=pre_step, succ_step=succ_step, C=C, T=T, thrsh=thrsh)
+        seed_index = self._seed_index(indices, C, T)
+        return [self.postprocessing(self._merge(seeds, mosaic_candidates, pre_step, succ_step, thrsh))
+                for seeds, mosaic_candidates in zip(seed_index, zip(*shard_candidates))]
+
+    def preprocessing(self, latent):
+        return int(self.slides_to_indices(np.expand_dims(latent, 0))[0])
+
+    def slides_to_indices(self, latents):
+        return latents_to_indices(latents, self.semantic_lookup)
+
+    def close(self):
+        """
+        Stop the worker processes of the shards
+        """
+        for worker, conn in self.workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def __del__(self):
+        self.close()
+
+    def __str__(self):
+        return "ShardedHistoDatabase with {} shards: {}".format(len(self.shard_paths), self.shard_paths)
+
+
+def split_by_key_range(index_meta_path, num_shards, save_path):
+    """
+    Split a database into shards of contiguous key ranges with about the same number of mosaics
+    Input:
+        index_meta_path (str): The path to the columnar store or meta.pkl to split
+        num_shards (int): The number of shards
+        save_path (str): The directory the shards are written to (shard_00, shard_01, ...)
+    Output:
+        shard_paths (list): The path of each shard
+    """
+    meta = load_columnar_meta(index_meta_path)
+    num_rows = int(meta.offsets[-1])
+    # Cut at key boundaries, so the mosaics of one key stay in one shard
+    cuts = np.searchsorted(meta.offsets, np.linspace(0, num_rows, num_shards + 1)[1:-1])
+    bounds = np.concatenate([[0], cuts, [len(meta.keys)]])
+    shard_paths = []
+    for shard, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        keep = np.zeros(num_rows, dtype=bool)
+        keep[meta.offsets[start]:meta.offsets[stop]] = True
+        shard_path = os.path.join(save_path, "shard_{:02d}".format(shard))
+        meta.select(keep).save(shard_path)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a database into key range shards")
+    parser.add_argument("--index_meta_path", type=str, required=True,
+                        help="Path to the meta data of each index (columnar store or meta.pkl)")
+    parser.add_argument("--num_shards", type=int, required=True,
+                        help="Number of shards")
+    parser.add_argument("--save_path", type=str, required=True,
+                        help="Directory of the shards")
+    args = parser.parse_args()
+
+    for path in split_by_key_range(args.index_meta_path, args.num_shards, args.save_path):
+        print("Wrote shard {}".format(path))
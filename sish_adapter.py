@@ -3,9 +3,13 @@ This module is meant to serve as an easy way to call a few functionalities of th
 on external drives holding the data.
 """
 
+import argparse
 import main_search
 import search_adapter
 from database import HistoDatabase
+from database_registry import DatabaseRegistry
+from query_cache import QueryCache
+from snapshot import is_snapshot
 from path_validation_duplicate import validate_dir_for_patchify
 import create_patches_fp
 import os
@@ -13,12 +17,18 @@ import re
 import shutil
 import multiprocessing as mp
 import extract_mosaic
-import artifacts_removal
 
 database: HistoDatabase = None
 database_site: str = ""
 data_path: str = ""
 
+# The databases of the sites used in this session stay open up to this many bytes
+DATABASE_MEMORY_BUDGET = 16 * 2 ** 30
+registry = DatabaseRegistry(DATABASE_MEMORY_BUDGET)
+
+# Whether repeated searches of the same mosaics are answered from DATA/QUERY_CACHE (--query_cache)
+use_query_cache: bool = False
+
 
 def main() -> None:
     global database
@@ -39,7 +49,8 @@ def main() -> None:
         elif util_choice == 'e':
             if database:
                 print("Freeing memory, this may take a little while...", flush=True)
-                del database
+                database = None
+                registry.clear()
             print("Exiting...", flush=True)
             return
         else:
@@ -111,6 +122,7 @@ def mosaic_adapter() -> None:
     # MOSAIC CREATION
     mag_dir_pattern = re.compile(r"^\d+x$")
     num_cpu = mp.cpu_count()
+    jobs = []
     for root, dirs, files in os.walk(database_path):
         new_root = root.replace('WSI', 'MOSAICS')
         os.makedirs(new_root, exist_ok=True)
@@ -128,14 +140,14 @@ def mosaic_adapter() -> None:
             os.makedirs(os.path.join(new_root, 'coord'), exist_ok=True)
             os.makedirs(os.path.join(new_root, 'coord_clean'), exist_ok=True)
 
-            print(f"\n\n\n------Starting mosaic generation for {root}------", flush=True)
-            extract_mosaic.process_slides(slide_path, patch_path, new_root, num_cpu)
+            jobs.extend(extract_mosaic.slide_jobs(slide_path, patch_path, new_root, remove_artifacts=True))
 
-    # ARTIFACT REMOVAL
-    for site in os.listdir(new_base_path):
-        path = os.path.join(new_base_path, site)
-        print(f"\n\n\n------Starting artifact removal for {path}------", flush=True)
-        artifacts_removal.process_mosaics(path.replace('MOSAICS', 'WSI'), path)
+    # The slides of all magnification directories are processed as one pipeline
+    print(f"\n\n\n------Starting mosaic generation for {len(jobs)} slides------", flush=True)
+    # The white mosaics are removed right away instead of in a second pass of artifacts_removal
+    extract_mosaic.extract_mosaics(jobs, num_cpu,
+                                   timing_csv=os.path.join(database_path, 'mosaic_timing.csv'),
+                                   remove_artifacts=True)
 
 
 def get_valid_wsi_path() -> str:
@@ -175,43 +187,63 @@ def update_database(site: str) -> None:
     if database and site == database_site:
         return
 
-    if database and site != database_site:
-        print("\nBecause you intend to query a new site, the database needs to be rebuilt")
+    first_database = len(registry.resident_sites()) == 0
+    if site in registry.resident_sites():
+        print(f"\nSwitching to the loaded database of {site}")
+    else:
+        print("Building site specific database... \n(This will only need to run once if you intend "
+              "to continue querying the same site. As long as you do not "
+              "exit the program, the database will stay loaded for your next queries.)", flush=True)
+    database = registry.get(site, **database_args(site))
 
-    db_index_path, index_meta_path, codebook_semantic = update_data_paths(site)
+    # Open the databases of the other sites in the background, so switching to them is instant
+    if first_database:
+        other_sites = [name for name in sorted(os.listdir(data_path + "DATABASES"))
+                       if name != site and os.path.isdir(data_path + "DATABASES/" + name)]
+        registry.preload({name: database_args(name) for name in other_sites})
 
-    print("Building site specific database... \n(This will only need to run once if you intend "
-          "to continue querying the same site. As long as you do not "
-          "exit the program, the database will stay loaded for your next queries.)", flush=True)
-    database = HistoDatabase(database_index_path=db_index_path,
-                             index_meta_path=index_meta_path,
-                             codebook_semantic=codebook_semantic)
+
+def database_args(site: str) -> dict:
+    """
+    The HistoDatabase arguments of a site. With use_query_cache, repeated searches of the
+    same mosaics are answered from DATA/QUERY_CACHE.
+    """
+    db_index_path, index_meta_path, codebook_semantic = update_data_paths(site)
+    query_cache = QueryCache(cache_dir=data_path + "QUERY_CACHE/" + site) if use_query_cache else None
+    return {'database_index_path': db_index_path, 'index_meta_path': index_meta_path,
+            'codebook_semantic': codebook_semantic, 'query_cache': query_cache}
 
 
 def update_data_paths(site: str) -> tuple[str, str, str]:
     """
-    Asks the user for the path to their data folder and then constructs the necessary path strings
-    needed for calling the standard SISH functionalities.
+    Asks the user for the path to their data folder (once per session) and then constructs the necessary
+    path strings needed for calling the standard SISH functionalities.
     Also updates the global data_path variable.
     """
 
-    print("\n**At this point you need to have a DATA folder that contains these directories: 'checkpoints', 'DATABASES'"
-          " and 'LATENT'. Each should follow the structure described in the SISH readme**")
-    path: str = input(" - Path to 'DATA': ")
+    global data_path
+    path: str = data_path
+    if path == "":
+        print("\n**At this point you need to have a DATA folder that contains these directories: 'checkpoints', 'DATABASES'"
+              " and 'LATENT'. Each should follow the structure described in the SISH readme**")
+        path = input(" - Path to 'DATA': ")
 
-    # Standardize the input
-    path = standardize_path(path)
-    if "DATA" not in path.upper():
-        path += "DATA/"
+        # Standardize the input
+        path = standardize_path(path)
+        if "DATA" not in path.upper():
+            path += "DATA/"
 
-    print(f"Registered path: {path}\n")
+        print(f"Registered path: {path}\n")
 
     # Construct path strings
     db_index_path = path + "DATABASES/" + site + "/index_tree/veb.pkl"
-    index_meta_path = path + "DATABASES/" + site + "/index_meta/meta.pkl"
+    index_meta_path = path + "DATABASES/" + site + "/snapshot"
+    if not is_snapshot(index_meta_path):
+        index_meta_path = path + "DATABASES/" + site + "/index_meta/columnar"
+    if not os.path.isdir(index_meta_path):
+        index_meta_path = path + "DATABASES/" + site + "/index_meta/meta.pkl"
     codebook_semantic = path + "checkpoints/codebook_semantic.pt"
 
-    global data_path
     data_path = path
 
     return db_index_path, index_meta_path, codebook_semantic
@@ -226,4 +258,8 @@ def standardize_path(path: str) -> str:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interactive access to the SISH functionalities")
+    parser.add_argument("--query_cache", action='store_true',
+                        help="Cache the searched mosaics of each site in DATA/QUERY_CACHE")
+    use_query_cache = parser.parse_args().query_cache
     main()
@@ -0,0 +1,101 @@
+"""
+Per-process cache of open slides for the pool workers of the mosaic extraction. Opening a
+slide parses its whole header, so every worker opens a slide once and reuses the handle for
+all of the patches it is given instead of opening it again for every patch. The number of
+slides a worker keeps open is capped, the least recently used one is closed first.
+The white patch filters only look at patches scaled down to 256 px, which read_downsampled
+reads from the matching pyramid level instead of level 0.
+"""
+import multiprocessing as mp
+import os
+from collections import OrderedDict
+
+# HANDLE OS SPECIFIC OPENSLIDE IMPORT
+if hasattr(os, 'add_dll_directory'):
+    import openslide_win_config
+
+    with os.add_dll_directory(openslide_win_config.get_openslide_path()):
+        import openslide
+else:
+    import openslide
+
+MAX_OPEN_SLIDES = 8  # Number of slides kept open by each worker
+
+_handles = OrderedDict()
+_max_open = MAX_OPEN_SLIDES
+
+
+def init_slide_handles(max_open=MAX_OPEN_SLIDES):
+    """
+    Initializer of the pool workers
+    Input:
+        max_open (int): The number of slides the worker keeps open
+    """
+    global _max_open
+    _max_open = max_open
+    close_slides()
+
+
+def get_slide(slide_path):
+    """
+    The open slide of slide_path, opened on the first use in this process
+    """
+    wsi = _handles.get(slide_path)
+    if wsi is not None:
+        _handles.move_to_end(slide_path)
+        return wsi
+    wsi = openslide.open_slide(slide_path)
+    _handles[slide_path] = wsi
+    while len(_handles) > _max_open:
+        _, evicted = _handles.popitem(last=False)
+        evicted.close()
+    return wsi
+
+
+def read_downsampled(wsi, coord, patch_size, target_size=256):
+    """
+    Read a patch scaled down to target_size from the pyramid level that best matches the
+    downsampling, instead of reading it at full resolution from level 0 and resizing it
+    Input:
+        wsi (openslide object): The slide
+        coord (tuple): The level 0 coordinate of the top left corner of the patch
+        patch_size (int): The height and width of the patch at level 0
+        target_size (int): The height and width of the returned image
+    Output:
+        region (PIL.Image): The RGBA patch of target_size x target_size
+    """
+    level = wsi.get_best_level_for_downsample(patch_size / target_size)
+    level_size = int(round(patch_size / wsi.level_downsamples[level]))
+    region = wsi.read_region((int(coord[0]), int(coord[1])), level, (level_size, level_size))
+    if level_size != target_size:
+        region = region.resize((target_size, target_size))
+    return region
+
+
+def close_slides():
+    """
+    Close all slides opened by this process
+    """
+    while len(_handles) > 0:
+        _, wsi = _handles.popitem(last=False)
+        wsi.close()
+
+
+def slide_pool(num_workers, max_open=MAX_OPEN_SLIDES):
+    """
+    A pool whose workers cache their open slides
+    Input:
+        num_workers (int): The number of worker processes
+        max_open (int): The number of slides each worker keeps open
+    Output:
+        pool (multiprocessing.Pool): The pool
+    """
+    return mp.Pool(num_workers, initializer=init_slide_handles, initargs=(max_open,))
+
+
+def slide_chunksize(num_patches, num_workers, chunks_per_worker=4):
+    """
+    The chunksize that splits the patches of a slide into a few contiguous chunks per worker,
+    so every worker reads a block of patches from its cached handle per task
+    """
+    return max(1, -(-num_patches // (num_workers * chunks_per_worker)))
@@ -0,0 +1,101 @@
+"""
+Binary snapshot of a whole database: the index keys and meta data as a columnar meta store
+(see meta_store.py) and the semantic codebook as a lookup array. Every component is opened
+with np.load(mmap_mode='r'), so loading a site takes a few memory maps instead of unpickling
+veb.pkl and meta.pkl. Layout:
+    snapshot.json               format version, content checksum and whether it is a patch database
+    meta/                       columnar meta store, its sorted keys are the index
+    codebook_semantic.npy       lookup[old codeword] = new codeword
+"""
+import argparse
+import json
+import os
+import pickle
+import time
+import numpy as np
+import torch
+from meta_store import ColumnarMeta, load_columnar_meta
+from mosaic_index import semantic_lookup
+from sorted_index import SortedIndex
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = 'snapshot.json'
+
+
+def is_snapshot(path):
+    """
+    Whether the path is a database snapshot directory
+    """
+    return path is not None and os.path.isfile(os.path.join(path, SNAPSHOT_HEADER))
+
+
+def save_snapshot(save_path, meta, codebook_semantic):
+    """
+    Write a database snapshot
+    Input:
+        save_path (str): The directory of the snapshot
+        meta (ColumnarMeta): The index meta data
+        codebook_semantic (dict, torch.Tensor or np.array): The semantic codebook
+    Output: None
+    """
+    os.makedirs(save_path, exist_ok=True)
+    meta.save(os.path.join(save_path, 'meta'))
+    np.save(os.path.join(save_path, 'codebook_semantic.npy'),
+            np.asarray(semantic_lookup(codebook_semantic), dtype=np.int64))
+    header = {'version': SNAPSHOT_VERSION, 'checksum': meta.checksum(), 'is_patch': meta.is_patch,
+              'num_keys': len(meta.keys), 'num_entries': len(meta.codes)}
+    with open(os.path.join(save_path, SNAPSHOT_HEADER), 'w') as handle:
+        json.dump(header, handle)
+
+
+def load_snapshot(snapshot_path):
+    """
+    Open a database snapshot written by save_snapshot
+    Input:
+        snapshot_path (str): The directory of the snapshot
+    Output:
+        meta (ColumnarMeta): The memory mapped index meta data, meta.keys is the index
+        lookup (np.array): The semantic codebook as returned by mosaic_index.semantic_lookup
+        load_times (dict): Seconds spent on each component
+    """
+    with open(os.path.join(snapshot_path, SNAPSHOT_HEADER), 'r') as handle:
+        header = json.load(handle)
+    if header['version'] != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version {} in {}".format(header['version'], snapshot_path))
+
+    load_times = {}
+    t_start = time.time()
+    meta = ColumnarMeta.open(os.path.join(snapshot_path, 'meta'))
+    load_times['index_meta'] = time.time() - t_start
+
+    t_start = time.time()
+    lookup = np.load(os.path.join(snapshot_path, 'codebook_semantic.npy'), mmap_mode='r')
+    load_times['codebook'] = time.time() - t_start
+    return meta, lookup, load_times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert veb.pkl + meta.pkl into a database snapshot")
+    parser.add_argument("--index_meta_path", type=str, required=True,
+                        help="Path to the meta data of each index (meta.pkl or a columnar store)")
+    parser.add_argument("--codebook_semantic", type=str, default="./checkpoints/codebook_semantic.pt",
+                        help="Path to the semantic codebook from vq-vae")
+    parser.add_argument("--db_index_path", type=str, default=None,
+                        help="Optional path to veb.pkl, checked to hold the same keys as the meta data")
+    parser.add_argument("--save_path", type=str, default=None,
+                        help="Directory of the snapshot, defaults to DATABASES/SITE/snapshot")
+    args = parser.parse_args()
+
+    save_path = args.save_path
+    if save_path is None:
+        site_path = os.path.dirname(os.path.dirname(os.path.abspath(args.index_meta_path)))
+        save_path = os.path.join(site_path, 'snapshot')
+
+    meta = load_columnar_meta(args.index_meta_path)
+    if args.db_index_path is not None:
+        with open(args.db_index_path, 'rb') as handle:
+            veb = pickle.load(handle)
+        if not np.array_equal(SortedIndex.from_veb(veb).keys, meta.keys):
+            raise ValueError("{} and {} hold different keys".format(args.db_index_path, args.index_meta_path))
+    save_snapshot(save_path, meta, torch.load(args.codebook_semantic))
+    print("Wrote snapshot with {} keys and {} mosaics to {}".format(len(meta.keys), len(meta.codes), save_path))
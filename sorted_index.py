@@ -0,0 +1,182 @@
+"""
+Array-backed index engine that answers the same predecessor/successor/member
+queries as the VEB tree in veb.py from a single sorted int64 key array.
+"""
+import numpy as np
+
+
+class SortedIndex(object):
+    """
+    Sorted-array replacement of the VEB tree
+    Attributes:
+        keys (np.array): Sorted and unique int64 keys stored in the index
+    """
+    # Number of keys materialized per step when walking with a cursor
+    walk_chunk = 64
+
+    def __init__(self, keys):
+        """
+        The initializer for SortedIndex
+        Input:
+            keys (iterable): Integer keys of the index, duplicates are allowed
+        Output: None
+        """
+        if isinstance(keys, np.ndarray):
+            keys = keys.astype(np.int64)
+        else:
+            keys = np.fromiter((int(k) for k in keys), dtype=np.int64)
+        self.keys = np.unique(keys)
+        if len(self.keys) > 0:
+            self.min = int(self.keys[0])
+            self.max = int(self.keys[-1])
+        else:
+            self.min = None
+            self.max = None
+
+    @classmethod
+    def from_sorted(cls, keys):
+        """
+        Wrap an array that is already sorted and unique without copying it
+        (e.g., the memory mapped keys of a columnar meta store)
+        Input:
+            keys (np.array): Sorted and unique int64 keys
+        Output:
+            index (SortedIndex): The sorted index over keys
+        """
+        index = cls.__new__(cls)
+        index.keys = keys
+        index.min = int(keys[0]) if len(keys) > 0 else None
+        index.max = int(keys[-1]) if len(keys) > 0 else None
+        return index
+
+    @classmethod
+    def from_veb(cls, veb):
+        """
+        Build the sorted index by walking all keys stored in a VEB tree
+        Input:
+            veb (VEB): The VEB tree to convert
+        Output:
+            index (SortedIndex): The equivalent sorted index
+        """
+        keys = []
+        if veb.min is not None:
+            keys.append(veb.min)
+            key = veb.successor(veb.min)
+            while key is not None:
+                keys.append(key)
+                key = veb.successor(key)
+        return cls(np.array(keys, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def member(self, x):
+        pos = np.searchsorted(self.keys, x, side='left')
+        return bool(pos < len(self.keys) and self.keys[pos] == x)
+
+    def predecessor(self, x):
+        """
+        Return the largest key strictly smaller than x, None if there is none
+        """
+        pos = np.searchsorted(self.keys, x, side='left')
+        if pos == 0:
+            return None
+        return int(self.keys[pos - 1])
+
+    def successor(self, x):
+        """
+        Return the smallest key strictly larger than x, None if there is none
+        """
+        pos = np.searchsorted(self.keys, x, side='right')
+        if pos == len(self.keys):
+            return None
+        return int(self.keys[pos])
+
+    def iter_predecessors(self, x):
+        """
+        Walk the keys strictly smaller than x in descending order. The position
+        is located once with a binary search and then moved as a cursor.
+        """
+        cursor = int(np.searchsorted(self.keys, x, side='left'))
+        while cursor > 0:
+            start = max(cursor - self.walk_chunk, 0)
+            for key in self.keys[start:cursor][::-1].tolist():
+                yield key
+            cursor = start
+
+    def iter_successors(self, x):
+        """
+        Walk the keys strictly larger than x in ascending order. The position
+        is located once with a binary search and then moved as a cursor.
+        """
+        cursor = int(np.searchsorted(self.keys, x, side='right'))
+        total = len(self.keys)
+        while cursor < total:
+            stop = min(cursor + self.walk_chunk, total)
+            for key in self.keys[cursor:stop].tolist():
+                yield key
+            cursor = stop
+
+    def range_scan(self, seeds, pre_step, succ_step, skip=None):
+        """
+        Resolve the backward and forward windows of many seeds in a single vectorized call.
+        Row i holds the positions of the pre_step keys strictly smaller than seeds[i] in
+        descending order, followed by the succ_step keys strictly larger than seeds[i]
+        in ascending order.
+        Input:
+            seeds (np.array): The seed keys
+            pre_step (int): The number of keys taken before each seed
+            succ_step (int): The number of keys taken after each seed
+            skip (np.array): Sorted positions that are passed over without being counted
+            (e.g., keys whose meta data is empty after leave-one-patient-out)
+        Output:
+            positions (len(seeds) x (pre_step + succ_step) np.array): Positions into self.keys,
+            -1 marks the slots that run past either end of the index
+        """
+        seeds = np.asarray(seeds, dtype=np.int64)
+        if skip is None:
+            skip = np.zeros(0, dtype=np.int64)
+        pre_end = np.searchsorted(self.keys, seeds, side='left')
+        succ_start = np.searchsorted(self.keys, seeds, side='right')
+        pre_window = self._scan_window(pre_end, pre_step, skip, backward=True)
+        succ_window = self._scan_window(succ_start, succ_step, skip, backward=False)
+        return np.concatenate([pre_window, succ_window], axis=1)
+
+    def _scan_window(self, anchor, step, skip, backward):
+        """
+        Take step positions before (backward) or from (forward) each anchor position,
+        widening the window for every skipped position that falls inside it.
+        """
+        total = len(self.keys)
+        if step <= 0:
+            return np.zeros((len(anchor), 0), dtype=np.int64)
+
+        # Widen the windows until the number of skipped positions inside them is stable
+        extra = np.zeros(len(anchor), dtype=np.int64)
+        while len(skip) > 0:
+            if backward:
+                lo = np.maximum(anchor - step - extra, 0)
+                hi = anchor
+            else:
+                lo = anchor
+                hi = np.minimum(anchor + step + extra, total)
+            skipped = np.searchsorted(skip, hi, side='left') - np.searchsorted(skip, lo, side='left')
+            if np.array_equal(skipped, extra):
+                break
+            extra = skipped
+
+        width = step + int(extra.max()) if len(extra) > 0 else step
+        offsets = np.arange(width, dtype=np.int64)
+        if backward:
+            positions = anchor[:, None] - 1 - offsets[None, :]
+        else:
+            positions = anchor[:, None] + offsets[None, :]
+        invalid = (positions < 0) | (positions >= total)
+        if len(skip) > 0:
+            invalid |= np.isin(positions, skip)
+        positions[invalid] = -1
+
+        # Compact the valid positions to the front of each row, keeping their order
+        order = np.argsort(invalid, axis=1, kind='stable')
+        positions = np.take_along_axis(positions, order, axis=1)
+        return positions[:, :step]
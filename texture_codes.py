@@ -0,0 +1,145 @@
+"""
+Packed storage of the binarized DenseNet texture features (h_{i}) and the
+vectorized hamming distance used to compare them.
+A code of 1024 bits is stored as 128 uint8 (np.packbits order), so the
+hamming distance to a whole block of candidates is one XOR and one popcount.
+"""
+import argparse
+import pickle
+import numpy as np
+
+# Number of bits of a texture code
+CODE_BITS = 1024
+
+# Number of set bits in every possible byte
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_codes(codes):
+    """
+    Convert texture codes into packed bits
+    Input:
+        codes (str, list of str or np.array): Either '0'/'1' strings as produced by
+        min_max_binarized, an array of CODE_BITS bits (e.g. bool or the uint8 bits of
+        unpack_codes), or an already packed uint8 array of CODE_BITS / 8 bytes which is
+        returned unchanged
+    Output:
+        packed (np.array): uint8 array of shape (L / 8,) for a single code or (N x L / 8)
+    """
+    if isinstance(codes, np.ndarray):
+        if codes.dtype == np.uint8 and codes.shape[-1] == CODE_BITS // 8:
+            return codes
+        if codes.dtype != np.uint8 or codes.shape[-1] == CODE_BITS:
+            return np.packbits(codes.astype(bool), axis=-1)
+        raise ValueError("Expected {} packed bytes or {} bits per code, got {}".format(
+            CODE_BITS // 8, CODE_BITS, codes.shape[-1]))
+    if isinstance(codes, str):
+        bits = np.frombuffer(codes.encode('ascii'), dtype=np.uint8) - ord('0')
+        return np.packbits(bits)
+    codes = list(codes)
+    if len(codes) == 0:
+        return np.zeros((0, CODE_BITS // 8), dtype=np.uint8)
+    if isinstance(codes[0], str):
+        bits = np.frombuffer("".join(codes).encode('ascii'), dtype=np.uint8) - ord('0')
+        return np.packbits(bits.reshape(len(codes), -1), axis=1)
+    return np.stack([pack_codes(code) for code in codes])
+
+
+def min_max_binarize(features, as_str=False):
+    """
+    Min-max algorithm proposed in paper: Yottixel-An Image Search Engine for Large Archives of
+    Histopathology Whole Slide Images, for a whole batch of features. Bit i is set when
+    feature i is not smaller than feature i - 1, the first bit is always 0.
+    Input:
+        features (np.array): Features from the last layer of DenseNet121, (1024,) or (N x 1024)
+        as_str (bool): Whether to return '0'/'1' strings compatible with the old meta files
+    Output:
+        codes (np.array, str or list of str): The codes packed into uint8, (128,) or (N x 128)
+    """
+    features = np.asarray(features)
+    bits = np.zeros(features.shape, dtype=bool)
+    bits[..., 1:] = features[..., 1:] >= features[..., :-1]
+    packed = np.packbits(bits, axis=-1)
+    if as_str:
+        return unpack_codes(packed, as_str=True)
+    return packed
+
+
+def unpack_codes(packed, as_str=False):
+    """
+    Convert packed codes back into bits
+    Input:
+        packed (np.array): uint8 array of shape (L / 8,) or (N x L / 8)
+        as_str (bool): Whether to return '0'/'1' strings compatible with the old meta files
+    Output:
+        codes (np.array, str or list of str): The unpacked codes
+    """
+    bits = np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=-1)
+    if not as_str:
+        return bits
+    if bits.ndim == 1:
+        return (bits + ord('0')).tobytes().decode('ascii')
+    return [(row + ord('0')).tobytes().decode('ascii') for row in bits]
+
+
+def hamming_distance(query, block):
+    """
+    Hamming distance between one packed query code and a block of packed codes
+    Input:
+        query (np.array): Packed query code of shape (L / 8,)
+        block (np.array): Packed candidate codes of shape (N x L / 8) or (L / 8,)
+    Output:
+        dist (np.array): int64 array of N distances (a scalar array for a single code)
+    """
+    xor = np.bitwise_xor(block, query)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT_TABLE[xor].sum(axis=-1, dtype=np.int64)
+
+
+def pack_meta_codes(meta):
+    """
+    Convert the string codes of an index meta dictionary into packed codes in place,
+    so databases built before the codes were packed keep working.
+    Input:
+        meta (dict): Index key -> list of mosaic meta data with 'dense_binarized'
+    Output:
+        converted (int): The number of converted codes
+    """
+    converted = 0
+    for entries in meta.values():
+        for entry in entries:
+            if isinstance(entry['dense_binarized'], str):
+                entry['dense_binarized'] = pack_codes(entry['dense_binarized'])
+                converted += 1
+    return converted
+
+
+def load_meta(index_meta_path):
+    """
+    Load an index meta file and make sure all of its codes are packed
+    Input:
+        index_meta_path (str): The path to meta.pkl
+    Output:
+        meta (dict): The index meta with packed codes
+    """
+    with open(index_meta_path, 'rb') as handle:
+        meta = pickle.load(handle)
+    converted = pack_meta_codes(meta)
+    if converted > 0:
+        print("Packed {} string texture codes from {}".format(converted, index_meta_path), flush=True)
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite a string-based meta.pkl with packed texture codes")
+    parser.add_argument("--index_meta_path", type=str, required=True,
+                        help="Path to the meta data of each index")
+    parser.add_argument("--save_path", type=str, default=None,
+                        help="Where to write the converted meta, defaults to overwriting the input")
+    args = parser.parse_args()
+
+    meta = load_meta(args.index_meta_path)
+    save_path = args.save_path if args.save_path is not None else args.index_meta_path
+    with open(save_path, 'wb') as handle:
+        pickle.dump(meta, handle)
@@ -104,6 +104,18 @@ class VEB:
                         offset = cluster2.max
                     return self.index(predcluster, offset)
 
+    def iter_predecessors(self, x):
+        pre = self.predecessor(x)
+        while pre is not None:
+            yield pre
+            pre = self.predecessor(pre)
+
+    def iter_successors(self, x):
+        succ = self.successor(x)
+        while succ is not None:
+            yield succ
+            succ = self.successor(succ)
+
     def emptyInsert(self, x):
         self.min = x
         self.max = x
@@ -3,7 +3,6 @@ import os
 import time
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
-import multiprocessing as mp
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
@@ -21,7 +20,7 @@ from PIL import Image
 import pdb
 import h5py
 import math
-from SISH_Fork.wsi_core.wsi_utils import savePatchIter_bag_hdf5, initialize_hdf5_bag, coord_generator, save_hdf5, sample_indices, screen_coords, isBlackPatch, isWhitePatch, to_percentiles
+from SISH_Fork.wsi_core.wsi_utils import savePatchIter_bag_hdf5, initialize_hdf5_bag, coord_generator, save_hdf5, sample_indices, screen_coords, isBlackPatch, isWhitePatch, to_percentiles, grid_in_contour
 import itertools
 from SISH_Fork.wsi_core.util_classes import isInContourV1, isInContourV2, isInContourV3_Easy, isInContourV3_Hard, Contour_Checking_fn
 from SISH_Fork.utils.file_utils import load_pkl, save_pkl
@@ -488,17 +487,10 @@ class WholeSlideImage(object):
 				print("Adjusted Bounding Box:", start_x, start_y, w, h, flush=True)
 	
 		if isinstance(contour_fn, str):
-			if contour_fn == 'four_pt':
-				cont_check_fn = isInContourV3_Easy(contour=cont, patch_size=ref_patch_size[0], center_shift=0.5)
-			elif contour_fn == 'center':
-				cont_check_fn = isInContourV2(contour=cont, patch_size=ref_patch_size[0])
-			elif contour_fn == 'basic':
-				cont_check_fn = isInContourV1(contour=cont)
-			else:
+			if contour_fn not in ('four_pt', 'center', 'basic'):
 				raise NotImplementedError
 		else:
 			assert isinstance(contour_fn, Contour_Checking_fn)
-			cont_check_fn = contour_fn
 
 		
 		step_size_x = step_size * patch_downsample[0]
@@ -509,26 +501,15 @@ class WholeSlideImage(object):
 		x_coords, y_coords = np.meshgrid(x_range, y_range, indexing='ij')
 		coord_candidates = np.array([x_coords.flatten(), y_coords.flatten()]).transpose()
 
-		num_workers = mp.cpu_count()
-		if num_workers > 4:
-			num_workers = 4
-		pool = mp.Pool(num_workers)
-
-		# process_dict = {'cont': cont, 'holes': contour_holes, 'patch_size': ref_patch_size[0], 
-		# 'cont_check_fn': cont_check_fn, 'use_padding': use_padding}
-		# coord_gen = coord_generator(start_x, stop_x, step_size_x, start_y, stop_y, step_size_y, args_dict=process_dict)
-		# while True:
-  #       	running = pool.map(savePatchIter, itertools.islice(patch_gen, n_gen_slice))
-  #           if running: 
-  #           	continue
-  #           else: 
-  #           	break
-		# pool.terminate()
-
-		iterable = [(coord, contour_holes, ref_patch_size[0], cont_check_fn) for coord in coord_candidates]
-		results = pool.starmap(WholeSlideImage.process_coord_candidate, iterable)
-		pool.close()
-		results = np.array([result for result in results if result is not None])
+		if isinstance(contour_fn, str):
+			# Test all candidates at once on masks of the contour and its holes at the step size resolution
+			keep = WholeSlideImage.grid_in_contours(cont, contour_holes, x_range, y_range, step_size_x, step_size_y,
+													 ref_patch_size[0], contour_fn)
+			results = coord_candidates[keep.flatten()]
+		else:
+			results = [WholeSlideImage.process_coord_candidate(coord, contour_holes, ref_patch_size[0], contour_fn)
+					   for coord in coord_candidates]
+			results = np.array([result for result in results if result is not None])
 		
 		print('Extracted {} coordinates'.format(len(results)), flush=True)
 
@@ -550,6 +531,33 @@ class WholeSlideImage(object):
 		else:
 			return {}, {}
 
+	@staticmethod
+	def grid_in_contours(cont, holes, x_range, y_range, step_size_x, step_size_y, patch_size, contour_fn='four_pt'):
+		"""
+		Vectorized isInContours for the patch candidates x_range x y_range with the isInContourV3_Easy ('four_pt'),
+		isInContourV2 ('center') or isInContourV1 ('basic') checking function, returns a len(x_range) x len(y_range) mask
+		"""
+		if len(x_range) == 0 or len(y_range) == 0:
+			return np.zeros((len(x_range), len(y_range)), dtype=bool)
+		center = patch_size//2
+		shift = int(patch_size//2*0.5)
+		if contour_fn == 'four_pt' and shift > 0:
+			offsets = [(center-shift, center-shift), (center+shift, center+shift),
+					   (center+shift, center-shift), (center-shift, center+shift)]
+		elif contour_fn in ('four_pt', 'center'):
+			offsets = [(center, center)]
+		else:
+			offsets = [(0, 0)]
+
+		grid = (step_size_x, step_size_y, len(x_range), len(y_range))
+		keep = np.zeros((len(x_range), len(y_range)), dtype=bool)
+		for offset_x, offset_y in offsets:
+			keep |= grid_in_contour(cont, x_range[0]+offset_x, y_range[0]+offset_y, *grid)
+		if holes is not None:
+			for hole in holes:
+				keep &= ~grid_in_contour(hole, x_range[0]+patch_size/2, y_range[0]+patch_size/2, *grid, strict=True)
+		return keep
+
 	@staticmethod
 	def process_coord_candidate(coord, contour_holes, ref_patch_size, cont_check_fn):
 		if WholeSlideImage.isInContours(cont_check_fn, coord, contour_holes, ref_patch_size):
@@ -69,6 +69,32 @@ def to_percentiles(scores):
     scores = rankdata(scores, 'average')/len(scores) * 100   
     return scores
 
+def grid_in_contour(contour, x_start, y_start, x_step, y_step, n_x, n_y, strict=False, margin=2):
+    """
+    Test which points (x_start + i * x_step, y_start + j * y_step) of a regular grid lie in a contour,
+    i.e., cv2.pointPolygonTest(contour, pt, False) >= 0 (> 0 if strict) for all points at once.
+    The contour is filled into a mask at the resolution of the grid with cv2.fillPoly, only the points
+    within margin grid cells of its outline are tested one by one with cv2.pointPolygonTest.
+    Returns an n_x x n_y bool array.
+    """
+    inside = np.zeros((n_y, n_x), dtype=bool)
+    if n_x == 0 or n_y == 0:
+        return inside.T
+    shift = 4  # Fractional bits of the vertices on the grid
+    vertices = contour.reshape(-1, 2).astype(np.float64)
+    vertices = np.stack([(vertices[:, 0] - x_start) / x_step, (vertices[:, 1] - y_start) / y_step], 1)
+    vertices = [np.round(vertices * (1 << shift)).astype(np.int32).reshape(-1, 1, 2)]
+
+    filled = np.zeros((n_y, n_x), dtype=np.uint8)
+    cv2.fillPoly(filled, vertices, 1, lineType=cv2.LINE_8, shift=shift)
+    outline = np.zeros((n_y, n_x), dtype=np.uint8)
+    cv2.polylines(outline, vertices, True, 1, thickness=2 * margin + 1, lineType=cv2.LINE_8, shift=shift)
+    inside[filled > 0] = True
+    for row, col in zip(*np.nonzero(outline)):
+        dist = cv2.pointPolygonTest(contour, (float(x_start + col * x_step), float(y_start + row * y_step)), False)
+        inside[row, col] = dist > 0 if strict else dist >= 0
+    return inside.T
+
 def top_k(scores, k, invert=False):
     if invert:
         top_k_ids=scores.argsort()[:k]